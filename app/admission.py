@@ -0,0 +1,245 @@
+"""
+Admission control for the suggest endpoint.
+
+Two layers, both answering with a fast 429 + Retry-After instead of letting requests pile up:
+- token buckets: one per user, with a rate and burst that depend on the user's tier
+  ("paid" for active/trialing subscriptions, "free" otherwise), and optionally one shared by
+  everyone in a tier. Buckets live in memory, or in redis (ADMISSION_REDIS_URL or REDIS_URL) so the limits hold
+  across workers. If redis is unreachable we fall back to the in-memory buckets.
+- a concurrency gate: at most SUGGEST_MAX_CONCURRENT suggestions talk to the model at once
+  (size it to the upstream quota, per worker). Past that, requests wait in a short queue where
+  paid users go first, SUGGEST_RESERVED_PAID slots are only for paid users, and a full queue
+  sheds a waiting free request to make room for a paid one.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+
+from fastapi import HTTPException
+
+from omni.cache import TTLCache, aioredis, get_redis, shared_url
+
+logger = logging.getLogger(__name__)
+
+TIERS = {
+    "free": {
+        "rate": float(os.getenv("SUGGEST_RATE_FREE", "2")),    # requests per second
+        "burst": float(os.getenv("SUGGEST_BURST_FREE", "20")),
+        # for the whole tier, 0 = no tier wide limit
+        "tier_rate": float(os.getenv("SUGGEST_TIER_RATE_FREE", "0")),
+        "tier_burst": float(os.getenv("SUGGEST_TIER_BURST_FREE", "0")),
+    },
+    "paid": {
+        "rate": float(os.getenv("SUGGEST_RATE_PAID", "5")),
+        "burst": float(os.getenv("SUGGEST_BURST_PAID", "50")),
+        "tier_rate": float(os.getenv("SUGGEST_TIER_RATE_PAID", "0")),
+        "tier_burst": float(os.getenv("SUGGEST_TIER_BURST_PAID", "0")),
+    },
+}
+MAX_CONCURRENT = int(os.getenv("SUGGEST_MAX_CONCURRENT", "64"))
+RESERVED_PAID = int(os.getenv("SUGGEST_RESERVED_PAID", "8"))
+MAX_QUEUE = int(os.getenv("SUGGEST_MAX_QUEUE", "256"))
+QUEUE_TIMEOUT = float(os.getenv("SUGGEST_QUEUE_TIMEOUT", "2"))
+BUSY_RETRY_AFTER = 1
+
+def tier_for(subscription) -> str:
+    if subscription and subscription.status in ["active", "trialing"]:
+        return "paid"
+    return "free"
+
+def too_many_requests(retry_after: float):
+    return HTTPException(
+        status_code=429,
+        detail="Too many requests",
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+class MemoryBuckets:
+    def __init__(self):
+        self.buckets = TTLCache(maxsize=int(os.getenv("ADMISSION_BUCKETS", "100000")), ttl=3600)
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        Take a token from the bucket. Returns 0 if we got one, otherwise the seconds until there is one.
+        """
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / rate
+        # a bucket that has refilled is the same as no bucket, so it can expire then
+        self.buckets.set(key, (tokens, now), ttl=burst / rate + 1)
+        return retry_after
+
+# the same bucket arithmetic, atomically in redis, on redis' clock so every worker agrees
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local retry = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    retry = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((burst / rate + 1) * 1000))
+return tostring(retry)
+"""
+
+class RedisBuckets:
+    def __init__(self, url: str, prefix: str = "admission"):
+        if aioredis is None:
+            raise RuntimeError("RedisBuckets needs the redis package (pip install redis)")
+        self.url = url
+        self.script = None
+        self.prefix = prefix
+        self.fallback = MemoryBuckets()
+        self.errors = 0
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        try:
+            if self.script is None:
+                self.script = get_redis(self.url).register_script(TAKE_SCRIPT)
+            return float(await self.script(keys=[f"{self.prefix}:{key}"], args=[rate, burst]))
+        except Exception as e:
+            logger.warning("redis rate limit failed, using local buckets: %s", e)
+            self.errors += 1
+            return await self.fallback.take(key, rate, burst)
+
+class Slot:
+    """
+    A place in the concurrency gate. release() is safe to call more than once.
+    """
+    def __init__(self, gate):
+        self.gate = gate
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gate.release()
+
+class ConcurrencyGate:
+    def __init__(self, limit: int, reserved_paid: int, max_queue: int, timeout: float):
+        self.limit = limit
+        self.reserved_paid = reserved_paid
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_use = 0
+        self.waiters = []  # heap of (priority, seq, future, paid), paid users first
+        self.seq = itertools.count()
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0, "timeouts": 0, "rejected": 0, "peak_in_use": 0}
+
+    def has_room(self, paid: bool) -> bool:
+        return self.in_use < (self.limit if paid else self.limit - self.reserved_paid)
+
+    def take(self) -> Slot:
+        self.in_use += 1
+        self.stats["admitted"] += 1
+        self.stats["peak_in_use"] = max(self.stats["peak_in_use"], self.in_use)
+        return Slot(self)
+
+    def remove(self, entry):
+        if entry in self.waiters:
+            self.waiters.remove(entry)
+            heapq.heapify(self.waiters)
+
+    def shed_free_waiter(self) -> bool:
+        """
+        Drop the newest free request from the queue, to make room for a paid one.
+        """
+        free = [w for w in self.waiters if not w[3]]
+        if not free:
+            return False
+        entry = max(free, key=lambda w: w[1])
+        self.remove(entry)
+        entry[2].set_exception(too_many_requests(BUSY_RETRY_AFTER))
+        self.stats["shed"] += 1
+        return True
+
+    async def acquire(self, paid: bool) -> Slot:
+        priority = 0 if paid else 1
+        # don't jump the queue ahead of anyone with the same or a higher priority
+        if self.has_room(paid) and not (self.waiters and self.waiters[0][0] <= priority):
+            return self.take()
+
+        if len(self.waiters) >= self.max_queue and not (paid and self.shed_free_waiter()):
+            self.stats["rejected"] += 1
+            raise too_many_requests(BUSY_RETRY_AFTER)
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.seq), future, paid)
+        heapq.heappush(self.waiters, entry)
+        self.stats["queued"] += 1
+        try:
+            await asyncio.wait([future], timeout=self.timeout)
+        except asyncio.CancelledError:
+            # the client went away while waiting, give back the slot if we had just been handed one
+            self.remove(entry)
+            if future.done() and not future.cancelled() and future.exception() is None:
+                future.result().release()
+            future.cancel()
+            raise
+
+        if not future.done():
+            self.remove(entry)
+            future.cancel()
+            self.stats["timeouts"] += 1
+            raise too_many_requests(BUSY_RETRY_AFTER)
+        return future.result()
+
+    def release(self):
+        self.in_use -= 1
+        while self.waiters and self.has_room(self.waiters[0][3]):
+            _, _, future, _ = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(self.take())
+
+class Admission:
+    def __init__(self):
+        redis_url = shared_url("ADMISSION_REDIS_URL")
+        self.buckets = RedisBuckets(redis_url) if redis_url else MemoryBuckets()
+        self.gate = ConcurrencyGate(MAX_CONCURRENT, RESERVED_PAID, MAX_QUEUE, QUEUE_TIMEOUT)
+        self.rate_limited = {tier: 0 for tier in TIERS}
+
+    async def check_rate(self, user_id: str, tier: str):
+        """
+        Raise a 429 if the user (or their whole tier) is over its rate.
+        """
+        limits = TIERS[tier]
+        retry_after = await self.buckets.take(f"user:{user_id}", limits["rate"], limits["burst"])
+        if not retry_after and limits["tier_rate"] > 0:
+            retry_after = await self.buckets.take(f"tier:{tier}", limits["tier_rate"], limits["tier_burst"] or limits["tier_rate"])
+        if retry_after:
+            self.rate_limited[tier] += 1
+            raise too_many_requests(retry_after)
+
+    async def acquire(self, tier: str) -> Slot:
+        """
+        Wait for a model slot. Raises a 429 if none frees up in time.
+        """
+        return await self.gate.acquire(tier == "paid")
+
+    def stats(self) -> dict:
+        return {
+            "rate_limited": self.rate_limited,
+            "in_use": self.gate.in_use,
+            "queued": len(self.gate.waiters),
+            **self.gate.stats,
+        }
+
+suggest_admission = Admission()
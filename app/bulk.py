@@ -0,0 +1,341 @@
+"""
+Batch item operations.
+
+POST /items/batch takes a list of operations:
+    {"op": "create", "item_type": "note", "meta": {...}, "content": "..."}
+    {"op": "get", "item_id": "...", "include_meta": true, "include_content": true}
+    {"op": "update", "item_id": "...", "meta": {...}, "content": "..."}
+    {"op": "delete", "item_id": "..."}
+and runs each kind as a few multi-row requests (the batch helpers in omni/helpers.py: one bulk insert,
+in_ filters for the rest) instead of one request per item. Creates run first, then updates, gets and
+deletes, so the gets see the updates of the same batch.
+
+Operations succeed or fail on their own. The response has one result per operation, in the same order:
+    {"index": 0, "op": "create", "status": 200, "item": {...}}
+    {"index": 1, "op": "get", "status": 404, "error": "Item not found"}
+If a bulk insert is rejected, its rows are retried one at a time so only the bad ones fail.
+
+POST /items/import takes NDJSON, one item per line (what /items/export writes), and inserts
+IMPORT_BATCH_SIZE lines at a time while the body is still coming in, so an import of any size
+is never held in memory.
+"""
+
+import asyncio
+import json
+import logging
+import os
+
+from omni.helpers import (
+    check_user_subscription, count_items, create_items, get_items_by_id, update_items, delete_items
+)
+from omni.writebehind import content_writer
+from .documents import remember_document, forget_document, current_document
+
+logger = logging.getLogger(__name__)
+
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "200"))
+IMPORT_MAX_LINE_BYTES = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(4 * 1024 * 1024)))
+# an import with lots of bad lines still reports how many, but only the first of them in detail
+IMPORT_MAX_ERRORS = 100
+# inserts at a time when retrying a rejected batch row by row
+RETRY_CONCURRENCY = 10
+
+bulk_stats = {
+    "batches": 0,
+    "operations": 0,
+    "failed": 0,
+    "imports": 0,
+    "imported": 0,
+    "retried_inserts": 0,
+}
+
+def failure(e: Exception) -> tuple:
+    """
+    (status, error) for an exception from the db. postgrest errors (bad values, constraint violations)
+    are the caller's problem, anything else is ours.
+    """
+    message = getattr(e, "message", None)
+    if message:
+        return 400, message
+    logger.error("batch operation failed", exc_info=e)
+    return 500, "Internal error"
+
+async def has_paid_plan(user_id: str, product_name: str) -> bool:
+    subscription = await check_user_subscription(user_id, product_name)
+    return bool(subscription) and subscription.status in ["active", "trialing"] and not subscription.cancel_at_period_end
+
+class CreateQuota:
+    """
+    The same limit as POST /items: without a subscription, a user can only add an item of a type while
+    they have 3 or fewer of that type. The count is fetched once per type and kept up to date as we
+    create items, and the subscription is checked at most once.
+    """
+    def __init__(self, user_id: str, product_name: str):
+        self.user_id = user_id
+        self.product_name = product_name
+        self.counts = {}
+        self.paid = None
+
+    async def take(self, item_type: str) -> bool:
+        if item_type not in self.counts:
+            self.counts[item_type] = await count_items(self.user_id, self.product_name, item_type)
+        if self.counts[item_type] > 3:
+            if self.paid is None:
+                self.paid = await has_paid_plan(self.user_id, self.product_name)
+            if not self.paid:
+                return False
+        self.counts[item_type] += 1
+        return True
+
+    def give_back(self, item_type: str):
+        # the insert failed after all
+        self.counts[item_type] -= 1
+
+async def insert_items(user_id: str, product_name: str, items: list) -> list:
+    """
+    Create items with one insert, or if that is rejected, with one insert per item so only the bad ones fail.
+    Returns the new row or the exception for each item, in order.
+    """
+    try:
+        return await create_items(user_id, product_name, items)
+    except Exception as e:
+        if len(items) == 1:
+            return [e]
+
+    bulk_stats["retried_inserts"] += 1
+    slots = asyncio.Semaphore(RETRY_CONCURRENCY)
+
+    async def insert_one(item):
+        async with slots:
+            try:
+                return (await create_items(user_id, product_name, [item]))[0]
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(insert_one(item) for item in items))
+
+async def create_quota_checked(quota: CreateQuota, user_id: str, product_name: str, items: list) -> list:
+    """
+    insert_items for the items the quota allows. Returns a row, an exception, or None (over the quota)
+    for each item, in order.
+    """
+    allowed = [await quota.take(item.get("item_type")) for item in items]
+    rows = await insert_items(user_id, product_name, [item for item, ok in zip(items, allowed) if ok]) if any(allowed) else []
+    results = []
+    rows = iter(rows)
+    for item, ok in zip(items, allowed):
+        row = next(rows) if ok else None
+        if isinstance(row, Exception):
+            quota.give_back(item.get("item_type"))
+        results.append(row)
+    return results
+
+async def run_batch(user_id: str, product_name: str, operations: list) -> dict:
+    """
+    Run a list of operations (dicts, see the top of this file). Returns
+    {"results": [one per operation], "succeeded": n, "failed": n}.
+    """
+    results = [None] * len(operations)
+
+    def succeed(index, **fields):
+        results[index] = {"index": index, "op": operations[index]["op"], "status": 200, **fields}
+
+    def fail(index, status, error):
+        results[index] = {"index": index, "op": operations[index]["op"], "status": status, "error": error}
+
+    kinds = {"create": [], "update": [], "get": [], "delete": []}
+    for index, operation in enumerate(operations):
+        if operation.get("op") not in kinds:
+            results[index] = {"index": index, "op": operation.get("op"), "status": 400, "error": "op must be create, get, update or delete"}
+        elif operation["op"] != "create" and not operation.get("item_id"):
+            fail(index, 400, "item_id is required")
+        elif operation["op"] == "update" and operation.get("meta") is None and operation.get("content") is None:
+            fail(index, 400, "meta or content is required")
+        else:
+            kinds[operation["op"]].append(index)
+
+    if kinds["create"]:
+        quota = CreateQuota(user_id, product_name)
+        rows = await create_quota_checked(quota, user_id, product_name, [operations[i] for i in kinds["create"]])
+        for index, row in zip(kinds["create"], rows):
+            if row is None:
+                fail(index, 402, "Payment required")
+            elif isinstance(row, Exception):
+                fail(index, *failure(row))
+            else:
+                succeed(index, item=row)
+
+    if kinds["update"]:
+        updates = []
+        for index in kinds["update"]:
+            operation = operations[index]
+            update = {"item_id": operation["item_id"]}
+            if operation.get("meta") is not None:
+                update["meta"] = operation["meta"]
+            if operation.get("content") is not None:
+                update["content"] = operation["content"]
+            updates.append(update)
+        updated = await update_items(user_id, updates)
+        for index, update in zip(kinds["update"], updates):
+            result = updated.get(update["item_id"])
+            if update["item_id"] not in updated:
+                fail(index, 404, "Item not found")
+                continue
+            if isinstance(result, Exception):
+                fail(index, *failure(result))
+                continue
+            fields = {"item_id": update["item_id"], "updated_at": result}
+            if "content" in update:
+                # an older save still waiting in the write-behind queue would overwrite this one
+                content_writer.discard(user_id, update["item_id"])
+                fields["version"] = await remember_document(user_id, update["item_id"], update["content"])
+            succeed(index, **fields)
+
+    if kinds["get"]:
+        # one lookup per combination of include flags
+        shapes = {}
+        for index in kinds["get"]:
+            operation = operations[index]
+            shape = (bool(operation.get("include_meta")), bool(operation.get("include_content")))
+            shapes.setdefault(shape, []).append(index)
+
+        async def get_shape(shape, indexes):
+            try:
+                found = await get_items_by_id(user_id, [operations[i]["item_id"] for i in indexes], *shape)
+            except Exception as e:
+                status, error = failure(e)
+                for index in indexes:
+                    fail(index, status, error)
+                return
+            for index in indexes:
+                item = found.get(operations[index]["item_id"])
+                if item is None:
+                    fail(index, 404, "Item not found")
+                    continue
+                item = dict(item)
+                if shape[1]:
+                    # same as GET /items/{item_id}: queued content is newer than the db's, and the version for patches
+                    document = await current_document(user_id, item["item_id"], item["item_content"])
+                    item["item_content"] = document["content"]
+                    item["version"] = document["version"]
+                succeed(index, item=item)
+
+        await asyncio.gather(*(get_shape(shape, indexes) for shape, indexes in shapes.items()))
+
+    if kinds["delete"]:
+        try:
+            deleted = set(await delete_items(user_id, [operations[i]["item_id"] for i in kinds["delete"]]))
+        except Exception as e:
+            status, error = failure(e)
+            for index in kinds["delete"]:
+                fail(index, status, error)
+        else:
+            for index in kinds["delete"]:
+                item_id = operations[index]["item_id"]
+                if item_id in deleted:
+                    await forget_document(user_id, item_id)
+                    content_writer.discard(user_id, item_id)
+                    succeed(index, item_id=item_id)
+                else:
+                    fail(index, 404, "Item not found")
+
+    failed = sum(1 for result in results if result["status"] != 200)
+    bulk_stats["batches"] += 1
+    bulk_stats["operations"] += len(results)
+    bulk_stats["failed"] += failed
+    return {"results": results, "succeeded": len(results) - failed, "failed": failed}
+
+def parse_import_line(line: bytes) -> dict:
+    """
+    An item to create from an import line. Takes the field names of create operations (meta, content)
+    and of exported items (item_meta, item_content). Raises ValueError if the line isn't one.
+    """
+    try:
+        value = json.loads(line)
+    except ValueError:
+        raise ValueError("Invalid JSON")
+    if not isinstance(value, dict):
+        raise ValueError("Expected an object")
+    item = {
+        "item_type": value.get("item_type"),
+        "meta": value.get("meta", value.get("item_meta")),
+        "content": value.get("content", value.get("item_content")),
+    }
+    if item["item_type"] is not None and not isinstance(item["item_type"], str):
+        raise ValueError("item_type must be a string")
+    if item["meta"] is not None and not isinstance(item["meta"], dict):
+        raise ValueError("meta must be an object")
+    if item["content"] is not None and not isinstance(item["content"], str):
+        raise ValueError("content must be a string")
+    return item
+
+async def import_lines(chunks):
+    """
+    Yields (line number, line) for the non-empty lines of an NDJSON body that arrives in chunks,
+    or (line number, None) for a line longer than IMPORT_MAX_LINE_BYTES (which is skipped, not buffered).
+    """
+    buffer = b""
+    number = 0
+    skipping = False
+    async for chunk in chunks:
+        buffer += chunk
+        lines = buffer.split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            number += 1
+            if skipping:
+                # the rest of the long line
+                skipping = False
+                yield number, None
+            elif line.strip():
+                yield number, line
+        if len(buffer) > IMPORT_MAX_LINE_BYTES:
+            buffer = b""
+            skipping = True
+    if skipping:
+        yield number + 1, None
+    elif buffer.strip():
+        yield number + 1, buffer
+
+async def import_items(user_id: str, product_name: str, chunks) -> dict:
+    """
+    Create an item for every line of an NDJSON body (chunks is an async iterator of bytes, e.g. request.stream()).
+    Returns {"created": n, "failed": n, "errors": [{"line": n, "status": ..., "error": ...}, ...]}.
+    """
+    quota = CreateQuota(user_id, product_name)
+    summary = {"created": 0, "failed": 0, "errors": []}
+
+    def fail(number, status, error):
+        summary["failed"] += 1
+        if len(summary["errors"]) < IMPORT_MAX_ERRORS:
+            summary["errors"].append({"line": number, "status": status, "error": error})
+
+    async def flush(batch):
+        rows = await create_quota_checked(quota, user_id, product_name, [item for _, item in batch])
+        for (number, _), row in zip(batch, rows):
+            if row is None:
+                fail(number, 402, "Payment required")
+            elif isinstance(row, Exception):
+                fail(number, *failure(row))
+            else:
+                summary["created"] += 1
+
+    batch = []
+    async for number, line in import_lines(chunks):
+        if line is None:
+            fail(number, 413, "Line too long")
+            continue
+        try:
+            batch.append((number, parse_import_line(line)))
+        except ValueError as e:
+            fail(number, 422, str(e))
+            continue
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+
+    bulk_stats["imports"] += 1
+    bulk_stats["imported"] += summary["created"]
+    return summary
@@ -0,0 +1,191 @@
+"""
+Builds the context we send to the model for long documents.
+
+The model only needs the end of the document to predict what comes next, so we keep a tail
+of at most CONTEXT_TOKEN_BUDGET tokens, cut at a paragraph or sentence boundary.
+Optionally the part we dropped is replaced by a short summary, which is made in the background
+and cached, so it never holds up a suggestion.
+
+Token counts come from tiktoken. The encoding is loaded once, at startup, from TIKTOKEN_CACHE_DIR
+(the file is downloaded into it the first time, so a deployment should ship it there or keep the
+directory between runs). If TIKTOKEN_CACHE_DIR isn't set or the encoding can't be loaded, the app
+doesn't start, because the context budgets are in tokens. With TOKENIZER_REQUIRED=0 it starts anyway
+and estimates ~4 characters per token, which shows as context_tokenizer_loaded 0 and a growing
+context_estimated_counts on /metrics.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+
+from omni.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_SUMMARY = os.getenv("CONTEXT_SUMMARY", "0") == "1"
+# the summarized head only moves in steps this big, so its summary can be reused for a while
+SUMMARY_STEP_CHARS = int(os.getenv("CONTEXT_SUMMARY_STEP_CHARS", "4000"))
+TOKENIZER_MODEL = os.getenv("TOKENIZER_MODEL", "gpt-4o-mini")
+
+TOKENIZER_REQUIRED = os.getenv("TOKENIZER_REQUIRED", "1") == "1"
+
+_encoding = None
+_encoding_loaded = False
+_encoding_error = None
+
+def get_encoding():
+    """
+    Get the tiktoken encoding for the model, or None if it isn't available.
+    Loading it reads (or the first time, downloads) a few MB, so outside of startup call load_encoding.
+    """
+    global _encoding, _encoding_loaded, _encoding_error
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            if not os.getenv("TIKTOKEN_CACHE_DIR"):
+                # tiktoken would download the file into a temp directory, on every new host
+                raise RuntimeError("TIKTOKEN_CACHE_DIR is not set")
+            import tiktoken
+            try:
+                _encoding = tiktoken.encoding_for_model(TOKENIZER_MODEL)
+            except KeyError:
+                _encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            _encoding_error = e
+            _encoding = None
+            logger.error("tiktoken unavailable, token counts will be estimated: %s", e)
+        context_stats["tokenizer_loaded"] = int(_encoding is not None)
+    return _encoding
+
+async def load_encoding():
+    """
+    Load the encoding off the event loop. Raises RuntimeError if it can't be loaded and
+    TOKENIZER_REQUIRED is on.
+    """
+    encoding = await asyncio.to_thread(get_encoding)
+    if encoding is None and TOKENIZER_REQUIRED:
+        raise RuntimeError(f"the {TOKENIZER_MODEL} tokenizer could not be loaded ({_encoding_error}); "
+                           "set TIKTOKEN_CACHE_DIR to a directory with its encoding file, "
+                           "or TOKENIZER_REQUIRED=0 to estimate token counts")
+    return encoding
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+    if encoding is None:
+        context_stats["estimated_counts"] += 1
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def tail_start(text: str, budget: int) -> int:
+    """
+    Character offset where the last `budget` tokens of text begin.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        context_stats["estimated_counts"] += 1
+        return max(0, len(text) - budget * 4)
+
+    # tokens are rarely longer than 8 characters, so there's no need to encode the whole document
+    window_start = max(0, len(text) - budget * 8)
+    tokens = encoding.encode(text[window_start:], disallowed_special=())
+    if len(tokens) <= budget:
+        return window_start
+    kept = encoding.decode(tokens[-budget:])
+    return len(text) - len(kept)
+
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s+")
+
+def snap_to_boundary(text: str, start: int) -> int:
+    """
+    Move start forward to the next paragraph break, or failing that the next sentence end,
+    as long as that doesn't throw away more than half of the tail.
+    """
+    limit = start + (len(text) - start) // 2
+
+    paragraph = text.find("\n\n", start, limit)
+    if paragraph != -1:
+        return paragraph + 2
+
+    sentence = SENTENCE_END.search(text, start, limit)
+    if sentence:
+        return sentence.end()
+
+    line = text.find("\n", start, limit)
+    if line != -1:
+        return line + 1
+
+    return start
+
+summary_cache = TTLCache(
+    maxsize=int(os.getenv("CONTEXT_SUMMARY_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("CONTEXT_SUMMARY_CACHE_TTL", "86400"))
+)
+_pending_summaries = {}
+
+context_stats = {
+    "requests": 0,
+    "truncated": 0,
+    "summarized": 0,
+    "input_tokens": 0,
+    "last_input_tokens": 0,
+    # 0 while token counts are estimated (see the top of this file)
+    "tokenizer_loaded": 0,
+    "estimated_counts": 0,
+}
+
+def request_summary(head: str, summarize) -> str:
+    """
+    Get the cached summary of head, or start making one in the background and return None.
+    """
+    key = hashlib.sha256(head.encode()).hexdigest()
+    summary = summary_cache.get(key)
+    if summary is not None or summarize is None:
+        return summary
+
+    if key not in _pending_summaries:
+        async def run():
+            try:
+                summary_cache.set(key, await summarize(head))
+            except Exception as e:
+                logger.warning("summarizing failed: %s", e)
+            finally:
+                _pending_summaries.pop(key, None)
+        _pending_summaries[key] = asyncio.create_task(run())
+    return None
+
+def build_context(content: str, budget: int = None, summarize=None) -> dict:
+    """
+    Pick what to send the model for content.
+    Returns {"text": tail to send, "summary": summary of the rest or None, "tokens": input token estimate}.
+    summarize is an async function (text -> summary) used when CONTEXT_SUMMARY is on.
+    """
+    budget = budget or CONTEXT_TOKEN_BUDGET
+    context_stats["requests"] += 1
+
+    start = tail_start(content, budget)
+    summary = None
+    if start > 0:
+        context_stats["truncated"] += 1
+        start = snap_to_boundary(content, start)
+
+        if CONTEXT_SUMMARY and summarize is not None:
+            # summarize up to a coarse boundary and send everything after it,
+            # so nothing falls in the gap between the summary and the tail
+            boundary = (start // SUMMARY_STEP_CHARS) * SUMMARY_STEP_CHARS
+            if boundary > 0:
+                summary = request_summary(content[:boundary], summarize)
+                if summary is not None:
+                    context_stats["summarized"] += 1
+                    # back up to the start of the word the boundary landed in
+                    start = boundary
+                    while start > 0 and not content[start - 1].isspace():
+                        start -= 1
+
+    text = content[start:]
+    tokens = count_tokens(text) + (count_tokens(summary) if summary else 0)
+    context_stats["input_tokens"] += tokens
+    context_stats["last_input_tokens"] = tokens
+    return {"text": text, "summary": summary, "tokens": tokens}
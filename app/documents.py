@@ -0,0 +1,153 @@
+"""
+Delta sync for item content.
+
+Instead of uploading the whole document on every debounce tick, the editor can send a patch:
+the version it last saw plus a list of edits. We keep the current text of recently edited items
+in memory, apply the edits to it, and reject the patch with a 409 if the client was editing an
+old version (it should then re-fetch the item and resend the full content).
+
+A version is a short hash of the content, so the client can compute it too.
+
+With several workers (gunicorn.conf.py) a patch can land on a different worker than the save before it,
+so with REDIS_URL (or DOCUMENT_REDIS_URL) set the documents live in redis only, and changing one takes a
+per-item redis lock. The content writers of the workers check, under the same lock, that what they are
+about to save is still the newest version of the item, so an older save queued on one worker can't
+overwrite a newer one saved by another.
+
+Edits are applied in order, each against the result of the previous one:
+    {"pos": 10, "delete": 3, "insert": "abc"}
+removes 3 characters at position 10 and inserts "abc" there.
+"""
+
+from contextlib import nullcontext
+from fastapi import HTTPException
+import hashlib
+import logging
+import os
+
+from omni.cache import TTLCache, RedisCache, TieredCache, get_redis, shared_url
+from omni.helpers import get_item, set_item_content
+from omni.writebehind import content_writer
+
+logger = logging.getLogger(__name__)
+
+DOCUMENT_CACHE_TTL = float(os.getenv("DOCUMENT_CACHE_TTL", "1800"))
+DOCUMENT_REDIS_URL = shared_url("DOCUMENT_REDIS_URL")
+# how long a worker may hold an item's lock (a content write), and wait for it
+DOCUMENT_LOCK_SECONDS = 30
+
+document_cache = TieredCache(
+    TTLCache(
+        maxsize=int(os.getenv("DOCUMENT_CACHE_SIZE", "5000")),
+        ttl=DOCUMENT_CACHE_TTL,
+        max_bytes=int(os.getenv("DOCUMENT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+    ),
+    RedisCache(DOCUMENT_REDIS_URL, "document", ttl=DOCUMENT_CACHE_TTL) if DOCUMENT_REDIS_URL else None,
+    # any worker may change a document, so a local copy could be stale the moment we make it
+    local_ttl=0,
+)
+
+def content_version(content: str) -> str:
+    return hashlib.sha256((content or "").encode()).hexdigest()[:16]
+
+def document_lock(user_id: str, item_id: str):
+    """
+    Held while changing a document. Only needed (and only taken) when the documents are shared.
+    """
+    if document_cache.shared is None:
+        # everything runs on this worker's event loop, where the code below doesn't await in between
+        return nullcontext()
+    return get_redis(DOCUMENT_REDIS_URL).lock(f"document-lock:{user_id}:{item_id}",
+                                              timeout=DOCUMENT_LOCK_SECONDS, blocking_timeout=DOCUMENT_LOCK_SECONDS)
+
+async def remember_document(user_id: str, item_id: str, content: str) -> str:
+    """
+    Record the latest content of an item. Returns its version.
+    """
+    version = content_version(content)
+    await document_cache.set((user_id, item_id), {"content": content, "version": version})
+    return version
+
+async def forget_document(user_id: str, item_id: str):
+    await document_cache.delete((user_id, item_id))
+
+async def current_document(user_id: str, item_id: str, stored: str) -> dict:
+    """
+    The newest content and version of an item whose content in the db is stored.
+    A document we remember, or content still waiting to be saved, is newer than the db's.
+    """
+    document = await document_cache.get((user_id, item_id))
+    if document is not None:
+        return document
+
+    content = content_writer.pending_content(user_id, item_id)
+    if content is None:
+        content = stored or ""
+    version = await remember_document(user_id, item_id, content)
+    return {"content": content, "version": version}
+
+async def load_document(user_id: str, item_id: str) -> dict:
+    """
+    Current content and version of an item, from memory if we have it.
+    """
+    document = await document_cache.get((user_id, item_id))
+    if document is not None:
+        return document
+
+    item = await get_item(user_id, item_id, include_meta=False, include_content=True)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+
+    # someone may have patched the item while we were loading it, theirs is newer
+    return await current_document(user_id, item_id, item["item_content"])
+
+def apply_ops(content: str, ops: list) -> str:
+    """
+    Apply a list of edits to content. Raises HTTPException(422) for edits that don't fit.
+    """
+    for op in ops:
+        pos = op.get("pos", 0)
+        delete = op.get("delete", 0)
+        insert = op.get("insert", "")
+        if not isinstance(pos, int) or not isinstance(delete, int) or not isinstance(insert, str):
+            raise HTTPException(status_code=422, detail="Invalid patch operation")
+        if pos < 0 or delete < 0 or pos + delete > len(content):
+            raise HTTPException(status_code=422, detail="Patch operation out of range")
+        content = content[:pos] + insert + content[pos + delete:]
+    return content
+
+async def patch_document(user_id: str, item_id: str, base_version: str, ops: list, check=None) -> dict:
+    """
+    Apply a patch made against base_version. Returns the new {"content", "version"}.
+    Raises HTTPException(409) if base_version isn't the current version.
+    check(content) is called with the patched content before it replaces the current version,
+    and can reject the patch by raising (the document is then left as it was).
+    """
+    async with document_lock(user_id, item_id):
+        document = await load_document(user_id, item_id)
+        if document["version"] != base_version:
+            raise HTTPException(status_code=409, detail={
+                "message": "Content has changed, resend the full content",
+                "version": document["version"]
+            })
+
+        content = apply_ops(document["content"], ops)
+        if check is not None:
+            check(content)
+        version = await remember_document(user_id, item_id, content)
+    return {"content": content, "version": version}
+
+async def save_if_newest(user_id: str, item_id: str, content: str):
+    """
+    The content writer's write when the documents are shared: skips content that another worker
+    has already replaced (that worker saves the newer content itself).
+    """
+    async with document_lock(user_id, item_id):
+        document = await document_cache.get((user_id, item_id))
+        if document is not None and document["version"] != content_version(content):
+            logger.debug("not saving %s, a newer version was saved elsewhere", item_id)
+            return
+        await set_item_content(user_id, item_id, content)
+
+if document_cache.shared is not None:
+    content_writer.write = save_if_newest
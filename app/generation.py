@@ -0,0 +1,191 @@
+"""
+How much we let the model generate for a prediction.
+
+Predictions are meant to finish the current sentence and maybe one or two more, and generation
+time grows with every output token, so instead of a flat max_tokens:
+- the output budget depends on where the user is (mid word, mid sentence, starting a new
+  sentence or a new paragraph), see generation_policy
+- a new paragraph (an escaped "\\n\\n" inside the JSON answer) is a stop sequence
+- streamed predictions stop at a sentence boundary once we have GEN_MAX_SENTENCES sentences,
+  or as soon as the model wasn't confident about the sentence it just finished
+  (geometric mean token probability below GEN_EARLY_STOP_CONFIDENCE, from logprobs)
+
+Every model call records its output tokens and why it stopped in output_stats.
+"""
+
+from collections import deque
+import math
+import os
+
+from omni.metrics import LLM_OUTPUT_TOKENS
+
+# output token budgets per prompt state, including ~10 tokens for the JSON around the prediction
+OUTPUT_BUDGETS = {
+    "word": int(os.getenv("GEN_BUDGET_WORD", "70")),
+    "sentence": int(os.getenv("GEN_BUDGET_SENTENCE", "80")),
+    "new_sentence": int(os.getenv("GEN_BUDGET_NEW_SENTENCE", "100")),
+    "paragraph": int(os.getenv("GEN_BUDGET_PARAGRAPH", "110")),
+}
+MAX_SENTENCES = int(os.getenv("GEN_MAX_SENTENCES", "3"))
+EARLY_STOP_CONFIDENCE = float(os.getenv("GEN_EARLY_STOP_CONFIDENCE", "0.4"))
+TEMPERATURE = float(os.getenv("GEN_TEMPERATURE", "1"))
+# ask for logprobs on streamed predictions, for the confidence based early stop
+LOGPROBS = os.getenv("GEN_LOGPROBS", "1") == "1"
+# the model answers in JSON, so a blank line in the prediction shows up as these characters
+STOP_SEQUENCES = ["\\n\\n"]
+
+SENTENCE_END = ".!?"
+CLOSING = "\"')]”’"
+ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "vs", "etc", "e.g", "i.e", "jr", "sr", "no"}
+
+def prompt_state(prompt: str) -> str:
+    """
+    Where the user is: "word" (mid word), "sentence" (mid sentence),
+    "new_sentence" (just finished one) or "paragraph" (at the start of a line).
+    """
+    if not prompt.strip() or prompt[-1] == "\n":
+        return "paragraph"
+    stripped = prompt.rstrip().rstrip(CLOSING)
+    if stripped and stripped[-1] in SENTENCE_END:
+        return "new_sentence"
+    if prompt[-1].isalnum() or prompt[-1] == "'":
+        return "word"
+    return "sentence"
+
+def generation_policy(prompt: str, max_tokens: int = None) -> dict:
+    """
+    Generation settings for a prompt. max_tokens, if given, caps the budget.
+    """
+    state = prompt_state(prompt)
+    budget = OUTPUT_BUDGETS[state]
+    if max_tokens:
+        budget = min(budget, max_tokens)
+    return {
+        "state": state,
+        "max_tokens": budget,
+        "max_sentences": MAX_SENTENCES,
+        "min_confidence": EARLY_STOP_CONFIDENCE,
+        "stop": STOP_SEQUENCES,
+        "temperature": TEMPERATURE,
+        "logprobs": LOGPROBS,
+    }
+
+def stop_reason(finish_reason: str, parser, gate) -> str:
+    """
+    Why a prediction ended, for output_stats.
+    """
+    if gate.done:
+        return "early" if gate.early else "sentences"
+    if parser.done:
+        return "complete"
+    if finish_reason == "length":
+        return "length"
+    if finish_reason == "stop":
+        return "stop_sequence"
+    return "aborted"
+
+class SentenceGate:
+    """
+    Decides how much of a streamed prediction to pass on.
+    Feed it decoded prediction text (and the logprobs of the tokens it came from, if we have them);
+    it returns the text to emit, and sets done once we should stop at a sentence boundary.
+    """
+    def __init__(self, max_sentences: int = MAX_SENTENCES, min_confidence: float = EARLY_STOP_CONFIDENCE):
+        self.max_sentences = max_sentences
+        self.min_confidence = min_confidence
+        self.text = ""
+        self.emitted = 0
+        self.scanned = 0
+        self.sentences = 0
+        self.logprob_sum = 0.0
+        self.tokens = 0
+        self.done = False
+        self.early = False
+
+    def confidence(self) -> float:
+        """
+        Geometric mean token probability of the sentence in progress (1.0 without logprobs).
+        """
+        if not self.tokens:
+            return 1.0
+        return math.exp(self.logprob_sum / self.tokens)
+
+    def boundary(self, i: int) -> bool:
+        """
+        Whether the sentence ends at text[i]. Needs the next character, so never true for the last one.
+        """
+        text = self.text
+        if i + 1 >= len(text):
+            return False
+        if text[i] in SENTENCE_END:
+            nxt = text[i + 1]
+            if nxt in SENTENCE_END or nxt in CLOSING:
+                return False
+            if not nxt.isspace():
+                return False
+            word = text[:i].rsplit(None, 1)[-1].lower() if text[:i].strip() else ""
+            return word.strip(CLOSING) not in ABBREVIATIONS
+        if text[i] in CLOSING and text[i - 1:i] and text[i - 1] in SENTENCE_END + CLOSING:
+            # a quote or bracket closing a sentence ends there instead
+            return text[i + 1].isspace()
+        return False
+
+    def feed(self, fragment: str, logprobs: list = None) -> str:
+        if self.done:
+            return ""
+        for logprob in logprobs or []:
+            self.logprob_sum += logprob
+            self.tokens += 1
+        self.text += fragment
+
+        end = len(self.text)
+        for i in range(self.scanned, len(self.text)):
+            if not self.boundary(i):
+                continue
+            self.sentences += 1
+            if self.sentences >= self.max_sentences or self.confidence() < self.min_confidence:
+                self.early = self.sentences < self.max_sentences
+                self.done = True
+                end = i + 1
+                break
+            self.logprob_sum = 0.0
+            self.tokens = 0
+        # the last character is checked again once we know what follows it
+        self.scanned = max(self.scanned, len(self.text) - 1)
+
+        out = self.text[self.emitted:end]
+        self.emitted = max(self.emitted, end)
+        return out
+
+output_stats = {
+    "requests": 0,
+    "completion_tokens": 0,
+    "budget_tokens": 0,
+    "stops": {"complete": 0, "early": 0, "sentences": 0, "stop_sequence": 0, "length": 0, "aborted": 0},
+    "by_state": {state: {"requests": 0, "completion_tokens": 0} for state in OUTPUT_BUDGETS},
+}
+recent_output_tokens = deque(maxlen=1000)
+
+def record_output(policy: dict, tokens: int, reason: str):
+    """
+    Record one model call: how many output tokens it used and why it stopped.
+    """
+    output_stats["requests"] += 1
+    output_stats["completion_tokens"] += tokens
+    output_stats["budget_tokens"] += policy["max_tokens"]
+    output_stats["stops"][reason] = output_stats["stops"].get(reason, 0) + 1
+    state = output_stats["by_state"][policy["state"]]
+    state["requests"] += 1
+    state["completion_tokens"] += tokens
+    recent_output_tokens.append(tokens)
+    LLM_OUTPUT_TOKENS.labels(policy["state"], reason).observe(tokens)
+
+def generation_stats() -> dict:
+    stats = dict(output_stats)
+    ordered = sorted(recent_output_tokens)
+    if ordered:
+        stats["p50_completion_tokens"] = ordered[len(ordered) // 2]
+        stats["p95_completion_tokens"] = ordered[max(0, int(len(ordered) * 0.95) - 1)]
+    if output_stats["budget_tokens"]:
+        stats["budget_used"] = output_stats["completion_tokens"] / output_stats["budget_tokens"]
+    return stats
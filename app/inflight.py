@@ -0,0 +1,75 @@
+"""
+Tracks suggestion requests that are in flight, per (user_id, item_id).
+
+While someone types, the editor sends overlapping suggest requests for the same item,
+and only the newest one will ever be shown. So:
+- a new request for an item supersedes the older ones, which return straight away,
+  and their model call is cancelled if nobody else is waiting on it
+- identical concurrent requests (same cache key) share a single model call
+"""
+
+import asyncio
+
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+class InflightRegistry:
+    def __init__(self):
+        self.flights = {}  # request key -> Flight
+        self.latest = {}   # owner key -> future that resolves when that request is superseded
+        self.stats = {"upstream": 0, "deduplicated": 0, "superseded": 0, "cancelled": 0}
+
+    def claim(self, owner):
+        """
+        Mark a new request as the latest for owner, superseding the previous one.
+        Returns a future that resolves if this request is superseded in turn.
+        """
+        superseded = asyncio.get_running_loop().create_future()
+        previous = self.latest.get(owner)
+        if previous is not None and not previous.done():
+            previous.set_result(True)
+            self.stats["superseded"] += 1
+        self.latest[owner] = superseded
+        return superseded
+
+    def release(self, owner, superseded):
+        if self.latest.get(owner) is superseded:
+            del self.latest[owner]
+
+    def forget(self, request_key, flight):
+        if self.flights.get(request_key) is flight:
+            del self.flights[request_key]
+
+    async def run(self, owner, request_key, factory):
+        """
+        Run factory() (an async function) for owner, sharing the call with identical requests.
+        Returns its result, or None if a newer request for the same owner came in first.
+        """
+        flight = self.flights.get(request_key)
+        if flight is None:
+            flight = Flight(asyncio.create_task(factory()))
+            self.flights[request_key] = flight
+            flight.task.add_done_callback(lambda _: self.forget(request_key, flight))
+            self.stats["upstream"] += 1
+        else:
+            self.stats["deduplicated"] += 1
+
+        flight.waiters += 1
+        superseded = self.claim(owner)
+        try:
+            await asyncio.wait([flight.task, superseded], return_when=asyncio.FIRST_COMPLETED)
+            if not flight.task.done() or flight.task.cancelled():
+                return None
+            return flight.task.result()
+        finally:
+            self.release(owner, superseded)
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                # nobody wants this answer any more, stop paying for it
+                flight.task.cancel()
+                self.forget(request_key, flight)
+                self.stats["cancelled"] += 1
+
+suggestion_flights = InflightRegistry()
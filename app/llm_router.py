@@ -0,0 +1,287 @@
+"""
+Routes model calls over a pool of deployments.
+
+Deployments come from LLM_DEPLOYMENTS (a JSON list, or LLM_DEPLOYMENTS_FILE pointing at one):
+    [
+        {"name": "east", "endpoint": "https://east.openai.azure.com", "api_key_env": "AZURE_OPENAI_KEY_EAST",
+         "model": "gpt-4o-mini"},
+        {"name": "west", "endpoint": "https://west.openai.azure.com", "api_key_env": "AZURE_OPENAI_KEY_WEST",
+         "model": "gpt-4o-mini"},
+        {"name": "cheap", "endpoint": "https://east.openai.azure.com", "api_key_env": "AZURE_OPENAI_KEY_EAST",
+         "model": "gpt-4.1-nano", "tier": "fallback"}
+    ]
+"kind" is "azure" (default) or "openai" for anything speaking the plain OpenAI API,
+which is how we point the router at local stub servers. "api_key" can be given inline instead of "api_key_env".
+Without LLM_DEPLOYMENTS we use the single AZURE_OPENAI_ENDPOINT / AZURE_OPENAI_KEY deployment as before.
+
+For every call the router:
+- picks the healthy primary deployment with the lowest recent latency (untried ones first)
+- if it hasn't answered within its p95 latency, sends the same request to the next best
+  deployment too (a hedge) and takes whichever answers first
+- on timeouts, connection errors, 429s and 5xx moves on to the next deployment; 429s put a deployment
+  in a cooldown for Retry-After. Other errors (400, 401, 404, content filter) are about the request,
+  not the deployment: they are raised straight away and don't count against it
+- uses the "fallback" tier (a cheaper model) once no primary is healthy,
+  or all of them have LLM_MAX_IN_FLIGHT requests running
+"""
+
+from collections import deque
+import asyncio
+import json
+import os
+import time
+
+import openai
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from omni.transport import get_http_client
+
+API_VERSION = "2024-10-21"
+WINDOW = 100               # calls kept per deployment for latency/error stats
+MIN_SAMPLES = 20           # calls before we trust a deployment's p95
+HEDGE_MIN_SECONDS = float(os.getenv("LLM_HEDGE_MIN_SECONDS", "0.3"))
+HEDGE_MAX_SECONDS = float(os.getenv("LLM_HEDGE_MAX_SECONDS", "5"))
+MAX_ERROR_RATE = 0.5
+ERROR_COOLDOWN_SECONDS = 5
+RATE_LIMIT_COOLDOWN_SECONDS = 10
+# a primary with this many requests in flight counts as under pressure, and the fallback tier goes first
+MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "100"))
+
+class Deployment:
+    def __init__(self, name: str, model: str, endpoint: str, api_key: str, kind: str = "azure",
+                 api_version: str = API_VERSION, tier: str = "primary"):
+        self.name = name
+        self.model = model
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.kind = kind
+        self.api_version = api_version
+        self.tier = tier
+        self._client = None
+
+        self.latencies = deque(maxlen=WINDOW)
+        self.errors = deque(maxlen=WINDOW)
+        self.ewma = None
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.calls = 0
+        self.hedges = 0
+        # attempts cancelled before they finished (lost a hedge race, or the caller went away)
+        self.cancelled = 0
+        self.rate_limited = 0
+
+    def client(self):
+        if self._client is None:
+            if self.kind == "openai":
+                self._client = AsyncOpenAI(base_url=self.endpoint, api_key=self.api_key,
+                                           http_client=get_http_client("openai"))
+            else:
+                self._client = AsyncAzureOpenAI(api_key=self.api_key, api_version=self.api_version,
+                                                azure_endpoint=self.endpoint,
+                                                http_client=get_http_client("openai"))
+        return self._client
+
+    def error_rate(self) -> float:
+        return sum(self.errors) / len(self.errors) if self.errors else 0.0
+
+    def p95(self):
+        if len(self.latencies) < MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def healthy(self) -> bool:
+        if time.monotonic() < self.cooldown_until:
+            return False
+        return len(self.errors) < MIN_SAMPLES or self.error_rate() < MAX_ERROR_RATE
+
+    def score(self) -> float:
+        # untried deployments go first so every deployment gets measured
+        return (self.ewma or 0.0) * (1 + self.in_flight * 0.1)
+
+    def record_latency(self, latency: float):
+        self.latencies.append(latency)
+        self.ewma = latency if self.ewma is None else 0.8 * self.ewma + 0.2 * latency
+
+    def record_success(self, latency: float):
+        self.record_latency(latency)
+        self.errors.append(0)
+
+    def record_error(self, error: Exception):
+        self.errors.append(1)
+        if isinstance(error, openai.RateLimitError):
+            self.rate_limited += 1
+            retry_after = None
+            try:
+                retry_after = float(error.response.headers.get("retry-after"))
+            except (TypeError, ValueError, AttributeError):
+                pass
+            self.cooldown_until = time.monotonic() + (retry_after or RATE_LIMIT_COOLDOWN_SECONDS)
+        elif not self.healthy():
+            self.cooldown_until = time.monotonic() + ERROR_COOLDOWN_SECONDS
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "tier": self.tier,
+            "healthy": self.healthy(),
+            "calls": self.calls,
+            "in_flight": self.in_flight,
+            "ewma_latency": self.ewma,
+            "p95_latency": self.p95(),
+            "error_rate": self.error_rate(),
+            "hedges": self.hedges,
+            "cancelled": self.cancelled,
+            "rate_limited": self.rate_limited,
+        }
+
+def load_deployments() -> list:
+    raw = os.getenv("LLM_DEPLOYMENTS")
+    if not raw and os.getenv("LLM_DEPLOYMENTS_FILE"):
+        with open(os.getenv("LLM_DEPLOYMENTS_FILE")) as f:
+            raw = f.read()
+
+    if not raw:
+        return [Deployment(
+            name="default",
+            model=os.getenv("AZURE_OPENAI_MODEL", "gpt-4o-mini"),
+            endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            api_key=os.getenv("AZURE_OPENAI_KEY"),
+        )]
+
+    deployments = []
+    for config in json.loads(raw):
+        deployments.append(Deployment(
+            name=config["name"],
+            model=config["model"],
+            endpoint=config["endpoint"],
+            api_key=config.get("api_key") or os.getenv(config.get("api_key_env", "AZURE_OPENAI_KEY")),
+            kind=config.get("kind", "azure"),
+            api_version=config.get("api_version", API_VERSION),
+            tier=config.get("tier", "primary"),
+        ))
+    return deployments
+
+class NoDeploymentAvailable(Exception):
+    pass
+
+def deployment_fault(error: Exception) -> bool:
+    """
+    Whether an error says something about the deployment (so another one might do better).
+    """
+    if isinstance(error, (openai.APIConnectionError, asyncio.TimeoutError)):
+        # APITimeoutError is a connection error too
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+class LLMRouter:
+    def __init__(self, deployments: list):
+        self.deployments = deployments
+
+    def candidates(self) -> list:
+        """
+        Deployments to try, best first: healthy primaries by score, then healthy fallbacks,
+        then anything in a cooldown (better a slow answer than none).
+        """
+        healthy = [d for d in self.deployments if d.healthy()]
+        primaries = sorted([d for d in healthy if d.tier == "primary"], key=lambda d: d.score())
+        fallbacks = sorted([d for d in healthy if d.tier != "primary"], key=lambda d: d.score())
+        rest = sorted([d for d in self.deployments if not d.healthy()], key=lambda d: d.cooldown_until)
+
+        relaxed = [d for d in primaries if d.in_flight < MAX_IN_FLIGHT]
+        pressured = [d for d in primaries if d.in_flight >= MAX_IN_FLIGHT]
+        return relaxed + fallbacks + pressured + rest
+
+    async def attempt(self, deployment: Deployment, call):
+        deployment.calls += 1
+        deployment.in_flight += 1
+        started = time.monotonic()
+        try:
+            result = await call(deployment)
+        except asyncio.CancelledError:
+            # lost a hedge race: we don't know how long it would have taken, and the time so far would
+            # pull its p95 (which sets the hedge delay) down, so it isn't a latency sample
+            deployment.cancelled += 1
+            raise
+        except Exception as e:
+            if deployment_fault(e):
+                deployment.record_error(e)
+            raise
+        finally:
+            deployment.in_flight -= 1
+        deployment.record_success(time.monotonic() - started)
+        return result
+
+    def hedge_delay(self, deployment: Deployment):
+        p95 = deployment.p95()
+        if p95 is None:
+            return HEDGE_MAX_SECONDS
+        return min(HEDGE_MAX_SECONDS, max(HEDGE_MIN_SECONDS, p95))
+
+    async def complete(self, call, hedge: bool = True):
+        """
+        Run call(deployment) (an async function making one model request) on the best deployment.
+        Hedges onto the next deployment when the first is slower than its p95,
+        and works down the list on errors that are the deployment's fault.
+        """
+        queue = self.candidates()
+        if not queue:
+            raise NoDeploymentAvailable("No LLM deployments configured")
+
+        running = {}
+        last_error = None
+        try:
+            while queue or running:
+                if not running:
+                    deployment = queue.pop(0)
+                    running[asyncio.create_task(self.attempt(deployment, call))] = deployment
+
+                timeout = None
+                if hedge and queue and len(running) == 1:
+                    timeout = self.hedge_delay(next(iter(running.values())))
+
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # slow, send the same request to the next deployment as well
+                    deployment = queue.pop(0)
+                    deployment.hedges += 1
+                    running[asyncio.create_task(self.attempt(deployment, call))] = deployment
+                    continue
+
+                for task in done:
+                    running.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                    if not deployment_fault(last_error):
+                        # the next deployment would say the same
+                        raise last_error
+        finally:
+            for task in running:
+                task.cancel()
+
+        raise last_error
+
+    async def open_stream(self, call):
+        """
+        Open a streaming request on the best deployment, moving on to the next one if opening fails.
+        Latency recorded is the time to open the stream. No hedging, streams are already fast to start.
+        """
+        last_error = None
+        for deployment in self.candidates():
+            try:
+                return await self.attempt(deployment, call)
+            except Exception as e:
+                if not deployment_fault(e):
+                    raise
+                last_error = e
+        raise last_error or NoDeploymentAvailable("No LLM deployments configured")
+
+    def stats(self) -> list:
+        return [d.stats() for d in self.deployments]
+
+router = LLMRouter(load_deployments())
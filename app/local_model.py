@@ -0,0 +1,211 @@
+"""
+A small local autocomplete model, built from the user's own writing.
+
+It is a word n-gram model (up to trigrams) over everything in the user's items. It answers
+the cheap cases - finishing a half typed word, or the next word or two of a phrase the user
+writes a lot - in well under a millisecond, with a confidence so the caller can escalate to
+the remote model when it isn't sure.
+
+Building a model means reading and counting the whole corpus, so that happens in a process pool
+(and in the background - until a user's model is ready we just return None). Predicting is a
+few dict lookups, so that runs inline; shipping the model to another process per call would cost
+more than the prediction itself.
+"""
+
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import asyncio
+import bisect
+import logging
+import os
+import re
+
+from omni.cache import TTLCache
+from omni.helpers import iter_items
+
+logger = logging.getLogger(__name__)
+
+LOCAL_MODEL_WORKERS = int(os.getenv("LOCAL_MODEL_WORKERS", "2"))
+LOCAL_MODEL_TTL = float(os.getenv("LOCAL_MODEL_TTL", "1800"))
+LOCAL_MODEL_MAX_CHARS = int(os.getenv("LOCAL_MODEL_MAX_CHARS", str(2_000_000)))
+MAX_PHRASE_WORDS = 3
+MAX_PREFIX_CANDIDATES = 500
+
+TOKEN = re.compile(r"[A-Za-z0-9']+|[.,!?;:]")
+SENTENCE_END = {".", "!", "?"}
+
+class NGramModel:
+    def __init__(self):
+        self.unigrams = Counter()
+        self.bigrams = defaultdict(Counter)
+        self.trigrams = defaultdict(Counter)
+        self.vocab = []  # sorted, for prefix lookups
+
+    def add(self, text: str):
+        tokens = TOKEN.findall(text)
+        self.unigrams.update(t for t in tokens if t not in SENTENCE_END)
+        for a, b in zip(tokens, tokens[1:]):
+            self.bigrams[a][b] += 1
+        for a, b, c in zip(tokens, tokens[1:], tokens[2:]):
+            self.trigrams[(a, b)][c] += 1
+
+    def finish(self):
+        self.vocab = sorted(self.unigrams)
+        # plain dicts pickle smaller and faster than defaultdicts of lambdas
+        self.bigrams = dict(self.bigrams)
+        self.trigrams = dict(self.trigrams)
+        return self
+
+    def next_counts(self, context: list):
+        """
+        Counts for the word after context, from the longest n-gram we have evidence for.
+        """
+        if len(context) >= 2 and tuple(context[-2:]) in self.trigrams:
+            return self.trigrams[tuple(context[-2:])]
+        if context and context[-1] in self.bigrams:
+            return self.bigrams[context[-1]]
+        return None
+
+    def with_prefix(self, prefix: str) -> list:
+        start = bisect.bisect_left(self.vocab, prefix)
+        words = []
+        for word in self.vocab[start:start + MAX_PREFIX_CANDIDATES]:
+            if not word.startswith(prefix):
+                break
+            if len(word) > len(prefix):
+                words.append(word)
+        return words
+
+    def best(self, counts: dict, allowed=None):
+        """
+        (word, confidence, evidence) for the most likely word in counts.
+        """
+        if allowed is not None:
+            counts = {w: counts.get(w, 0) for w in allowed}
+            counts = {w: c for w, c in counts.items() if c}
+        total = sum(counts.values())
+        if not total:
+            return None, 0.0, 0
+        word, count = max(counts.items(), key=lambda wc: wc[1])
+        return word, count / total, total
+
+    def predict(self, text: str, min_confidence: float, min_evidence: int):
+        """
+        Complete the current word and/or the next few words of text.
+        Returns {"prediction", "confidence"} or None if we aren't sure enough.
+        """
+        tail = text[-300:]
+        tokens = TOKEN.findall(tail)
+        if not tokens:
+            return None
+
+        words = []
+        confidence = 1.0
+        if tail[-1].isalnum() or tail[-1] == "'":
+            # finishing a half typed word
+            partial = tokens[-1]
+            context = tokens[:-1]
+            candidates = self.with_prefix(partial)
+            if not candidates:
+                return None
+            counts = self.next_counts(context)
+            word, conf, evidence = self.best(counts, candidates) if counts else (None, 0.0, 0)
+            if word is None:
+                word, conf, evidence = self.best(self.unigrams, candidates)
+            if word is None or conf < min_confidence or evidence < min_evidence:
+                return None
+            prediction = word[len(partial):]
+            context = context + [word]
+            confidence = conf
+            separator = " "
+        elif tail[-1].isspace():
+            if tokens[-1] in SENTENCE_END:
+                # a new sentence is the remote model's job
+                return None
+            prediction = ""
+            context = tokens
+            separator = ""
+        else:
+            return None
+
+        # carry on with the next words while we're confident
+        while len(words) < MAX_PHRASE_WORDS:
+            counts = self.next_counts(context)
+            if not counts:
+                break
+            word, conf, evidence = self.best(counts)
+            if word is None or word in SENTENCE_END or evidence < min_evidence or confidence * conf < min_confidence:
+                break
+            confidence *= conf
+            words.append(word)
+            context = context + [word]
+
+        if words:
+            prediction += separator + " ".join(words)
+        if not prediction:
+            return None
+        return {"prediction": prediction, "confidence": confidence}
+
+def build_model(texts: list) -> NGramModel:
+    """
+    Build a model from a list of texts. Runs in the process pool.
+    """
+    model = NGramModel()
+    for text in texts:
+        model.add(text)
+    return model.finish()
+
+class LocalModels:
+    """
+    One model per (user_id, product_name), built in the background and rebuilt after LOCAL_MODEL_TTL.
+    """
+    def __init__(self):
+        self.models = TTLCache(maxsize=int(os.getenv("LOCAL_MODEL_CACHE_SIZE", "1000")), ttl=LOCAL_MODEL_TTL)
+        self.building = {}
+        self.pool = None
+        self.stats = {"builds": 0, "build_errors": 0}
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=LOCAL_MODEL_WORKERS)
+        return self.pool
+
+    async def build(self, user_id: str, product_name: str):
+        key = (user_id, product_name)
+        try:
+            texts = []
+            size = 0
+            async for item in iter_items(user_id, product_name, include_content=True):
+                content = item.get("item_content") or ""
+                texts.append(content)
+                size += len(content)
+                if size > LOCAL_MODEL_MAX_CHARS:
+                    break
+            loop = asyncio.get_running_loop()
+            model = await loop.run_in_executor(self.get_pool(), build_model, texts)
+            self.models.set(key, model)
+            self.stats["builds"] += 1
+        except Exception as e:
+            logger.warning("building the local model for %s failed: %s", user_id, e)
+            self.stats["build_errors"] += 1
+        finally:
+            self.building.pop(key, None)
+
+    def get(self, user_id: str, product_name: str):
+        """
+        The user's model, or None if it isn't built yet (in which case a build is started).
+        """
+        key = (user_id, product_name)
+        model = self.models.get(key)
+        if model is None and key not in self.building:
+            self.building[key] = asyncio.create_task(self.build(user_id, product_name))
+        return model
+
+    def shutdown(self):
+        for task in self.building.values():
+            task.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+local_models = LocalModels()
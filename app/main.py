@@ -1,27 +1,90 @@
-from fastapi import FastAPI, Depends, FastAPI, HTTPException
-from fastapi.responses import RedirectResponse
+import time
+# the imports below count towards the startup budget (see lifespan)
+import_started = time.perf_counter()
+
+from fastapi import FastAPI, Depends, FastAPI, HTTPException, Request, Response
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 
-from dotenv import load_dotenv
+from contextlib import asynccontextmanager
+import json
+import logging
 import os
-load_dotenv()
+
+from omni.logs import setup_logging, stop_logging
+logger = logging.getLogger(__name__)
 
 from omni.helpers import (
-    supabase,
     require_auth, RequireProductSubscription,
     create_checkout_session, verify_checkout_session,
     get_settings, set_settings,
     get_items, get_item, create_item, delete_item,
-    set_item_content, set_item_meta,
-    check_user_subscription
+    iter_items, count_items, encode_cursor,
+    set_item_meta,
+    check_user_subscription, handle_stripe_event,
+    auth_stats, token_cache, entitlement_stats, record_cache_stats, broadcast
 )
 
-from .suggest import get_suggestions
+from .suggest import (
+    complete_suggestion, complete_before_stream, stream_suggestions, continue_prediction, remember_prediction, suggestion_cache_key,
+    suggestion_cache_stats, usage_stats, backend_stats
+)
+from .inflight import suggestion_flights
+from .local_model import local_models
+from omni.writebehind import content_writer
+from omni.transport import start_http_clients, close_http_clients, pool_stats
+from omni.cache import close_redis
+from omni.metrics import MetricsMiddleware, register_stats, render_metrics, stage, STAGE_LATENCY
+from .documents import remember_document, forget_document, current_document, patch_document
+from .style import style_profiles
+from .admission import suggest_admission, tier_for
+from .context import context_stats, load_encoding
+from .generation import generation_stats
+from .llm_router import router
+from .search import search_indexes
+from .retrieval import related_passages
+from .bulk import run_batch, import_items, bulk_stats
+
+# a worker that takes longer than this to import and start up gets a warning in the log
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "3"))
+startup_stats = {"import_seconds": time.perf_counter() - import_started, "startup_seconds": 0.0}
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # per worker and not at import: with preload_app the import happens in the gunicorn master,
+    # and the writer thread would not survive the fork
+    setup_logging()
+    await start_http_clients()
+    content_writer.start()
+    broadcast.start()
+    search_indexes.start()
+    related_passages.start()
+    # load the tokenizer now rather than on the first suggestion, and refuse to start without it
+    # (under gunicorn with preload_app the master has already loaded it, see gunicorn.conf.py)
+    await load_encoding()
+    startup_stats["startup_seconds"] = time.perf_counter() - started
+    total = startup_stats["import_seconds"] + startup_stats["startup_seconds"]
+    if total > STARTUP_BUDGET_SECONDS:
+        logger.warning("worker %d took %.2fs to start (imports %.2fs), over the %.1fs budget",
+                       os.getpid(), total, startup_stats["import_seconds"], STARTUP_BUDGET_SECONDS)
+    else:
+        logger.info("worker %d ready in %.2fs", os.getpid(), total)
+    yield
+    await related_passages.stop()
+    await search_indexes.stop()
+    await broadcast.stop()
+    # make sure queued content is saved before we go away
+    await content_writer.stop()
+    local_models.shutdown()
+    await close_http_clients()
+    await close_redis()
+    stop_logging()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "http://localhost:3000",
@@ -34,20 +97,54 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(MetricsMiddleware, routes=app.routes)
+
+# the stats the modules keep, read on every /metrics scrape
+register_stats("auth", lambda: auth_stats)
+# hits and misses of the verified token cache, per tier (local, and shared with redis)
+register_stats("auth_cache", token_cache.stats)
+register_stats("entitlement", lambda: entitlement_stats)
+register_stats("record_cache", record_cache_stats)
+register_stats("broadcast", lambda: broadcast.stats)
+register_stats("suggestion_cache", suggestion_cache_stats)
+register_stats("llm_usage", lambda: usage_stats)
+register_stats("suggest_backend", lambda: backend_stats)
+register_stats("context", lambda: context_stats)
+register_stats("generation", generation_stats)
+register_stats("llm_deployment", router.stats)
+register_stats("suggest_flights", lambda: suggestion_flights.stats)
+register_stats("suggest_admission", suggest_admission.stats)
+register_stats("local_model", lambda: local_models.stats)
+register_stats("style_profile", lambda: style_profiles.stats)
+register_stats("content_writer", lambda: content_writer.stats)
+register_stats("http_pool", lambda: pool_stats)
+register_stats("search", lambda: search_indexes.stats)
+register_stats("retrieval", lambda: related_passages.stats)
+register_stats("bulk", lambda: bulk_stats)
+register_stats("worker", lambda: startup_stats)
 
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics.
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 PRODUCT = "writer"
 
 @app.get("/purchase")
-def purchase(user_id: str, product_name: str = PRODUCT):
+async def purchase(user_id: str, product_name: str = PRODUCT):
     """
     Endpoint to purchase a product.
     """
-    session = create_checkout_session(user_id, product_name, f"{os.getenv("HOST")}/complete-purchase", os.getenv("HOST"))
+    session = await create_checkout_session(user_id, product_name, f"{os.getenv('HOST')}/complete-purchase", os.getenv("HOST"))
 
     url = session.url
     # redirect to the checkout page
@@ -55,16 +152,26 @@ def purchase(user_id: str, product_name: str = PRODUCT):
 
     
 @app.get("/complete-purchase")
-def complete_purchase(user_id: str, session_id: str, product_name: str):
+async def complete_purchase(user_id: str, session_id: str, product_name: str):
     """
     Endpoint to complete the purchase.
     """
-    session = verify_checkout_session(user_id, session_id, product_name)
-    print(session)
+    await verify_checkout_session(user_id, session_id, product_name)
+    logger.info("completed %s purchase for %s", product_name, user_id)
     return RedirectResponse(os.getenv("HOST"), status_code=303)
 
+@app.post("/stripe/webhook")
+async def stripe_webhook(request: Request):
+    """
+    Endpoint for stripe webhook events.
+    Keeps our stored subscription state in sync so the paywall never has to ask stripe.
+    """
+    payload = await request.body()
+    await handle_stripe_event(payload, request.headers.get("stripe-signature"))
+    return {"status": "ok"}
+
 @app.get("/subscription")
-def get_subscription_endpoint(sub = Depends(RequireProductSubscription(PRODUCT))):
+async def get_subscription_endpoint(sub = Depends(RequireProductSubscription(PRODUCT))):
     """
     Endpoint to get subscription for a user.
     """
@@ -72,36 +179,129 @@ def get_subscription_endpoint(sub = Depends(RequireProductSubscription(PRODUCT))
     return subscription
 
 @app.get("/settings")
-def get_settings_endpoint(product_name: str = PRODUCT, user = Depends(require_auth)):
+async def get_settings_endpoint(product_name: str = PRODUCT, user = Depends(require_auth)):
     """
     Endpoint to get settings for a user.
     """
-    settings = get_settings(user.user.id, product_name)
+    settings = await get_settings(user.user.id, product_name)
     return settings
 
 @app.post("/settings")
-def set_settings_endpoint(settings: dict, product_name: str = PRODUCT, user = Depends(require_auth)):
+async def set_settings_endpoint(settings: dict, product_name: str = PRODUCT, user = Depends(require_auth)):
     """
     Endpoint to set settings for a user.
     """
-    set_settings(user.user.id, product_name, settings)
+    await set_settings(user.user.id, product_name, settings)
     return {"status": "ok"}
 
+MAX_PAGE_SIZE = 500
+
 @app.get("/items")
-def get_items_endpoint(
+async def get_items_endpoint(
+    response: Response,
     product_name: str = PRODUCT, 
     item_type: str = None, 
     include_meta: bool = False, 
     include_content: bool = False, 
+    limit: int = None,
+    cursor: str = None,
     user = Depends(require_auth)):
     """
     Endpoint to get items for a user.
+    With a limit, returns one page (newest first) and puts the cursor for the next page
+    in the X-Next-Cursor header (no header on the last page).
     """
-    items = get_items(user.user.id, product_name, item_type, include_meta, include_content)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    items = await get_items(user.user.id, product_name, item_type, include_meta, include_content, limit, cursor)
+    if limit and len(items) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(items[-1])
     return items
 
+@app.get("/items/export")
+async def export_items_endpoint(
+    product_name: str = PRODUCT, 
+    item_type: str = None, 
+    include_meta: bool = True, 
+    include_content: bool = True, 
+    user = Depends(require_auth)):
+    """
+    Endpoint to export all items for a user as NDJSON, one item per line.
+    Items are fetched and sent a page at a time.
+    """
+    async def lines():
+        async for item in iter_items(user.user.id, product_name, item_type, include_meta, include_content):
+            if include_content:
+                pending = content_writer.pending_content(user.user.id, item["item_id"])
+                if pending is not None:
+                    item["item_content"] = pending
+            yield json.dumps(item) + "\n"
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+MAX_SEARCH_RESULTS = 100
+
+@app.get("/search")
+async def search_endpoint(
+    q: str,
+    product_name: str = PRODUCT,
+    item_type: str = None,
+    limit: int = 20,
+    mode: str = None,
+    user = Depends(require_auth)):
+    """
+    Endpoint to search a user's items (see app/search.py).
+    mode is "text", "semantic" or "hybrid", and defaults to hybrid when embeddings are enabled.
+    Returns the best matches first, each with a snippet and the [start, end] of the matched words in it.
+    """
+    if mode not in (None, "text", "semantic", "hybrid"):
+        raise HTTPException(status_code=400, detail="mode must be text, semantic or hybrid")
+    limit = max(1, min(limit, MAX_SEARCH_RESULTS))
+    with stage("search"):
+        return await search_indexes.search(user.user.id, product_name, q, item_type, limit, mode)
+
+MAX_BATCH_OPERATIONS = 500
+
+class BatchOperation(BaseModel):
+    op: str
+    item_id: Optional[str] = None
+    item_type: Optional[str] = None
+    meta: Optional[dict] = None
+    content: Optional[str] = None
+    include_meta: Optional[bool] = False
+    include_content: Optional[bool] = False
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
+
+@app.post("/items/batch")
+async def batch_items_endpoint(
+    body: BatchRequest,
+    product_name: str = PRODUCT,
+    user = Depends(require_auth)):
+    """
+    Endpoint to create, get, update and delete several items in one request (see app/bulk.py).
+    Returns a result with its own status for every operation, in the same order.
+    """
+    if len(body.operations) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    with stage("batch"):
+        return await run_batch(user.user.id, product_name, [operation.model_dump() for operation in body.operations])
+
+@app.post("/items/import")
+async def import_items_endpoint(
+    request: Request,
+    product_name: str = PRODUCT,
+    user = Depends(require_auth)):
+    """
+    Endpoint to create items from an NDJSON body, one item per line (e.g. the output of /items/export).
+    Items are inserted in batches while the body is uploaded. Returns how many were created and
+    the lines that failed.
+    """
+    with stage("import"):
+        return await import_items(user.user.id, product_name, request.stream())
+
 @app.get("/items/{item_id}")
-def get_item_endpoint(
+async def get_item_endpoint(
     item_id: str, 
     include_meta: bool = False, 
     include_content: bool = False, 
@@ -109,7 +309,15 @@ def get_item_endpoint(
     """
     Endpoint to get a specific item for a user.
     """
-    item = get_item(user.user.id, item_id, include_meta, include_content)
+    item = await get_item(user.user.id, item_id, include_meta, include_content)
+    if not item:
+        raise HTTPException(status_code=404, detail="Item not found")
+    if include_content:
+        # content that is still waiting to be written is newer than what's in the db,
+        # and the version is what to send patches against
+        document = await current_document(user.user.id, item_id, item["item_content"])
+        item["item_content"] = document["content"]
+        item["version"] = document["version"]
     return item
 
 class ItemCreateRequest(BaseModel):
@@ -118,7 +326,7 @@ class ItemCreateRequest(BaseModel):
     content: Optional[str] = None
 
 @app.post("/items")
-def create_item_endpoint(
+async def create_item_endpoint(
     body: ItemCreateRequest,
     product_name: str = PRODUCT,
     user = Depends(require_auth)):
@@ -126,62 +334,148 @@ def create_item_endpoint(
     Endpoint to create an item for a user.
     """
     #count existing items of the same type
-    items = get_items(user.user.id, product_name, body.item_type)
-    print(len(items))
-    if len(items) > 3:
-        subscription = check_user_subscription(user.user.id, product_name)
+    item_count = await count_items(user.user.id, product_name, body.item_type)
+    if item_count > 3:
+        subscription = await check_user_subscription(user.user.id, product_name)
         if not subscription:
             raise HTTPException(status_code=402, detail="Payment required")
         
         if subscription.status not in ["active", "trialing"] or subscription.cancel_at_period_end:
                 raise HTTPException(status_code=402, detail="Payment required")
 
-    item = create_item(user.user.id, product_name, body.item_type, body.meta, body.content)
+    item = await create_item(user.user.id, product_name, body.item_type, body.meta, body.content)
     return item
 
 class ItemUpdateRequest(BaseModel):
     content: Optional[str] = None
 
 @app.post("/items/{item_id}/content")
-def set_item_content_endpoint(
+async def set_item_content_endpoint(
     item_id: str, 
     body: ItemUpdateRequest,
     user = Depends(require_auth)):
     """
     Endpoint to set the content of an item for a user.
     """
-    set_item_content(user.user.id, item_id, body.content)
-    return {"status": "ok"}
+    content_writer.enqueue(user.user.id, item_id, body.content)
+    version = await remember_document(user.user.id, item_id, body.content)
+    return {"status": "ok", "version": version}
+
+class ItemPatchRequest(BaseModel):
+    base_version: str
+    ops: List[Dict[str, Any]]
+
+@app.patch("/items/{item_id}/content")
+async def patch_item_content_endpoint(
+    item_id: str, 
+    body: ItemPatchRequest,
+    user = Depends(require_auth)):
+    """
+    Endpoint to update the content of an item with a list of edits (see app/documents.py).
+    Returns 409 if base_version is out of date.
+    """
+    document = await patch_document(user.user.id, item_id, body.base_version, body.ops)
+    content_writer.enqueue(user.user.id, item_id, document["content"])
+    return {"status": "ok", "version": document["version"]}
 
 @app.post("/items/{item_id}/meta")
-def set_item_meta_endpoint(
+async def set_item_meta_endpoint(
     item_id: str, 
     meta: dict, 
     user = Depends(require_auth)):
     """
     Endpoint to set the meta of an item for a user.
     """
-    set_item_meta(user.user.id, item_id, meta)
+    await set_item_meta(user.user.id, item_id, meta)
     return {"status": "ok"}
 
 @app.delete("/items/{item_id}")
-def delete_item_endpoint(
+async def delete_item_endpoint(
     item_id: str, 
     product_name: str = PRODUCT, 
     user = Depends(require_auth)):
     """
     Endpoint to delete an item for a user.
     """
-    delete_item(user.user.id, product_name, item_id)
+    await delete_item(user.user.id, item_id)
+    await forget_document(user.user.id, item_id)
+    content_writer.discard(user.user.id, item_id)
     return {"status": "ok"}
 
 
 class SuggestRequest(BaseModel):
-    content: str
+    # either the full content, or a patch against the last version we saw (patches are always saved)
+    content: Optional[str] = None
+    base_version: Optional[str] = None
+    ops: Optional[List[Dict[str, Any]]] = None
     save_content: Optional[bool] = False
+    stream: Optional[bool] = False
+
+class SlotStreamingResponse(StreamingResponse):
+    """
+    A StreamingResponse that gives back an admission slot once it is done, however it ends.
+    The generator's own finally isn't enough: a generator that never started (the client went away
+    before the first chunk) doesn't run it when it's closed.
+    """
+    def __init__(self, content, slot, **kwargs):
+        super().__init__(content, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.slot.release()
+
+async def stream_prediction(content: str, prediction_key, version: str = None, profile: str = None, references: str = None, slot = None):
+    """
+    Yields NDJSON lines with prediction fragments as the model produces them.
+    The last line is {"prediction": "", "done": true} (plus the content version if it was saved).
+    """
+    first = True
+    prediction = ""
+    started = time.perf_counter()
+    # a newer request for the same item makes this one pointless, stop streaming (and stop the model)
+    superseded = suggestion_flights.claim(prediction_key)
+    fragments = stream_suggestions(content, profile=profile, references=references)
+    try:
+        async for fragment in fragments:
+            if superseded.done():
+                superseded_line = {"prediction": "", "done": True, "superseded": True}
+                if version:
+                    superseded_line["version"] = version
+                yield json.dumps(superseded_line) + "\n"
+                return
+            #same leading space trimming as the non streaming response, but only on the first chunk
+            if first and content.endswith(" ") and fragment.startswith(" "):
+                fragment = fragment[1:]
+            first = False
+            if not fragment:
+                continue
+            if not prediction:
+                STAGE_LATENCY.labels("first_fragment").observe(time.perf_counter() - started)
+            prediction += fragment
+            yield json.dumps({"prediction": fragment}) + "\n"
+    finally:
+        await fragments.aclose()
+        suggestion_flights.release(prediction_key, superseded)
+        if slot is not None:
+            slot.release()
+    remember_prediction(prediction_key, content, prediction)
+    yield done_line(version)
+
+async def stream_continuation(remaining: str, version: str = None):
+    yield json.dumps({"prediction": remaining}) + "\n"
+    yield done_line(version)
+
+def done_line(version: str = None) -> str:
+    done = {"prediction": "", "done": True}
+    if version:
+        done["version"] = version
+    return json.dumps(done) + "\n"
 
 @app.post("/items/{item_id}/suggest")
-def get_suggestion(
+async def get_suggestion(
     item_id: str, 
     body: SuggestRequest, 
     user = Depends(require_auth),
@@ -189,30 +483,129 @@ def get_suggestion(
     """
     Endpoint to get suggestions for a user.
     """
-    item = get_item(user.user.id, item_id, include_meta=True)
+    # turn away runaway clients before doing any work (the subscription lookup is cached)
+    with stage("admission"):
+        lookup_failed = False
+        try:
+            subscription = await check_user_subscription(user.user.id, product_name)
+        except Exception as e:
+            # short documents don't need a subscription, so don't fail them because stripe or the db
+            # is having trouble: they get the free tier's limits, and long ones are refused below
+            logger.warning("subscription lookup for %s failed, treating as free: %s", user.user.id, e)
+            subscription = None
+            lookup_failed = True
+        tier = tier_for(subscription)
+        await suggest_admission.check_rate(user.user.id, tier)
+
+    with stage("lookup"):
+        item = await get_item(user.user.id, item_id, include_meta=True)
+
     if not item:
         return {"status": "error", "message": "Item not found"}
-    
-    #count the number of words in the content
-    word_count = len(body.content.split())
-    if word_count > 250:
-        subscription = check_user_subscription(user.user.id, product_name)
-        if not subscription:
-            raise HTTPException(status_code=402, detail="Payment required")
-        
-        if subscription.status not in ["active", "trialing"]:
+
+    def check_plan(content: str):
+        # documents over 250 words need a subscription
+        if len(content.split()) > 250:
+            if lookup_failed:
+                # we don't know whether they are paying, so neither serve nor bill them
+                raise HTTPException(status_code=503, detail="Could not check the subscription, try again",
+                                    headers={"Retry-After": "5"})
+            if not subscription:
+                raise HTTPException(status_code=402, detail="Payment required")
+
+            if subscription.status not in ["active", "trialing"]:
                 raise HTTPException(status_code=402, detail="Payment required")
 
+    version = None
+    save_content = body.save_content
+    if body.ops is not None:
+        if not body.base_version:
+            raise HTTPException(status_code=422, detail="base_version is required with ops")
+        # checked before the patch is applied, so a rejected patch leaves the client's version current
+        with stage("patch"):
+            document = await patch_document(user.user.id, item_id, body.base_version, body.ops, check=check_plan)
+        content = document["content"]
+        version = document["version"]
+        save_content = True
+    elif body.content is not None:
+        content = body.content
+        check_plan(content)
+    else:
+        raise HTTPException(status_code=422, detail="content or ops is required")
+
+    if save_content:
+        if version is None:
+            version = await remember_document(user.user.id, item_id, content)
+        # saved in the background by the content writer, so it doesn't hold up the suggestion
+        content_writer.enqueue(user.user.id, item_id, content)
+
+    # the measured style of the whole item, so the model only needs to see the end of it
+    profile = style_profiles.get(user.user.id, item_id)
+    if save_content:
+        style_profiles.maybe_refresh(user.user.id, item_id, content)
+
+    # If the user is typing along the last prediction, hand back the rest of it without asking the model
+    prediction_key = (user.user.id, item_id)
+    remaining = continue_prediction(prediction_key, content)
+    if remaining is not None:
+        if body.stream:
+            return StreamingResponse(stream_continuation(remaining, version), media_type="application/x-ndjson")
+        suggestion = {"prediction": remaining}
+        if version:
+            suggestion["version"] = version
+        return suggestion
+
+    # what the user wrote elsewhere about the same things (precomputed, see app/retrieval.py)
+    with stage("retrieval"):
+        references = await related_passages.passages(user.user.id, product_name, item_id)
+
+    if body.stream:
+        # answers from the backends before the llm (like the local model's word/phrase completions)
+        # are instant, no point streaming them
+        instant = await complete_before_stream(content, user.user.id, product_name, profile, references)
+        if instant is not None:
+            remember_prediction(prediction_key, content, instant["prediction"])
+            return StreamingResponse(stream_continuation(instant["prediction"], version), media_type="application/x-ndjson")
+        # the slot is released when the stream ends, or by the response if it never starts
+        with stage("queue"):
+            slot = await suggest_admission.acquire(tier)
+        try:
+            return SlotStreamingResponse(stream_prediction(content, prediction_key, version, profile, references, slot),
+                                         slot, media_type="application/x-ndjson")
+        except BaseException:
+            slot.release()
+            raise
+
     # Get the suggestions from the model
-    suggestion = get_suggestions(body.content)
-    
-    # Save the suggestions to the item if requested
-    # Todo - this should be in a background task
-    if body.save_content:
-        set_item_content(user.user.id, item_id, body.content)
+    # identical requests in flight share one call, and a newer request for this item supersedes this one
+    with stage("queue"):
+        slot = await suggest_admission.acquire(tier)
+    try:
+        with stage("model"):
+            suggestion = await suggestion_flights.run(
+                prediction_key,
+                # per user, since the local backend answers from the user's own writing
+                (user.user.id, product_name, suggestion_cache_key(content, profile, references)),
+                lambda: complete_suggestion(content, user.user.id, product_name, profile, references)
+            )
+    finally:
+        slot.release()
+    if suggestion is None:
+        # the content was still saved, the client needs its version for the next patch
+        superseded = {"prediction": "", "superseded": True}
+        if version:
+            superseded["version"] = version
+        return superseded
+    # the result may be shared with other requests, don't trim theirs
+    suggestion = dict(suggestion)
 
     #if the content ends in a space and the suggestion starts with a space, remove it
-    if body.content.endswith(" ") and suggestion['prediction'].startswith(" "):
+    if content.endswith(" ") and suggestion['prediction'].startswith(" "):
         suggestion['prediction'] = suggestion['prediction'][1:]
+
+    remember_prediction(prediction_key, content, suggestion['prediction'])
+
+    if version:
+        suggestion["version"] = version
     
     return suggestion
\ No newline at end of file
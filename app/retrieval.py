@@ -0,0 +1,385 @@
+"""
+Passages from the user's other items, so predictions can pick up their recurring names, phrasing and terminology.
+
+Every item's content is cut into chunks of about RETRIEVAL_CHUNK_TOKENS tokens, at paragraph and sentence
+boundaries, and embedded ahead of time. A user's chunks live in a store on disk under RETRIEVAL_DIR:
+    <key>.json         the item_id and text of every chunk, the products that are fully in the store,
+                       and which .npy file holds the vectors
+    <key>.<gen>.npy    float32 matrix, one normalized RETRIEVAL_DIMENSIONS long embedding per chunk,
+                       opened memory mapped
+Stores are rewritten whole (new .npy, then the .json is swapped in, then the old .npy removed) under an
+exclusive file lock, and read under a shared one, so workers on the same host can share them. A reader
+has the .npy mapped by the time it lets go of the lock, and a mapping outlives the removal of its file.
+
+Nothing on the suggest path calls a model: the query is the current item's last chunk, which is already
+in the store, and scoring is one matrix-vector product over the user's chunks. Until an item has been
+embedded it just doesn't get any passages.
+
+Stores are kept up to date from the item write hooks, by the worker that made the write. Changed items are
+re-chunked every RETRIEVAL_INTERVAL seconds, and only chunks whose text changed are embedded again. The first
+suggest for a product that isn't in the user's store yet adds all of its items in the background.
+"""
+
+from contextlib import contextmanager
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+import weakref
+
+import numpy as np
+
+from omni.cache import TTLCache
+from omni.helpers import item_listeners, iter_items
+from omni.writebehind import content_writer
+from .context import count_tokens
+from .search import embed_texts, SEARCH_EMBEDDING_MODEL
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL = os.getenv("RETRIEVAL", "0") == "1"
+RETRIEVAL_DIR = os.getenv("RETRIEVAL_DIR", "data/retrieval")
+RETRIEVAL_DIMENSIONS = int(os.getenv("RETRIEVAL_DIMENSIONS", "256"))
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "120"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "300"))
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RETRIEVAL_MIN_SIMILARITY = float(os.getenv("RETRIEVAL_MIN_SIMILARITY", "0.35"))
+RETRIEVAL_INTERVAL = float(os.getenv("RETRIEVAL_INTERVAL", "60"))
+RETRIEVAL_STORE_CACHE_SIZE = int(os.getenv("RETRIEVAL_STORE_CACHE_SIZE", "1000"))
+RETRIEVAL_STORE_TTL = float(os.getenv("RETRIEVAL_STORE_TTL", "600"))
+EMBED_BATCH = 128
+BACKFILL_PAGE = 200
+
+PARAGRAPH = re.compile(r"\n\s*\n")
+SENTENCE = re.compile(r"(?<=[.!?])\s+")
+
+def chunk_text(text: str) -> list:
+    """
+    Cut text into chunks of about RETRIEVAL_CHUNK_TOKENS tokens. Paragraphs are kept together when they fit,
+    longer ones are split between sentences. Packing starts at the top, so typing at the end of a
+    document only changes its last chunk.
+    """
+    pieces = []
+    for paragraph in PARAGRAPH.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph) <= RETRIEVAL_CHUNK_TOKENS:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE.split(paragraph):
+            # a "sentence" without any punctuation can be anything, cut it by length
+            limit = RETRIEVAL_CHUNK_TOKENS * 4
+            pieces += [sentence[i:i + limit] for i in range(0, len(sentence), limit)]
+
+    chunks = []
+    current, tokens = [], 0
+    for piece in pieces:
+        size = count_tokens(piece)
+        if current and tokens + size > RETRIEVAL_CHUNK_TOKENS:
+            chunks.append("\n".join(current))
+            current, tokens = [], 0
+        current.append(piece)
+        tokens += size
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def store_path(user_id: str) -> str:
+    return os.path.join(RETRIEVAL_DIR, hashlib.sha256(user_id.encode()).hexdigest()[:32])
+
+@contextmanager
+def locked(path: str, shared: bool = False):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+class VectorStore:
+    def __init__(self, vectors=None, items: list = None, texts: list = None, products: list = None, file: str = None):
+        self.vectors = vectors           # chunk -> embedding
+        self.items = items or []         # chunk -> item_id
+        self.texts = texts or []         # chunk -> text
+        self.products = set(products or [])
+        self.file = file
+        self.rows = {}                   # item_id -> its chunks, in order
+        for row, item_id in enumerate(self.items):
+            self.rows.setdefault(item_id, []).append(row)
+
+    @classmethod
+    def read(cls, path: str) -> "VectorStore":
+        """
+        load, under the store's lock, so a save can't remove the .npy between reading the json and opening it.
+        """
+        with locked(path, shared=True):
+            return cls.load(path)
+
+    @classmethod
+    def load(cls, path: str) -> "VectorStore":
+        """
+        The store at path, or an empty one if there isn't one (or it was made with another embedding model).
+        The caller holds the store's lock (see read).
+        """
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        if meta.get("model") != SEARCH_EMBEDDING_MODEL or meta.get("dimensions") != RETRIEVAL_DIMENSIONS:
+            return cls()
+        vectors = None
+        if meta["items"]:
+            vectors = np.asarray(np.load(os.path.join(os.path.dirname(path), meta["file"]), mmap_mode="r"))
+        return cls(vectors, meta["items"], meta["texts"], meta["products"], meta["file"])
+
+    def save(self, path: str):
+        """
+        Write the vectors to a new file, then point the json at it. Readers that still have
+        the old file mapped keep working.
+        """
+        file = f"{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.npy"
+        directory = os.path.dirname(path)
+        vectors = self.vectors if self.vectors is not None else np.zeros((0, RETRIEVAL_DIMENSIONS), dtype=np.float32)
+        np.save(os.path.join(directory, file), vectors)
+        meta = {"model": SEARCH_EMBEDDING_MODEL, "dimensions": RETRIEVAL_DIMENSIONS, "file": file,
+                "items": self.items, "texts": self.texts, "products": sorted(self.products)}
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".json.tmp", path + ".json")
+        if self.file:
+            try:
+                os.remove(os.path.join(directory, self.file))
+            except FileNotFoundError:
+                pass
+        self.file = file
+
+    def vectors_by_text(self, item_id: str) -> dict:
+        if self.vectors is None:
+            return {}
+        return {self.texts[row]: row for row in self.rows.get(item_id, [])}
+
+    def related(self, item_id: str, k: int, min_similarity: float) -> list:
+        """
+        Texts of the k chunks of other items most similar to the last chunk of item_id, most similar first.
+        """
+        rows = self.rows.get(item_id)
+        if not rows or self.vectors is None or len(self.items) == len(rows):
+            return []
+        scores = self.vectors @ self.vectors[rows[-1]]
+        scores[rows] = -np.inf
+        k = min(k, len(scores) - len(rows))
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best])]
+        return [self.texts[row] for row in best if scores[row] >= min_similarity]
+
+def pick_passages(store: VectorStore, item_id: str) -> tuple:
+    """
+    (texts, tokens) of the chunks related to item_id that fit in RETRIEVAL_TOKEN_BUDGET.
+    """
+    picked, tokens = [], 0
+    for text in store.related(item_id, RETRIEVAL_TOP_K, RETRIEVAL_MIN_SIMILARITY):
+        size = count_tokens(text)
+        if tokens + size > RETRIEVAL_TOKEN_BUDGET:
+            continue
+        picked.append(text)
+        tokens += size
+    return picked, tokens
+
+def rechunk(store: VectorStore, contents: dict) -> tuple:
+    """
+    Chunk the items in contents (item_id -> content, or None if deleted) for apply_changes, reusing the
+    vectors the store has for chunks with the same text. Returns (changes, missing), where missing
+    lists the (item_id, chunk index) that still need a vector.
+    """
+    changes = {}
+    missing = []
+    for item_id, content in contents.items():
+        if content is None:
+            changes[item_id] = None
+            continue
+        known = store.vectors_by_text(item_id)
+        chunks = []
+        for text in chunk_text(content):
+            row = known.get(text)
+            if row is None:
+                missing.append((item_id, len(chunks)))
+                chunks.append((text, None))
+            else:
+                chunks.append((text, np.array(store.vectors[row])))
+        changes[item_id] = chunks
+    return changes, missing
+
+def apply_changes(path: str, changes: dict, product_name: str = None) -> VectorStore:
+    """
+    Replace the chunks of the changed items in the store at path.
+    changes maps item_id to a list of (text, vector), or None for deleted items.
+    Runs in a thread: it reads and writes the whole store.
+    """
+    with locked(path):
+        current = VectorStore.load(path)
+        keep = [row for row, item_id in enumerate(current.items) if item_id not in changes]
+        items = [current.items[row] for row in keep]
+        texts = [current.texts[row] for row in keep]
+        vectors = [current.vectors[keep]] if keep else []
+        for item_id, chunks in changes.items():
+            if not chunks:
+                continue
+            items += [item_id] * len(chunks)
+            texts += [text for text, _ in chunks]
+            vectors.append(np.stack([vector for _, vector in chunks]))
+        products = current.products | ({product_name} if product_name else set())
+        store = VectorStore(np.concatenate(vectors).astype(np.float32) if vectors else None,
+                            items, texts, products, current.file)
+        store.save(path)
+        return VectorStore.load(path)
+
+class RelatedPassages:
+    def __init__(self, embed=embed_texts, enabled: bool = RETRIEVAL):
+        self.embed = embed if enabled else None
+        self.stores = TTLCache(maxsize=RETRIEVAL_STORE_CACHE_SIZE, ttl=RETRIEVAL_STORE_TTL)
+        self.pending = {}      # user_id -> {item_id: latest content, None once deleted}
+        self.loading = {}      # user_id -> task loading the store from disk
+        self.backfills = {}    # (user_id, product_name) -> task adding all items of the product
+        self.locks = weakref.WeakValueDictionary()  # user_id -> lock around updates of their store
+        self.task = None
+        self.stats = {"requests": 0, "hits": 0, "passages": 0, "tokens": 0, "loads": 0, "updates": 0,
+                      "backfills": 0, "chunks_embedded": 0, "chunks_reused": 0, "failures": 0}
+        item_listeners.append(self.on_item_change)
+
+    def start(self):
+        if self.embed is not None and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def on_item_change(self, change: str, user_id: str, item_id: str, fields: dict):
+        if self.embed is None or change == "meta":
+            return
+        content = None if change == "delete" else fields.get("content") or ""
+        self.pending.setdefault(user_id, {})[item_id] = content
+
+    async def passages(self, user_id: str, product_name: str, item_id: str):
+        """
+        Related passages from the user's other items, as one block of text within RETRIEVAL_TOKEN_BUDGET,
+        or None. Never waits for the store: one that isn't loaded yet is loaded for next time.
+        """
+        if self.embed is None:
+            return None
+        self.stats["requests"] += 1
+        store = self.stores.get(user_id)
+        if store is None:
+            self.load_later(user_id, product_name)
+            return None
+        if product_name not in store.products:
+            self.backfill_later(user_id, product_name)
+
+        # scoring against every chunk of a big store takes a while, keep it off the event loop
+        picked, tokens = await asyncio.to_thread(pick_passages, store, item_id)
+        if not picked:
+            return None
+        self.stats["hits"] += 1
+        self.stats["passages"] += len(picked)
+        self.stats["tokens"] += tokens
+        return "\n---\n".join(picked)
+
+    def load_later(self, user_id: str, product_name: str):
+        if user_id in self.loading:
+            return
+
+        async def load():
+            try:
+                store = await asyncio.to_thread(VectorStore.read, store_path(user_id))
+                if self.stores.get(user_id) is None:
+                    self.stores.set(user_id, store)
+                self.stats["loads"] += 1
+                if product_name not in store.products:
+                    self.backfill_later(user_id, product_name)
+            except Exception as e:
+                logger.warning("loading the passage store of %s failed: %s", user_id, e)
+                self.stats["failures"] += 1
+            finally:
+                self.loading.pop(user_id, None)
+        self.loading[user_id] = asyncio.create_task(load())
+
+    def backfill_later(self, user_id: str, product_name: str):
+        key = (user_id, product_name)
+        if key in self.backfills:
+            return
+
+        async def backfill():
+            try:
+                page = {}
+                async for item in iter_items(user_id, product_name, include_content=True):
+                    content = content_writer.pending_content(user_id, item["item_id"])
+                    page[item["item_id"]] = content if content is not None else item.get("item_content") or ""
+                    if len(page) >= BACKFILL_PAGE:
+                        await self.update(user_id, page)
+                        page = {}
+                await self.update(user_id, page, product_name)
+                self.stats["backfills"] += 1
+            except Exception as e:
+                logger.warning("adding the %s items of %s to their passage store failed: %s", product_name, user_id, e)
+                self.stats["failures"] += 1
+            finally:
+                self.backfills.pop(key, None)
+        self.backfills[key] = asyncio.create_task(backfill())
+
+    async def update(self, user_id: str, contents: dict, product_name: str = None):
+        """
+        Re-chunk the items in contents (item_id -> content, or None if deleted) and write them to the store.
+        Chunks that are already in the store with the same text keep their vector.
+        """
+        lock = self.locks.get(user_id)
+        if lock is None:
+            lock = self.locks[user_id] = asyncio.Lock()
+        async with lock:
+            path = store_path(user_id)
+            store = self.stores.get(user_id)
+            if store is None:
+                store = await asyncio.to_thread(VectorStore.read, path)
+
+            # tokenizing whole documents takes a while, keep it off the event loop
+            changes, missing = await asyncio.to_thread(rechunk, store, contents)
+            self.stats["chunks_reused"] += sum(len(chunks) for chunks in changes.values() if chunks) - len(missing)
+
+            for start in range(0, len(missing), EMBED_BATCH):
+                batch = missing[start:start + EMBED_BATCH]
+                vectors = await self.embed([changes[item_id][i][0] for item_id, i in batch], RETRIEVAL_DIMENSIONS)
+                for (item_id, i), vector in zip(batch, vectors):
+                    changes[item_id][i] = (changes[item_id][i][0], vector)
+                self.stats["chunks_embedded"] += len(batch)
+
+            store = await asyncio.to_thread(apply_changes, path, changes, product_name)
+            self.stores.set(user_id, store)
+            self.stats["updates"] += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(RETRIEVAL_INTERVAL)
+            pending, self.pending = self.pending, {}
+            for user_id, contents in pending.items():
+                try:
+                    await self.update(user_id, contents)
+                except Exception as e:
+                    logger.warning("updating the passage store of %s failed: %s", user_id, e)
+                    self.stats["failures"] += 1
+                    # try again next time, unless the items changed since
+                    waiting = self.pending.setdefault(user_id, {})
+                    for item_id, content in contents.items():
+                        waiting.setdefault(item_id, content)
+
+related_passages = RelatedPassages()
@@ -0,0 +1,545 @@
+"""
+Search over a user's items.
+
+Each (user, product) gets an in-memory index the first time they search. It is built with one paged
+pass over their items (iter_items) and after that kept up to date by the write helpers
+(create_item, set_item_content, set_item_meta and delete_item call notify_item_change).
+So a search never reads item content from the db, except for the handful of results it makes snippets for.
+
+An index has two halves:
+- an inverted index, term -> {doc: term frequency}, ranked with BM25
+- with SEARCH_EMBEDDINGS=1, an embedding per item (the title and the start of the content) as a row of
+  a NumPy matrix, scored against the query embedding with one matrix-vector product. If hnswlib is
+  installed and there are more than SEARCH_ANN_MIN_ITEMS embedded items, an HNSW graph is used instead.
+mode="text" ranks with BM25 only, "semantic" with embeddings only, and "hybrid" (the default when
+embeddings are on) mixes the two scores.
+
+Embeddings are computed in the background, a batch every SEARCH_EMBED_INTERVAL seconds, so an item
+that is being typed into is embedded once per interval and not on every save.
+Indexes live in a TTLCache. An index is dropped SEARCH_INDEX_TTL seconds after it was built, however
+much it is used, and rebuilt by the next search. Writes made by other workers reach the index as broadcast item changes (omni/helpers.py),
+and if this worker may have missed some of those, all indexes are dropped.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+from omni.cache import TTLCache
+from omni.helpers import broadcast, item_listeners, remote_item_listeners, iter_items, get_item
+from omni.writebehind import content_writer
+from .llm_router import router
+
+logger = logging.getLogger(__name__)
+
+SEARCH_INDEX_TTL = float(os.getenv("SEARCH_INDEX_TTL", "1800"))
+SEARCH_INDEX_CACHE_SIZE = int(os.getenv("SEARCH_INDEX_CACHE_SIZE", "200"))
+SEARCH_EMBEDDINGS = os.getenv("SEARCH_EMBEDDINGS", "0") == "1"
+# the embedding deployment, which has to exist next to the chat deployments the router knows about
+SEARCH_EMBEDDING_MODEL = os.getenv("SEARCH_EMBEDDING_MODEL", "text-embedding-3-small")
+SEARCH_EMBED_INTERVAL = float(os.getenv("SEARCH_EMBED_INTERVAL", "30"))
+SEARCH_EMBED_BATCH = int(os.getenv("SEARCH_EMBED_BATCH", "64"))
+SEARCH_EMBED_CHARS = int(os.getenv("SEARCH_EMBED_CHARS", "2000"))
+SEARCH_ANN_MIN_ITEMS = int(os.getenv("SEARCH_ANN_MIN_ITEMS", "5000"))
+SEARCH_SEMANTIC_WEIGHT = float(os.getenv("SEARCH_SEMANTIC_WEIGHT", "0.5"))
+SEARCH_MIN_SIMILARITY = float(os.getenv("SEARCH_MIN_SIMILARITY", "0.25"))
+SNIPPET_CHARS = 200
+CANDIDATES = 200       # results of each half that go into the hybrid ranking
+TITLE_WEIGHT = 3       # a term in the title counts as this many in the content
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+WORD = re.compile(r"\w+")
+
+def tokenize(text: str) -> list:
+    return [w for w in WORD.findall(text.lower()) if len(w) <= 40]
+
+def title_of(meta: dict):
+    return (meta or {}).get("title")
+
+def embedding_text(title: str, content: str) -> str:
+    return ((title + "\n") if title else "") + (content or "")[:SEARCH_EMBED_CHARS]
+
+class ItemIndex:
+    """
+    The index of one user's items of one product. Docs are numbered, and a deleted doc's number is reused.
+    """
+    def __init__(self):
+        self.ids = []          # doc -> item_id, None for a free doc
+        self.docs = {}         # item_id -> doc
+        self.free = []
+        self.terms = []        # doc -> {term: frequency}, to take a doc out of the postings again
+        self.info = []         # doc -> {"item_type", "title", "updated_at"}
+        self.postings = {}     # term -> {doc: frequency}
+        self.lengths = np.zeros(64, dtype=np.float32)
+        self.total_length = 0.0
+        self.vectors = None    # doc -> normalized embedding, once we know the dimension
+        self.embedded = np.zeros(64, dtype=bool)
+        self.ann = None
+        # while the index is being built: item_id -> what was written to it since the scan started
+        self.written = None
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _grow(self):
+        capacity = len(self.lengths) * 2
+        self.lengths = np.resize(self.lengths, capacity)
+        self.lengths[len(self.ids):] = 0
+        self.embedded = np.resize(self.embedded, capacity)
+        self.embedded[len(self.ids):] = False
+        if self.vectors is not None:
+            vectors = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors[:len(self.vectors)] = self.vectors
+            self.vectors = vectors
+        if self.ann is not None:
+            self.ann.resize_index(capacity)
+
+    def _doc(self, item_id: str) -> int:
+        doc = self.docs.get(item_id)
+        if doc is not None:
+            return doc
+        if self.free:
+            doc = self.free.pop()
+            self.ids[doc] = item_id
+            self.terms[doc] = {}
+            self.info[doc] = {}
+        else:
+            doc = len(self.ids)
+            if doc >= len(self.lengths):
+                self._grow()
+            self.ids.append(item_id)
+            self.terms.append({})
+            self.info.append({})
+        self.docs[item_id] = doc
+        return doc
+
+    def _unindex(self, doc: int):
+        for term in self.terms[doc]:
+            posting = self.postings[term]
+            del posting[doc]
+            if not posting:
+                del self.postings[term]
+        self.terms[doc] = {}
+        self.total_length -= self.lengths[doc]
+        self.lengths[doc] = 0
+
+    def _index(self, doc: int, frequencies: dict):
+        for term, count in frequencies.items():
+            self.postings.setdefault(term, {})[doc] = count
+        self.terms[doc] = frequencies
+        length = sum(frequencies.values())
+        self.lengths[doc] = length
+        self.total_length += length
+
+    def upsert(self, item_id: str, content: str = None, **info):
+        """
+        Add or update an item. Without content only the info (item_type, title, updated_at) changes,
+        and the title terms are swapped if the title did.
+        """
+        doc = self._doc(item_id)
+        old_title = self.info[doc].get("title")
+        self.info[doc].update(info)
+        title = self.info[doc].get("title")
+        if content is not None:
+            frequencies = {}
+            for term in tokenize(content):
+                frequencies[term] = frequencies.get(term, 0) + 1
+        elif title != old_title:
+            frequencies = dict(self.terms[doc])
+            for term in tokenize(old_title or ""):
+                frequencies[term] -= TITLE_WEIGHT
+        else:
+            return
+        for term in tokenize(title or ""):
+            frequencies[term] = frequencies.get(term, 0) + TITLE_WEIGHT
+        self._unindex(doc)
+        self._index(doc, {term: count for term, count in frequencies.items() if count > 0})
+
+    def fill(self, item_id: str, **info):
+        """
+        Fill in info we didn't have for an item, without overwriting anything.
+        """
+        doc = self.docs.get(item_id)
+        if doc is None:
+            return
+        missing = {k: v for k, v in info.items() if self.info[doc].get(k) is None}
+        if missing:
+            self.upsert(item_id, **missing)
+
+    def remove(self, item_id: str):
+        doc = self.docs.pop(item_id, None)
+        if doc is None:
+            return
+        self._unindex(doc)
+        self.ids[doc] = None
+        self.info[doc] = {}
+        self.embedded[doc] = False
+        if self.ann is not None:
+            try:
+                self.ann.mark_deleted(doc)
+            except RuntimeError:
+                pass
+        self.free.append(doc)
+
+    def only(self, docs, item_type: str = None):
+        if not item_type:
+            return docs
+        return np.array([d for d in docs if self.info[d].get("item_type") == item_type], dtype=np.int64)
+
+    def set_vector(self, item_id: str, vector):
+        doc = self.docs.get(item_id)
+        if doc is None:
+            return
+        if self.vectors is None:
+            self.vectors = np.zeros((len(self.lengths), len(vector)), dtype=np.float32)
+        self.vectors[doc] = vector
+        self.embedded[doc] = True
+        if self.ann is not None:
+            self.ann.add_items(vector[np.newaxis], [doc])
+        elif hnswlib is not None and int(self.embedded.sum()) >= SEARCH_ANN_MIN_ITEMS:
+            self.build_ann()
+
+    def build_ann(self):
+        docs = np.flatnonzero(self.embedded)
+        ann = hnswlib.Index(space="ip", dim=self.vectors.shape[1])
+        ann.init_index(max_elements=len(self.lengths), ef_construction=200, M=16)
+        ann.add_items(self.vectors[docs], docs)
+        self.ann = ann
+
+    def bm25(self, terms: list):
+        """
+        BM25 score of every doc (0 for docs without any of the terms).
+        """
+        count = len(self.ids)
+        scores = np.zeros(count, dtype=np.float32)
+        if not self.docs:
+            return scores
+        average = self.total_length / len(self.docs) or 1.0
+        norms = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[:count] / average)
+        for term in set(terms):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            docs = np.fromiter(posting.keys(), dtype=np.int64, count=len(posting))
+            frequencies = np.fromiter(posting.values(), dtype=np.float32, count=len(posting))
+            idf = math.log(1 + (len(self.docs) - len(posting) + 0.5) / (len(posting) + 0.5))
+            scores[docs] += idf * frequencies * (BM25_K1 + 1) / (frequencies + norms[docs])
+        return scores
+
+    def nearest(self, query, k: int):
+        """
+        (docs, cosine similarities) of the k embedded docs closest to the query vector.
+        """
+        if self.vectors is None or not self.embedded.any():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if self.ann is not None:
+            self.ann.set_ef(max(2 * k, 50))
+            try:
+                docs, distances = self.ann.knn_query(query, k=min(k, self.ann.get_current_count()))
+                docs, similarities = docs[0].astype(np.int64), 1 - distances[0]
+                live = self.embedded[docs]
+                return docs[live], similarities[live]
+            except RuntimeError:
+                # too few live elements for k after deletes, the brute force below still works
+                pass
+        count = len(self.ids)
+        similarities = self.vectors[:count] @ query
+        similarities[~self.embedded[:count]] = -np.inf
+        docs = top(similarities, k)
+        docs = docs[np.isfinite(similarities[docs])]
+        return docs, similarities[docs]
+
+def top(scores, k: int):
+    """
+    Indexes of the k highest scores, highest first.
+    """
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+def snippet(content: str, terms: set) -> dict:
+    """
+    The SNIPPET_CHARS long stretch of content with the most distinct query terms in it,
+    and where the terms are inside it.
+    """
+    matches = [(m.start(), m.end()) for m in WORD.finditer(content) if m.group().lower() in terms]
+    if not matches:
+        text = content[:SNIPPET_CHARS]
+        return {"snippet": text + ("…" if len(content) > SNIPPET_CHARS else ""), "highlights": []}
+
+    best, best_count, end = 0, 0, 0
+    for start in range(len(matches)):
+        end = max(end, start)
+        while end + 1 < len(matches) and matches[end + 1][1] - matches[start][0] <= SNIPPET_CHARS:
+            end += 1
+        count = len({content[s:e].lower() for s, e in matches[start:end + 1]})
+        if count > best_count:
+            best, best_count = start, count
+
+    first = matches[best][0]
+    window = [m for m in matches[best:] if m[1] - first <= SNIPPET_CHARS]
+    # center the matches in the window, then move the edges to word boundaries
+    slack = SNIPPET_CHARS - (window[-1][1] - first)
+    begin = max(0, first - slack // 2)
+    stop = min(len(content), begin + SNIPPET_CHARS)
+    if begin > 0:
+        space = content.find(" ", begin, first)
+        begin = space + 1 if space != -1 else begin
+    if stop < len(content):
+        space = content.rfind(" ", window[-1][1], stop)
+        stop = space if space != -1 else stop
+    prefix = "…" if begin > 0 else ""
+    text = prefix + content[begin:stop] + ("…" if stop < len(content) else "")
+    offset = len(prefix) - begin
+    return {"snippet": text, "highlights": [[s + offset, e + offset] for s, e in matches if s >= begin and e <= stop]}
+
+async def embed_texts(texts: list, dimensions: int = None):
+    """
+    Normalized embeddings of texts, one row each.
+    dimensions shortens the embeddings (text-embedding-3 models only).
+    """
+    options = {"dimensions": dimensions} if dimensions else {}
+    response = await router.complete(lambda deployment: deployment.client().embeddings.create(
+        model=SEARCH_EMBEDDING_MODEL,
+        input=texts,
+        **options
+    ), hedge=False)
+    vectors = np.array([d.embedding for d in response.data], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class SearchIndexes:
+    def __init__(self, embed=embed_texts, embeddings: bool = SEARCH_EMBEDDINGS):
+        self.embed = embed if embeddings else None
+        self.indexes = TTLCache(maxsize=SEARCH_INDEX_CACHE_SIZE, ttl=SEARCH_INDEX_TTL)
+        self.products = {}     # user_id -> product names we may have an index for
+        self.builds = {}       # (user_id, product_name) -> (index, task) while it is being built
+        self.to_embed = {}     # (user_id, product_name, item_id) -> text
+        self.queries = TTLCache(maxsize=1000, ttl=600)
+        self.task = None
+        self.stats = {"builds": 0, "build_seconds": 0.0, "build_failures": 0, "items_indexed": 0,
+                      "searches": 0, "updates": 0, "embedded": 0, "embed_failures": 0}
+        item_listeners.append(self.on_item_change)
+        remote_item_listeners.append(self.on_item_change)
+        broadcast.on_reset(self.indexes.clear)
+
+    def start(self):
+        if self.embed is not None and self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def loaded(self, user_id: str):
+        """
+        (product_name, index) for every index of the user that is built or being built.
+        """
+        for product_name in list(self.products.get(user_id, ())):
+            key = (user_id, product_name)
+            index = self.indexes.get(key)
+            if index is None and key in self.builds:
+                index = self.builds[key][0]
+            if index is None:
+                self.products[user_id].discard(product_name)
+                continue
+            yield product_name, index
+        if not self.products.get(user_id):
+            self.products.pop(user_id, None)
+
+    def on_item_change(self, change: str, user_id: str, item_id: str, fields: dict):
+        """
+        Apply a write to any index that has (or, for new items, should have) the item.
+        """
+        for product_name, index in self.loaded(user_id):
+            if change == "create":
+                if fields.get("product_name") != product_name:
+                    continue
+            elif item_id not in index.docs:
+                if index.written is not None:
+                    # the scan hasn't got to the item yet (and it may not even be of this product),
+                    # so keep the write for when it does
+                    written = index.written.setdefault(item_id, {})
+                    if change == "delete":
+                        written["deleted"] = True
+                    elif change == "content":
+                        written["content"] = fields.get("content") or ""
+                    else:
+                        written["title"] = title_of(fields.get("meta"))
+                continue
+            self.stats["updates"] += 1
+            if index.written is not None:
+                # the index is newer than the item's row in the scan
+                index.written[item_id] = {"deleted": True} if change == "delete" else {}
+
+            if change == "delete":
+                index.remove(item_id)
+                self.to_embed.pop((user_id, product_name, item_id), None)
+                continue
+            if change == "meta":
+                if item_id in index.docs:
+                    index.upsert(item_id, title=title_of(fields.get("meta")))
+            elif change == "content":
+                index.upsert(item_id, fields.get("content") or "")
+            else:
+                index.upsert(item_id, fields.get("content") or "", item_type=fields.get("item_type"),
+                             title=title_of(fields.get("meta")), updated_at=fields.get("updated_at"))
+            if self.embed is not None and item_id in index.docs and change != "meta":
+                title = index.info[index.docs[item_id]].get("title")
+                self.to_embed[(user_id, product_name, item_id)] = embedding_text(title, fields.get("content"))
+
+    async def get(self, user_id: str, product_name: str) -> ItemIndex:
+        """
+        The user's index, building it if we don't have it. Concurrent searches share one build.
+        """
+        key = (user_id, product_name)
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+        if key not in self.builds:
+            index = ItemIndex()
+            index.written = {}
+            self.builds[key] = (index, asyncio.create_task(self.build(user_id, product_name, index)))
+            self.products.setdefault(user_id, set()).add(product_name)
+        return await asyncio.shield(self.builds[key][1])
+
+    async def build(self, user_id: str, product_name: str, index: ItemIndex) -> ItemIndex:
+        started = time.monotonic()
+        key = (user_id, product_name)
+        try:
+            async for item in iter_items(user_id, product_name, include_meta=True, include_content=True):
+                item_id = item["item_id"]
+                info = {"item_type": item.get("item_type"), "title": title_of(item.get("item_meta")),
+                        "updated_at": item.get("updated_at")}
+                written = index.written.get(item_id)
+                if written is not None and (written.get("deleted") or item_id in index.docs):
+                    # changed while we were scanning, the index is already newer than this row
+                    index.fill(item_id, **info)
+                    continue
+                content = content_writer.pending_content(user_id, item_id)
+                if written is not None:
+                    content = written.get("content", content)
+                    info["title"] = written.get("title", info["title"])
+                if content is None:
+                    content = item.get("item_content") or ""
+                index.upsert(item_id, content, **info)
+                if self.embed is not None:
+                    self.to_embed[(user_id, product_name, item_id)] = embedding_text(info["title"], content)
+                self.stats["items_indexed"] += 1
+        except Exception:
+            self.stats["build_failures"] += 1
+            raise
+        finally:
+            self.builds.pop(key, None)
+        index.written = None
+        self.indexes.set(key, index)
+        self.stats["builds"] += 1
+        self.stats["build_seconds"] += time.monotonic() - started
+        return index
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SEARCH_EMBED_INTERVAL)
+            while self.to_embed:
+                batch = []
+                while self.to_embed and len(batch) < SEARCH_EMBED_BATCH:
+                    key = next(iter(self.to_embed))
+                    batch.append((key, self.to_embed.pop(key)))
+                try:
+                    vectors = await self.embed([text or " " for _, text in batch])
+                except Exception as e:
+                    logger.warning("embedding %d items failed: %s", len(batch), e)
+                    self.stats["embed_failures"] += len(batch)
+                    # try again next interval, unless the items changed since
+                    for key, text in batch:
+                        self.to_embed.setdefault(key, text)
+                    break
+                for ((user_id, product_name, item_id), _), vector in zip(batch, vectors):
+                    index = self.indexes.get((user_id, product_name))
+                    if index is not None:
+                        index.set_vector(item_id, vector)
+                self.stats["embedded"] += len(batch)
+
+    async def query_vector(self, query: str):
+        vector = self.queries.get(query)
+        if vector is None:
+            vector = (await self.embed([query]))[0]
+            self.queries.set(query, vector)
+        return vector
+
+    async def search(self, user_id: str, product_name: str, query: str, item_type: str = None,
+                     limit: int = 20, mode: str = None) -> dict:
+        """
+        The best matching items with a snippet each, best first.
+        """
+        self.stats["searches"] += 1
+        mode = mode or ("hybrid" if self.embed is not None else "text")
+        if mode != "text" and self.embed is None:
+            mode = "text"
+        index = await self.get(user_id, product_name)
+        terms = tokenize(query)
+
+        scores = {}
+        matches = 0
+        if mode != "semantic" and terms:
+            bm25 = index.bm25(terms)
+            docs = index.only(np.flatnonzero(bm25), item_type)
+            matches = len(docs)
+            if matches:
+                best = float(bm25[docs].max())
+                weight = 1.0 if mode == "text" else 1 - SEARCH_SEMANTIC_WEIGHT
+                for doc in docs[top(bm25[docs], CANDIDATES)]:
+                    scores[int(doc)] = weight * float(bm25[doc]) / best
+        if mode != "text":
+            try:
+                vector = await self.query_vector(query)
+            except Exception as e:
+                logger.warning("embedding the search query failed, searching text only: %s", e)
+                vector = None
+            if vector is not None:
+                weight = 1.0 if mode == "semantic" else SEARCH_SEMANTIC_WEIGHT
+                docs, similarities = index.nearest(vector, CANDIDATES)
+                for doc, similarity in zip(docs, similarities):
+                    if similarity >= SEARCH_MIN_SIMILARITY and index.only([doc], item_type).size:
+                        scores[int(doc)] = scores.get(int(doc), 0.0) + weight * float(similarity)
+
+        ranked = sorted(((s, d) for d, s in scores.items()), reverse=True)[:limit]
+
+        async def result(score: float, doc: int) -> dict:
+            item_id = index.ids[doc]
+            info = index.info[doc]
+            content = content_writer.pending_content(user_id, item_id)
+            if content is None:
+                item = await get_item(user_id, item_id, include_meta=False, include_content=True)
+                if item is None:
+                    # deleted by another worker (or not yet removed here), drop it from the index too
+                    index.remove(item_id)
+                    return None
+                content = item.get("item_content") or ""
+            return {"item_id": item_id, "item_type": info.get("item_type"), "title": info.get("title"),
+                    "updated_at": info.get("updated_at"), "score": round(score, 4), **snippet(content, set(terms))}
+
+        results = await asyncio.gather(*(result(score, doc) for score, doc in ranked))
+        gone = results.count(None)
+        results = [r for r in results if r is not None]
+        return {"results": results, "total": max(matches, len(scores)) - gone, "mode": mode}
+
+search_indexes = SearchIndexes()
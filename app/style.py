@@ -0,0 +1,214 @@
+"""
+Per-item style profiles.
+
+The instructions ask the model to work out the type, tone, style and reading level of the
+writing on every call, which means sending it a lot of text. Instead we measure those things
+ourselves, in the background, and send a one line profile plus a short tail.
+
+A profile is a set of running counters (words, sentences, syllables, pronouns, ...) over the text
+analyzed so far. When the content grows we only count the new text; if the start of the document
+changed we recount everything. Profiles are kept in memory and saved to their own table
+(item_style_profiles) so they survive restarts and reach the other workers (a saved profile is broadcast,
+and the other workers load it again). Not to the item's meta: the client replaces the meta
+wholesale, and saving the item would move it up the item list while the user is only typing.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+
+from omni.cache import TTLCache
+from omni.helpers import (
+    broadcast, item_listeners, remote_item_listeners, get_item_style_profile, set_item_style_profile
+)
+
+logger = logging.getLogger(__name__)
+
+# refresh once the content has grown (or shrunk) by this many characters since the last profile
+STYLE_REFRESH_CHARS = int(os.getenv("STYLE_REFRESH_CHARS", "1000"))
+# profiles need a bit of text before they say anything useful
+STYLE_MIN_WORDS = int(os.getenv("STYLE_MIN_WORDS", "80"))
+
+WORD = re.compile(r"[A-Za-z']+")
+SENTENCE_END = re.compile(r"[.!?]+")
+FIRST_PERSON = {"i", "me", "my", "mine", "we", "us", "our", "ours", "i'm", "i've", "i'd", "i'll", "we're"}
+SECOND_PERSON = {"you", "your", "yours", "you're", "you've", "you'll"}
+THIRD_PERSON = {"he", "she", "they", "him", "her", "them", "his", "hers", "their", "it", "its"}
+COUNTERS = ["words", "sentences", "syllables", "long_words", "first", "second", "third",
+            "contractions", "exclamations", "questions", "quotes", "paragraphs", "list_lines"]
+
+def syllables(word: str) -> int:
+    groups = re.findall(r"[aeiouy]+", word.lower())
+    count = len(groups)
+    if word.lower().endswith("e") and count > 1:
+        count -= 1
+    return max(1, count)
+
+def count_text(text: str) -> dict:
+    counts = dict.fromkeys(COUNTERS, 0)
+    for word in WORD.findall(text):
+        lower = word.lower()
+        counts["words"] += 1
+        s = syllables(word)
+        counts["syllables"] += s
+        if s >= 3:
+            counts["long_words"] += 1
+        if lower in FIRST_PERSON:
+            counts["first"] += 1
+        elif lower in SECOND_PERSON:
+            counts["second"] += 1
+        elif lower in THIRD_PERSON:
+            counts["third"] += 1
+        if "'" in word.strip("'"):
+            counts["contractions"] += 1
+    counts["sentences"] = len(SENTENCE_END.findall(text))
+    counts["exclamations"] = text.count("!")
+    counts["questions"] = text.count("?")
+    counts["quotes"] = text.count('"') + text.count("“")
+    counts["paragraphs"] = len([p for p in text.split("\n\n") if p.strip()])
+    counts["list_lines"] = len(re.findall(r"^\s*([-*]|\d+\.)\s", text, re.MULTILINE))
+    return counts
+
+def prefix_hash(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def update_profile(profile: dict, content: str) -> dict:
+    """
+    Bring a profile up to date with content, counting only new text when we can.
+    """
+    analyzed = profile.get("analyzed_chars", 0) if profile else 0
+    if profile and analyzed <= len(content) and prefix_hash(content[:analyzed]) == profile.get("prefix_hash"):
+        counts = profile["counts"]
+        new = count_text(content[analyzed:])
+        counts = {k: counts.get(k, 0) + new[k] for k in COUNTERS}
+        # a paragraph that was still being written when we last looked got counted twice
+        split_paragraph = not content[:analyzed].endswith("\n\n") and not content[analyzed:].startswith("\n\n")
+        if analyzed and new["paragraphs"] and split_paragraph:
+            counts["paragraphs"] -= 1
+    else:
+        counts = count_text(content)
+
+    return {"counts": counts, "analyzed_chars": len(content), "prefix_hash": prefix_hash(content)}
+
+def describe(profile: dict) -> str:
+    """
+    One line description of a profile for the prompt, or None if there isn't enough text yet.
+    """
+    if not profile:
+        return None
+    c = profile["counts"]
+    words = c["words"]
+    if words < STYLE_MIN_WORDS:
+        return None
+    sentences = max(1, c["sentences"])
+
+    words_per_sentence = words / sentences
+    # Flesch-Kincaid grade level
+    grade = 0.39 * words_per_sentence + 11.8 * (c["syllables"] / words) - 15.59
+
+    pronouns = {"first": c["first"], "second": c["second"], "third": c["third"]}
+    pov = max(pronouns, key=pronouns.get) if any(pronouns.values()) else "third"
+
+    per_100 = lambda n: 100 * n / words
+    formality = "casual" if per_100(c["contractions"]) > 2 or per_100(c["exclamations"]) > 1 else "formal"
+
+    if c["list_lines"] > c["paragraphs"]:
+        kind = "structured (lists/notes)"
+    elif c["quotes"] / sentences > 0.3:
+        kind = "narrative with dialogue"
+    elif c["second"] > c["first"] and c["second"] > c["third"]:
+        kind = "addressed to the reader (letter, guide or blog)"
+    else:
+        kind = "prose"
+
+    return (
+        f"{kind}; {pov} person; {formality}; "
+        f"~{round(words_per_sentence)} words per sentence; "
+        f"reading grade ~{max(1, round(grade))}; "
+        f"{round(per_100(c['questions']), 1)} questions per 100 words"
+    )
+
+class StyleProfiles:
+    def __init__(self):
+        self.profiles = TTLCache(maxsize=int(os.getenv("STYLE_CACHE_SIZE", "10000")), ttl=float(os.getenv("STYLE_CACHE_TTL", "3600")))
+        self.loading = {}
+        self.refreshing = {}
+        self.stats = {"loads": 0, "refreshes": 0, "errors": 0}
+        # another worker saved a newer profile, load it again when we next need it
+        broadcast.on("style", lambda user_id, item_id: self.profiles.delete((user_id, item_id)))
+        broadcast.on_reset(self.profiles.clear)
+        item_listeners.append(self.on_item_change)
+        remote_item_listeners.append(self.on_item_change)
+
+    def on_item_change(self, change: str, user_id: str, item_id: str, fields: dict):
+        # the db row goes with the item (omni/helpers.py), the copy in memory goes here
+        if change == "delete":
+            self.profiles.delete((user_id, item_id))
+
+    def get(self, user_id: str, item_id: str) -> str:
+        """
+        The profile description for an item. The first time we see an item its saved profile
+        is loaded in the background, so that call goes without one.
+        """
+        key = (user_id, item_id)
+        profile = self.profiles.get(key)
+        if profile is None and key not in self.loading and key not in self.refreshing:
+            self.loading[key] = asyncio.create_task(self.load(user_id, item_id))
+        return describe(profile)
+
+    async def load(self, user_id: str, item_id: str) -> dict:
+        """
+        The item's profile, from memory or from the db. {} if it doesn't have one yet.
+        """
+        key = (user_id, item_id)
+        profile = self.profiles.get(key)
+        if profile is not None:
+            return profile
+        try:
+            profile = await get_item_style_profile(user_id, item_id) or {}
+            self.stats["loads"] += 1
+        except Exception as e:
+            logger.warning("loading the style profile for %s failed: %s", item_id, e)
+            self.stats["errors"] += 1
+            return {}
+        finally:
+            self.loading.pop(key, None)
+        # a refresh may have finished while we were loading, it's newer
+        if self.profiles.get(key) is None:
+            self.profiles.set(key, profile)
+        return self.profiles.get(key)
+
+    def due(self, profile: dict, content: str) -> bool:
+        if not profile:
+            return True
+        return abs(len(content) - profile.get("analyzed_chars", 0)) >= STYLE_REFRESH_CHARS
+
+    def maybe_refresh(self, user_id: str, item_id: str, content: str):
+        """
+        Start a background refresh of the item's profile if the content has moved on enough.
+        """
+        key = (user_id, item_id)
+        if key in self.refreshing or not self.due(self.profiles.get(key), content):
+            return
+        self.refreshing[key] = asyncio.create_task(self.refresh(user_id, item_id, content))
+
+    async def refresh(self, user_id: str, item_id: str, content: str):
+        key = (user_id, item_id)
+        try:
+            # count on from the saved profile rather than from scratch
+            profile = await self.load(user_id, item_id)
+            if not self.due(profile, content):
+                return
+            profile = update_profile(profile, content)
+            self.profiles.set(key, profile)
+            await set_item_style_profile(user_id, item_id, profile)
+            self.stats["refreshes"] += 1
+        except Exception as e:
+            logger.warning("refreshing the style profile for %s failed: %s", item_id, e)
+            self.stats["errors"] += 1
+        finally:
+            self.refreshing.pop(key, None)
+
+style_profiles = StyleProfiles()
@@ -1,17 +1,19 @@
-from dotenv import load_dotenv
-load_dotenv()
 import os
-from openai import AzureOpenAI
-import json
+import abc
+import hashlib
+import re
 
-client = AzureOpenAI(
-    api_key=os.getenv("AZURE_OPENAI_KEY"),  
-    api_version="2024-10-21",
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-)
+from omni.cache import TTLCache, RedisCache, TieredCache, shared_url
+from omni.metrics import record_tokens, stage
+from .context import build_context
+from .generation import generation_policy, SentenceGate, record_output, stop_reason
+from .llm_router import router
+from .local_model import local_models
 
 #model_name = "gpt-4.1"
-model_name = "gpt-4o-mini"
+# the model the prompt is written for (part of the suggestion cache key).
+# which deployment actually serves a request is up to the router, see llm_router.py
+model_name = os.getenv("AZURE_OPENAI_MODEL", "gpt-4o-mini")
 
 response_format = {
     "type": "json_schema",
@@ -32,6 +34,9 @@ response_format = {
     }
 }
 
+# bump this whenever the instructions change in a way that should invalidate cached suggestions
+INSTRUCTIONS_VERSION = "1"
+
 instructions = """
 You are an export ghost-writing AI providing an auto complete service to assist users in all kinds of writing.
 All "user role" content passed to you will be either the full content or the most recent subsection (if the content is too long to send).
@@ -48,20 +53,371 @@ Based on all of the above criteria, make your best prediction of what the user i
 - limit your prediction to finishing the current sentance + maybe 1-2 more if you are very confident.
 """
 
-def get_suggestions(prompt: str, max_tokens: int = 500) -> dict:
+# Suggestions for recently seen text, so a pause/backspace/retype doesn't cost another model call.
+# Keyed on the tail of the content (see suggestion_cache_key), bounded by entries and bytes,
+# and optionally shared through redis.
+SUGGESTION_CACHE_TAIL_CHARS = int(os.getenv("SUGGESTION_CACHE_TAIL_CHARS", "2000"))
+
+SUGGESTION_CACHE_TTL = float(os.getenv("SUGGESTION_CACHE_TTL", "600"))
+suggestion_cache = TieredCache(
+    TTLCache(
+        maxsize=int(os.getenv("SUGGESTION_CACHE_SIZE", "50000")),
+        ttl=SUGGESTION_CACHE_TTL,
+        max_bytes=int(os.getenv("SUGGESTION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    ),
+    RedisCache(
+        shared_url("SUGGESTION_CACHE_REDIS_URL"),
+        "suggest",
+        ttl=SUGGESTION_CACHE_TTL
+    ) if shared_url("SUGGESTION_CACHE_REDIS_URL") else None
+)
+
+def suggestion_cache_key(prompt: str, profile: str = None, references: str = None) -> str:
     """
-    Get suggestions from the model.
+    Cache key for a prompt: the model, the instructions version, the style profile and
+    related passages (if any) and the normalized trailing context.
+    Runs of whitespace are collapsed (but a trailing space is kept, it changes the prediction).
+    """
+    tail = re.sub(r"\s+", " ", prompt[-SUGGESTION_CACHE_TAIL_CHARS:])
+    key = f"{model_name}\n{INSTRUCTIONS_VERSION}\n{profile or ''}\n{references or ''}\n{tail}"
+    return hashlib.sha256(key.encode()).hexdigest()
+
+async def get_cached_suggestion(key: str):
+    """
+    Look a suggestion up in the local cache, then the shared one.
+    """
+    suggestion = await suggestion_cache.get(key)
+    # callers trim the prediction, so hand out a copy
+    return dict(suggestion) if suggestion is not None else None
+
+async def cache_suggestion(key: str, suggestion: dict):
+    await suggestion_cache.set(key, dict(suggestion))
+
+def suggestion_cache_stats() -> dict:
+    return suggestion_cache.stats()
+
+# The last prediction we handed out for each (user_id, item_id), with the content it was made for.
+# While the user keeps typing along that prediction we can answer with the rest of it locally.
+last_predictions = TTLCache(
+    maxsize=int(os.getenv("LAST_PREDICTION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("LAST_PREDICTION_CACHE_TTL", "900"))
+)
+
+def remember_prediction(key, content: str, prediction: str):
+    """
+    Store the prediction shown for content (after any whitespace trimming).
+    """
+    if prediction:
+        last_predictions.set(key, (content, prediction))
+
+def continue_prediction(key, content: str):
+    """
+    If content is the previous content plus the start of the previous prediction,
+    return the rest of the prediction. Returns None if the user went somewhere else.
+    Matching is case insensitive, like the editor's own trimming.
+    """
+    entry = last_predictions.get(key)
+    if entry is None:
+        return None
+
+    previous_content, prediction = entry
+    if not content.startswith(previous_content):
+        return None
+
+    typed = content[len(previous_content):]
+    if prediction[:len(typed)].lower() != typed.lower():
+        return None
+
+    remaining = prediction[len(typed):]
+    if not remaining.strip():
+        # they typed the whole thing, time for a new prediction
+        return None
+    return remaining
+
+summary_instructions = """
+Summarize the following writing in under 120 words.
+Keep names, terminology, the point of view, the tone and where the text is heading.
+"""
+
+async def summarize_text(text: str) -> str:
     """
-    completion = client.chat.completions.create(
-        model=model_name,
+    Short summary of the earlier part of a long document (see context.build_context).
+    """
+    completion = await router.complete(lambda deployment: deployment.client().chat.completions.create(
+        model=deployment.model,
         messages=[
-            {"role": "system", "content": instructions},
-            {"role": "user", "content": prompt}
+            {"role": "system", "content": summary_instructions},
+            {"role": "user", "content": text}
         ],
-        max_tokens=max_tokens,
-        temperature=1,
+        max_tokens=200,
+        temperature=0
+    ), hedge=False)
+    return completion.choices[0].message.content
+
+usage_stats = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+# with a style profile the model doesn't have to work the style out from the text, so a shorter tail does
+STYLE_TAIL_TOKEN_BUDGET = int(os.getenv("STYLE_TAIL_TOKEN_BUDGET", "600"))
+
+def build_messages(prompt: str, profile: str = None, references: str = None) -> list:
+    """
+    The messages for a prediction: instructions, the style profile, passages from the user's other
+    writing and a summary of the earlier text if we have them, and the most recent part of the content.
+    """
+    budget = STYLE_TAIL_TOKEN_BUDGET if profile else None
+    with stage("context"):
+        context = build_context(prompt, budget=budget, summarize=summarize_text)
+    messages = [{"role": "system", "content": instructions}]
+    if profile:
+        messages.append({"role": "system", "content": "Measured style of the full content (use it instead of inferring style from the excerpt): " + profile})
+    if references:
+        messages.append({"role": "system", "content": "Passages from the user's other writing, for the names, terms and phrasing they use (don't copy them):\n" + references})
+    if context["summary"]:
+        messages.append({"role": "system", "content": "Summary of the earlier part of the content:\n" + context["summary"]})
+    messages.append({"role": "user", "content": context["text"]})
+    return messages
+
+def record_usage(usage):
+    usage_stats["requests"] += 1
+    if usage:
+        usage_stats["prompt_tokens"] += usage.prompt_tokens
+        usage_stats["completion_tokens"] += usage.completion_tokens
+        record_tokens(usage.prompt_tokens, usage.completion_tokens)
+
+async def get_suggestions(prompt: str, max_tokens: int = None, profile: str = None, references: str = None) -> dict:
+    """
+    Get suggestions from the model.
+    The output budget and stop rules come from generation_policy; max_tokens, if given, caps the budget.
+    """
+    key = suggestion_cache_key(prompt, profile, references)
+    cached = await get_cached_suggestion(key)
+    if cached is not None:
+        return cached
+
+    messages = build_messages(prompt, profile, references)
+    policy = generation_policy(prompt, max_tokens)
+    completion = await router.complete(lambda deployment: deployment.client().chat.completions.create(
+        model=deployment.model,
+        messages=messages,
+        max_tokens=policy["max_tokens"],
+        temperature=policy["temperature"],
+        stop=policy["stop"],
         response_format=response_format
-    )
-    return json.loads(completion.choices[0].message.content)
+    ))
+    record_usage(completion.usage)
+
+    # a stop sequence or the token budget can cut the JSON short, so decode it like a stream
+    choice = completion.choices[0]
+    parser = PredictionStream()
+    gate = SentenceGate(policy["max_sentences"], policy["min_confidence"])
+    suggestion = {"prediction": gate.feed(parser.feed(choice.message.content or ""))}
+    record_output(policy, completion.usage.completion_tokens if completion.usage else 0,
+                  stop_reason(choice.finish_reason, parser, gate))
+    await cache_suggestion(key, suggestion)
+    return suggestion
+
+class PredictionStream:
+    """
+    Incrementally pulls the "prediction" string out of a streamed JSON-schema response.
+    The model sends raw JSON text ({"prediction": "...}) in arbitrary fragments,
+    so we decode the string value as it arrives instead of waiting for the whole object.
+    """
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = None  # index of the next undecoded character inside the string value
+        self.done = False
+
+    def feed(self, text: str) -> str:
+        """
+        Add raw model output and return any newly decoded prediction text.
+        """
+        self.buffer += text
+        if self.done:
+            return ""
+
+        if self.pos is None:
+            key = self.buffer.find('"prediction"')
+            if key == -1:
+                return ""
+            rest = self.buffer[key + len('"prediction"'):]
+            stripped = rest.lstrip()
+            if not stripped.startswith(":"):
+                return ""
+            value = stripped[1:].lstrip()
+            if not value.startswith('"'):
+                return ""
+            self.pos = len(self.buffer) - len(value) + 1
+
+        out = []
+        buf = self.buffer
+        i = self.pos
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self.done = True
+                i += 1
+                break
+            if ch == "\\":
+                if i + 1 >= len(buf):
+                    break
+                esc = buf[i + 1]
+                if esc == "u":
+                    if i + 6 > len(buf):
+                        break
+                    code = int(buf[i + 2:i + 6], 16)
+                    if 0xD800 <= code < 0xDC00:
+                        # surrogate pair, wait for the low half before emitting
+                        if i + 12 > len(buf):
+                            break
+                        low = int(buf[i + 8:i + 12], 16)
+                        out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                        i += 12
+                        continue
+                    out.append(chr(code))
+                    i += 6
+                    continue
+                out.append(self.ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            out.append(ch)
+            i += 1
+        self.pos = i
+        return "".join(out)
+
+async def stream_suggestions(prompt: str, max_tokens: int = None, profile: str = None, references: str = None):
+    """
+    Stream suggestions from the model.
+    Yields prediction fragments as soon as the model produces them,
+    and stops at a sentence boundary once the prediction is long enough or the model gets unsure.
+    """
+    key = suggestion_cache_key(prompt, profile, references)
+    cached = await get_cached_suggestion(key)
+    if cached is not None:
+        yield cached["prediction"]
+        return
+
+    messages = build_messages(prompt, profile, references)
+    policy = generation_policy(prompt, max_tokens)
+    options = {"logprobs": True} if policy["logprobs"] else {}
+    stream = await router.open_stream(lambda deployment: deployment.client().chat.completions.create(
+        model=deployment.model,
+        messages=messages,
+        max_tokens=policy["max_tokens"],
+        temperature=policy["temperature"],
+        stop=policy["stop"],
+        response_format=response_format,
+        stream=True,
+        stream_options={"include_usage": True},
+        **options
+    ))
+
+    parser = PredictionStream()
+    gate = SentenceGate(policy["max_sentences"], policy["min_confidence"])
+    prediction = ""
+    usage = None
+    tokens_seen = 0
+    finish_reason = None
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            delta = choice.delta.content
+            if not delta:
+                continue
+            logprobs = None
+            if choice.logprobs and choice.logprobs.content:
+                logprobs = [token.logprob for token in choice.logprobs.content]
+            tokens_seen += len(logprobs) if logprobs else 1
+            # the tokens before the prediction starts are JSON syntax, they'd only inflate the confidence
+            in_prediction = parser.pos is not None
+            fragment = gate.feed(parser.feed(delta), logprobs if in_prediction else None)
+            if fragment:
+                prediction += fragment
+                yield fragment
+            if parser.done or gate.done:
+                break
+    finally:
+        # stop reading from upstream if we finished early or the client went away
+        await stream.close()
+        # usage arrives in the last chunk, which we don't wait for once we stop early
+        record_usage(usage)
+        record_output(policy, usage.completion_tokens if usage else tokens_seen,
+                      stop_reason(finish_reason, parser, gate))
 
-#print(get_suggestions("It was a dark and"))
\ No newline at end of file
+    if parser.done or gate.done or finish_reason in ("stop", "length"):
+        await cache_suggestion(key, {"prediction": prediction})
+
+# Completion backends.
+# A backend either answers a prompt or returns None to let the next one try,
+# so cheap backends go first and the remote model is the last resort.
+LOCAL_MIN_CONFIDENCE = float(os.getenv("LOCAL_MIN_CONFIDENCE", "0.6"))
+LOCAL_MIN_EVIDENCE = int(os.getenv("LOCAL_MIN_EVIDENCE", "3"))
+
+class CompletionBackend(abc.ABC):
+    name = None
+
+    @abc.abstractmethod
+    async def complete(self, prompt: str, user_id: str = None, product_name: str = None, profile: str = None, references: str = None):
+        """
+        Return {"prediction": ...} or None to pass the prompt on.
+        """
+
+class LocalBackend(CompletionBackend):
+    """
+    Word and phrase completions from an n-gram model of the user's own items (see local_model.py).
+    Passes on anything sentence level, or anything it isn't confident about.
+    """
+    name = "local"
+
+    async def complete(self, prompt: str, user_id: str = None, product_name: str = None, profile: str = None, references: str = None):
+        if not user_id or not product_name:
+            return None
+        model = local_models.get(user_id, product_name)
+        if model is None:
+            return None
+        result = model.predict(prompt, LOCAL_MIN_CONFIDENCE, LOCAL_MIN_EVIDENCE)
+        if result is None:
+            return None
+        return {"prediction": result["prediction"]}
+
+class RemoteBackend(CompletionBackend):
+    name = "remote"
+
+    async def complete(self, prompt: str, user_id: str = None, product_name: str = None, profile: str = None, references: str = None):
+        return await get_suggestions(prompt, profile=profile, references=references)
+
+BACKENDS = {backend.name: backend for backend in [LocalBackend(), RemoteBackend()]}
+backend_order = [BACKENDS[name.strip()] for name in os.getenv("SUGGEST_BACKENDS", "local,remote").split(",")]
+backend_stats = {name: 0 for name in BACKENDS}
+
+async def complete_suggestion(prompt: str, user_id: str = None, product_name: str = None, profile: str = None, references: str = None, backends: list = None) -> dict:
+    """
+    Get a suggestion from the first backend that has one.
+    """
+    for backend in backends or backend_order:
+        suggestion = await backend.complete(prompt, user_id, product_name, profile, references)
+        if suggestion is not None:
+            backend_stats[backend.name] += 1
+            return suggestion
+    return {"prediction": ""}
+
+async def complete_before_stream(prompt: str, user_id: str = None, product_name: str = None, profile: str = None, references: str = None) -> dict:
+    """
+    For streaming requests, which stream the remote model themselves: a suggestion from the backends
+    that come before it in backend_order, or None to stream from the model.
+    """
+    for backend in backend_order:
+        if backend.name == "remote":
+            return None
+        suggestion = await backend.complete(prompt, user_id, product_name, profile, references)
+        if suggestion is not None:
+            backend_stats[backend.name] += 1
+            return suggestion
+    # the remote model isn't one of the backends
+    return {"prediction": ""}
@@ -0,0 +1,310 @@
+"""
+Benchmark the API against stand-in upstreams.
+
+    python -m bench.run --workload typing_stream --users 50 --duration 60
+    python -m bench.run --workload mixed --profile degraded --compare
+    python -m bench.run --workload typing --save-baseline
+
+Starts the stand-in servers (python -m bench.stubs) and the app (uvicorn app.main:app, or
+gunicorn with gunicorn.conf.py for --workers > 1) as subprocesses wired to each other, runs the workload's sessions concurrently for --duration
+seconds, and reports throughput, latency percentiles, time to first token for streamed
+suggestions, status codes and upstream calls per request (from the stubs' counters).
+
+--save-baseline stores the summary in bench/baseline.json (per workload and profile),
+--compare prints the change against it and exits with 1 if anything got worse than --tolerance.
+Use --no-servers with --app-url/--stub-port to point at servers you started yourself.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+import jwt
+
+from .stubs.supabase import user_id_for
+from .workloads import WORKLOADS, plan_sessions, typing_session, browse_session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FILE = os.path.join(ROOT, "bench", "baseline.json")
+JWT_SECRET = "bench-jwt-secret-that-is-at-least-32-bytes"
+STUBS = ["supabase", "stripe", "openai"]
+
+def make_token(sub: str, role: str = "authenticated", lifetime: int = 24 * 3600) -> str:
+    now = int(time.time())
+    return jwt.encode({"sub": sub, "aud": "authenticated", "role": role, "iat": now, "exp": now + lifetime},
+                      JWT_SECRET, algorithm="HS256")
+
+def app_env(host: str, stub_port: int, overrides: list) -> dict:
+    env = dict(os.environ)
+    env.update({
+        "SUPABASE_URL": f"http://{host}:{stub_port}",
+        "SUPABASE_SERVICE_KEY": make_token("service", role="service_role"),
+        "SUPABASE_JWT_SECRET": JWT_SECRET,
+        "STRIPE_SECRET_KEY": "sk_test_bench",
+        "STRIPE_API_BASE": f"http://{host}:{stub_port + 1}",
+        "STRIPE_WEBHOOK_SECRET": "whsec_bench",
+        "LLM_DEPLOYMENTS": json.dumps([{
+            "name": "stub", "kind": "openai", "endpoint": f"http://{host}:{stub_port + 2}/v1",
+            "api_key": "bench", "model": "gpt-4o-mini",
+        }]),
+        "LOG_LEVEL": "WARNING",
+    })
+    if not env.get("TIKTOKEN_CACHE_DIR"):
+        # start without the tokenizer rather than not at all, token counts are then estimated
+        env.setdefault("TOKENIZER_REQUIRED", "0")
+    for override in overrides:
+        key, _, value = override.partition("=")
+        env[key] = value
+    return env
+
+async def wait_until_up(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2) as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} did not come up")
+            await asyncio.sleep(0.2)
+
+def start_servers(args) -> list:
+    stubs = subprocess.Popen([
+        sys.executable, "-m", "bench.stubs", "--host", args.host, "--port", str(args.stub_port),
+        "--profile", args.profile, "--users", str(args.users), "--items", str(args.items),
+        "--paid-ratio", str(args.paid_ratio), "--content-chars", str(args.content_chars),
+    ], cwd=ROOT)
+    if args.workers > 1:
+        command = [
+            sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app",
+            "--bind", f"{args.host}:{args.app_port}", "--workers", str(args.workers), "--log-level", "warning",
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "uvicorn", "app.main:app", "--host", args.host, "--port", str(args.app_port),
+            "--log-level", "warning", "--no-access-log",
+        ]
+    app = subprocess.Popen(command, cwd=ROOT, env=app_env(args.host, args.stub_port, args.env))
+    return [stubs, app]
+
+def stop_servers(processes: list):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+async def stub_stats(host: str, port: int, reset: bool = False) -> dict:
+    stats = {}
+    async with httpx.AsyncClient(timeout=5) as client:
+        for offset, name in enumerate(STUBS):
+            base = f"http://{host}:{port + offset}"
+            if reset:
+                await client.post(f"{base}/_reset")
+            else:
+                stats[name] = (await client.get(f"{base}/_stats")).json()
+    return stats
+
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+def summarize(samples: list, elapsed: float, upstream: dict) -> dict:
+    summary = {"requests": len(samples), "elapsed": round(elapsed, 2),
+               "throughput": round(len(samples) / elapsed, 2) if elapsed else 0.0, "kinds": {}}
+    for kind in sorted({s.kind for s in samples}):
+        group = [s for s in samples if s.kind == kind]
+        ok = [s.latency for s in group if s.status == 200]
+        statuses = {}
+        for s in group:
+            statuses[str(s.status)] = statuses.get(str(s.status), 0) + 1
+        entry = {
+            "requests": len(group),
+            "errors": len(group) - len(ok),
+            "statuses": statuses,
+            "p50_ms": ms(percentile(ok, 50)),
+            "p95_ms": ms(percentile(ok, 95)),
+            "p99_ms": ms(percentile(ok, 99)),
+        }
+        ttfts = [s.ttft for s in group if s.ttft is not None]
+        if ttfts:
+            entry["ttft_p50_ms"] = ms(percentile(ttfts, 50))
+            entry["ttft_p95_ms"] = ms(percentile(ttfts, 95))
+        summary["kinds"][kind] = entry
+
+    summary["upstream"] = {}
+    for name, stats in upstream.items():
+        summary["upstream"][name] = {
+            "calls": stats["total"],
+            "errors": stats["errors"],
+            "calls_per_request": round(stats["total"] / len(samples), 3) if samples else 0.0,
+            "routes": stats["calls"],
+        }
+    return summary
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+def print_summary(summary: dict):
+    print(f"\n{summary['requests']} requests in {summary['elapsed']}s, {summary['throughput']} req/s\n")
+    print(f"{'kind':<16}{'reqs':>7}{'errors':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttft50':>9}{'ttft95':>9}")
+    for kind, entry in summary["kinds"].items():
+        print(f"{kind:<16}{entry['requests']:>7}{entry['errors']:>8}"
+              f"{fmt(entry['p50_ms'])}{fmt(entry['p95_ms'])}{fmt(entry['p99_ms'])}"
+              f"{fmt(entry.get('ttft_p50_ms'))}{fmt(entry.get('ttft_p95_ms'))}")
+        if entry["errors"]:
+            print(f"{'':<16}statuses: {entry['statuses']}")
+    print(f"\n{'upstream':<16}{'calls':>7}{'errors':>8}{'per req':>9}")
+    for name, entry in summary["upstream"].items():
+        print(f"{name:<16}{entry['calls']:>7}{entry['errors']:>8}{entry['calls_per_request']:>9}")
+        for route, calls in sorted(entry["routes"].items()):
+            print(f"    {route:<40}{calls:>7}")
+
+def fmt(value) -> str:
+    return f"{'-':>9}" if value is None else f"{value:>9}"
+
+def compared_metrics(summary: dict) -> dict:
+    metrics = {"throughput": (summary["throughput"], True)}
+    for kind, entry in summary["kinds"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms"):
+            if entry.get(key) is not None:
+                metrics[f"{kind}.{key}"] = (entry[key], False)
+        metrics[f"{kind}.error_rate"] = (entry["errors"] / entry["requests"] if entry["requests"] else 0.0, False)
+    for name, entry in summary["upstream"].items():
+        metrics[f"{name}.calls_per_request"] = (entry["calls_per_request"], False)
+    return metrics
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> bool:
+    """
+    Print the change against the baseline. Returns False if something regressed beyond tolerance.
+    """
+    current = compared_metrics(summary)
+    previous = compared_metrics(baseline)
+    ok = True
+    print(f"\n{'metric':<36}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, (value, higher_is_better) in current.items():
+        if name not in previous:
+            continue
+        before = previous[name][0]
+        change = (value - before) / before if before else (0.0 if value == before else float("inf"))
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance and abs(value - before) > 1e-9:
+            flag = "  REGRESSION"
+            ok = False
+        print(f"{name:<36}{round(before, 3):>12}{round(value, 3):>12}{change:>+10.1%}{flag}")
+    return ok
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+async def run_workload(args) -> dict:
+    rng = random.Random(args.seed)
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    samples = []
+    await stub_stats(args.host, args.stub_port, reset=True)
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+    sessions = []
+    clients = []
+    for n, (kind, options) in enumerate(plan_sessions(args.workload, args.users)):
+        user = n % args.users
+        # one client per user, like one browser per user
+        client = httpx.AsyncClient(base_url=args.app_url, limits=limits, timeout=args.timeout,
+                                   headers={"Authorization": f"Bearer {make_token(user_id_for(user))}"})
+        clients.append(client)
+        session_rng = random.Random(rng.random())
+        if kind == "typing":
+            sessions.append(typing_session(client, samples, user, rng.randrange(args.items), options["mode"],
+                                           args.speed, deadline, session_rng))
+        else:
+            sessions.append(browse_session(client, samples, user, args.items, args.speed, deadline, session_rng))
+
+    try:
+        await asyncio.gather(*sessions)
+    finally:
+        for client in clients:
+            await client.aclose()
+    elapsed = time.perf_counter() - started
+    return summarize(samples, elapsed, await stub_stats(args.host, args.stub_port))
+
+async def main_async(args) -> int:
+    processes = []
+    try:
+        if not args.no_servers:
+            processes = start_servers(args)
+        await wait_until_up(f"http://{args.host}:{args.stub_port}/_stats")
+        await wait_until_up(f"{args.app_url}/health")
+
+        summary = await run_workload(args)
+        summary["config"] = {k: getattr(args, k) for k in
+                             ("workload", "profile", "users", "duration", "speed", "items", "paid_ratio", "content_chars", "workers")}
+        print_summary(summary)
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=2)
+
+        key = f"{args.workload}/{args.profile}" + (f"/{args.workers}w" if args.workers > 1 else "")
+        baselines = load_baselines()
+        status = 0
+        if args.compare:
+            if key in baselines:
+                if not compare(summary, baselines[key], args.tolerance):
+                    status = 1
+            else:
+                print(f"\nno baseline for {key} yet, run with --save-baseline")
+        if args.save_baseline:
+            baselines[key] = summary
+            with open(BASELINE_FILE, "w") as f:
+                json.dump(baselines, f, indent=2, sort_keys=True)
+            print(f"\nsaved baseline for {key}")
+        return status
+    finally:
+        stop_servers(processes)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API against stand-in upstreams")
+    parser.add_argument("--workload", choices=sorted(WORKLOADS), default="mixed")
+    parser.add_argument("--profile", default="default", help="fault profile from bench/profiles.json")
+    parser.add_argument("--users", type=int, default=20, help="concurrent sessions")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--speed", type=float, default=4, help="typing speed multiplier (1 = 60 wpm)")
+    parser.add_argument("--items", type=int, default=5, help="items per user")
+    parser.add_argument("--paid-ratio", type=float, default=0.5)
+    parser.add_argument("--content-chars", type=int, default=4000, help="size of the seeded documents")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=1, help="app workers, more than 1 runs gunicorn")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--app-port", type=int, default=18000)
+    parser.add_argument("--stub-port", type=int, default=18101)
+    parser.add_argument("--app-url", default=None, help="defaults to http://host:app-port")
+    parser.add_argument("--no-servers", action="store_true", help="use servers that are already running")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the app")
+    parser.add_argument("--output", help="write the summary as JSON")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression, 0.10 = 10%%")
+    args = parser.parse_args()
+    args.app_url = args.app_url or f"http://{args.host}:{args.app_port}"
+    sys.exit(asyncio.run(main_async(args)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure how long a worker takes to start, and check it against a budget.
+
+    python -m bench.startup --runs 5 --budget 3
+
+Every run is a fresh interpreter that imports app.main and runs the app's lifespan startup, like a
+worker does (without preload). Prints the median import and startup times and the slowest imports
+(from python -X importtime). Exits with 1 if the median total is over --budget seconds.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+
+import asyncio, json
+
+async def start():
+    async with app.main.app.router.lifespan_context(app.main.app):
+        return time.perf_counter()
+
+ready = asyncio.run(start())
+print(json.dumps({"import_seconds": imported - started, "startup_seconds": ready - imported}))
+"""
+
+def slowest_imports(stderr: str, count: int) -> list:
+    """
+    (cumulative seconds, module) of the slowest imports in -X importtime output.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # what the top level modules (app.main, really) import directly, not what those import in turn
+        if name.startswith("   ") and not name.startswith("    "):
+            imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def probe(env: dict, importtime: bool = False) -> tuple:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", PROBE]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f"the app failed to start:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure worker startup time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=float(os.getenv("STARTUP_BUDGET_SECONDS", "3")),
+                        help="seconds for imports plus lifespan startup")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to show")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for the app")
+    args = parser.parse_args()
+
+    env = dict(os.environ, LOG_LEVEL="WARNING")
+    for override in args.env:
+        key, _, value = override.partition("=")
+        env[key] = value
+
+    # the first run warms the OS file cache and writes .pyc files, it doesn't count
+    _, stderr = probe(env, importtime=True)
+    runs = [probe(env)[0] for _ in range(args.runs)]
+
+    imports = statistics.median(r["import_seconds"] for r in runs)
+    startup = statistics.median(r["startup_seconds"] for r in runs)
+    total = imports + startup
+    print(f"imports   {imports:6.3f}s")
+    print(f"startup   {startup:6.3f}s")
+    print(f"total     {total:6.3f}s  (budget {args.budget:.1f}s)")
+    print("\nslowest imports:")
+    for seconds, name in slowest_imports(stderr, args.top):
+        print(f"  {seconds:6.3f}s  {name}")
+
+    if total > args.budget:
+        print(f"\nover budget by {total - args.budget:.3f}s")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
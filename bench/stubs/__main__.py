@@ -0,0 +1,55 @@
+"""
+Run the stand-in servers:
+
+    python -m bench.stubs --profile default --users 200 --items 5
+
+Supabase, stripe and openai listen on --port, --port + 1 and --port + 2.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+
+import uvicorn
+
+from . import openai, stripe, supabase
+from .common import Faults
+
+PROFILES_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "profiles.json")
+
+def load_profile(name: str) -> dict:
+    with open(PROFILES_FILE) as f:
+        return json.load(f)[name]
+
+async def serve(apps: list, host: str):
+    servers = [
+        uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False))
+        for app, port in apps
+    ]
+    await asyncio.gather(*(server.serve() for server in servers))
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in supabase, stripe and openai servers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18101)
+    parser.add_argument("--profile", default="default", help="fault profile from bench/profiles.json")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--items", type=int, default=5, help="items per user")
+    parser.add_argument("--paid-ratio", type=float, default=0.5)
+    parser.add_argument("--content-chars", type=int, default=4000)
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    store = supabase.Store()
+    store.seed(args.users, args.items, args.paid_ratio, args.content_chars)
+
+    apps = [
+        (supabase.build_app(Faults(**profile.get("supabase", {})), store), args.port),
+        (stripe.build_app(Faults(**profile.get("stripe", {}))), args.port + 1),
+        (openai.build_app(Faults(**profile.get("openai", {}))), args.port + 2),
+    ]
+    asyncio.run(serve(apps, args.host))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Shared bits for the stand-in servers: fault injection and call counting.
+
+Every stub is a small FastAPI app wrapped in FaultMiddleware, which delays each request
+(latency_ms plus an exponential jitter with mean jitter_ms), fails a fraction of them
+(error_rate, with error_status), and counts calls per route. Every stub also has:
+    GET  /_stats    {"calls": {"GET /rest/v1/{table}": 12, ...}, "total": 12, "errors": 0}
+    POST /_reset    zero the counters
+    POST /_faults   change the fault settings while running (same keys as Faults)
+"""
+
+import asyncio
+import json
+import random
+
+from fastapi import FastAPI, Request
+
+class Faults:
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0.0,
+                 error_status: int = 503, retry_after: float = None, **extra):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        # stub specific settings (ttft_ms, token_ms, ...)
+        self.extra = extra
+
+    def update(self, settings: dict):
+        for key, value in settings.items():
+            if hasattr(self, key) and key != "extra":
+                setattr(self, key, value)
+            else:
+                self.extra[key] = value
+
+    def get(self, key: str, default=None):
+        return self.extra.get(key, default)
+
+    async def delay(self):
+        seconds = self.latency_ms / 1000
+        if self.jitter_ms:
+            seconds += random.expovariate(1000 / self.jitter_ms)
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+class CallCounter:
+    def __init__(self):
+        self.calls = {}
+        self.errors = 0
+
+    def count(self, key: str):
+        self.calls[key] = self.calls.get(key, 0) + 1
+
+    def stats(self) -> dict:
+        return {"calls": dict(self.calls), "total": sum(self.calls.values()), "errors": self.errors}
+
+    def reset(self):
+        self.calls = {}
+        self.errors = 0
+
+class FaultMiddleware:
+    def __init__(self, app, faults: Faults, counter: CallCounter):
+        self.app = app
+        self.faults = faults
+        self.counter = counter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/_"):
+            return await self.app(scope, receive, send)
+
+        await self.faults.delay()
+        if self.faults.should_fail():
+            self.counter.count(f"{scope['method']} {scope['path']}")
+            self.counter.errors += 1
+            headers = [(b"content-type", b"application/json")]
+            if self.faults.retry_after is not None:
+                headers.append((b"retry-after", str(self.faults.retry_after).encode()))
+            await send({"type": "http.response.start", "status": self.faults.error_status, "headers": headers})
+            await send({"type": "http.response.body", "body": json.dumps({"error": {"message": "injected fault"}}).encode()})
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            route = scope.get("route")
+            self.counter.count(f"{scope['method']} {getattr(route, 'path', scope['path'])}")
+
+def stub_app(faults: Faults) -> FastAPI:
+    """
+    A FastAPI app with fault injection, call counting and the /_ control endpoints.
+    """
+    app = FastAPI()
+    counter = CallCounter()
+    app.state.faults = faults
+    app.state.counter = counter
+    app.add_middleware(FaultMiddleware, faults=faults, counter=counter)
+
+    @app.get("/_stats")
+    async def stats():
+        return counter.stats()
+
+    @app.post("/_reset")
+    async def reset():
+        counter.reset()
+        return {"status": "ok"}
+
+    @app.post("/_faults")
+    async def set_faults(request: Request):
+        faults.update(await request.json())
+        return {"status": "ok"}
+
+    return app
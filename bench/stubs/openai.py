@@ -0,0 +1,131 @@
+"""
+Stand-in for an OpenAI compatible chat completions API (point an LLM_DEPLOYMENTS entry with
+"kind": "openai" at it).
+
+Answers predictions (requests with a response_format) with a JSON {"prediction": ...} made of a
+couple of canned sentences, and anything else (summaries) with plain text. Supports streaming
+(with logprobs and the include_usage chunk), max_tokens and stop sequences.
+
+Timing comes from the fault settings: ttft_ms before the first token, then token_ms per token.
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from .common import Faults, stub_app
+
+SENTENCES = [
+    "the rain had finally stopped by the time we got to the station.",
+    "she looked at the map again and sighed.",
+    "nobody had told us the bridge was closed for repairs.",
+    "it was the kind of quiet that makes you listen harder.",
+    "we would have to make a decision before dark.",
+    "the letter was still in my pocket, unopened.",
+    "he laughed, but it did not sound like he meant it.",
+    "there was nothing to do but wait for the morning.",
+]
+
+def tokenize(text: str) -> list:
+    """
+    Rough tokens: about four characters each, like the real thing on average.
+    """
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+def prediction_for(messages: list) -> str:
+    last = next((m.get("content") or "" for m in reversed(messages) if m.get("role") == "user"), "")
+    digest = int(hashlib.sha256(last.encode()).hexdigest(), 16)
+    first = SENTENCES[digest % len(SENTENCES)]
+    second = SENTENCES[(digest // len(SENTENCES)) % len(SENTENCES)]
+    text = f"{first} {second[0].upper()}{second[1:]}"
+    return text if last.endswith((" ", "\n")) or not last else " " + text
+
+def answer_text(body: dict) -> str:
+    messages = body.get("messages") or []
+    if body.get("response_format"):
+        return json.dumps({"prediction": prediction_for(messages)})
+    return "A short summary of the earlier part of the text."
+
+def prompt_tokens(body: dict) -> int:
+    return sum(len(str(m.get("content") or "")) for m in body.get("messages") or []) // 4 + 1
+
+def limit_tokens(body: dict, tokens: list):
+    """
+    Apply stop sequences and max_tokens. Returns (tokens, finish_reason).
+    """
+    text = "".join(tokens)
+    stops = body.get("stop") or []
+    if isinstance(stops, str):
+        stops = [stops]
+    cut = min([text.find(s) for s in stops if s and s in text], default=-1)
+    finish_reason = "stop"
+    if cut != -1:
+        tokens = tokenize(text[:cut])
+    max_tokens = body.get("max_tokens") or body.get("max_completion_tokens")
+    if max_tokens and len(tokens) > max_tokens:
+        tokens = tokens[:max_tokens]
+        finish_reason = "length"
+    return tokens, finish_reason
+
+def build_app(faults: Faults):
+    app = stub_app(faults)
+
+    @app.post("/v1/chat/completions")
+    @app.post("/openai/deployments/{deployment}/chat/completions")
+    async def chat_completions(request: Request, deployment: str = None):
+        body = await request.json()
+        model = body.get("model") or deployment or "stub"
+        tokens, finish_reason = limit_tokens(body, tokenize(answer_text(body)))
+        ttft = faults.get("ttft_ms", 200) / 1000
+        per_token = faults.get("token_ms", 10) / 1000
+        logprob = faults.get("logprob", -0.2)
+        usage = {"prompt_tokens": prompt_tokens(body), "completion_tokens": len(tokens),
+                 "total_tokens": prompt_tokens(body) + len(tokens)}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(ttft + per_token * len(tokens))
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": finish_reason, "logprobs": None}],
+                "usage": usage,
+            }
+
+        want_logprobs = bool(body.get("logprobs"))
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def chunk(delta: dict, finish: str = None, token: str = None, with_usage: bool = False) -> str:
+            choice = {"index": 0, "delta": delta, "finish_reason": finish, "logprobs": None}
+            if token is not None and want_logprobs:
+                choice["logprobs"] = {"content": [{"token": token, "logprob": logprob, "bytes": None, "top_logprobs": []}]}
+            data = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                    "choices": [] if with_usage else [choice]}
+            if with_usage:
+                data["usage"] = usage
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            await asyncio.sleep(ttft)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(per_token)
+                yield chunk({"content": token}, token=token)
+            yield chunk({}, finish=finish_reason)
+            if include_usage:
+                yield chunk({}, with_usage=True)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
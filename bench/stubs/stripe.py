@@ -0,0 +1,54 @@
+"""
+Stand-in for the stripe API: subscriptions and checkout sessions, enough for omni's helpers.
+Every subscription exists and is active, unless its id contains "canceled".
+"""
+
+import time
+import uuid
+
+from fastapi import Request
+
+from .common import Faults, stub_app
+
+def subscription(sub_id: str) -> dict:
+    period_end = int(time.time()) + 30 * 24 * 3600
+    return {
+        "id": sub_id,
+        "object": "subscription",
+        "status": "canceled" if "canceled" in sub_id else "active",
+        "cancel_at_period_end": False,
+        "customer": "cus_bench",
+        "created": int(time.time()) - 3600,
+        "current_period_end": period_end,
+        "items": {"object": "list", "data": [{"id": "si_bench", "object": "subscription_item",
+                                              "current_period_end": period_end}]},
+    }
+
+def checkout_session(session_id: str, expand_subscription: bool) -> dict:
+    sub_id = "sub_" + session_id.removeprefix("cs_")
+    return {
+        "id": session_id,
+        "object": "checkout.session",
+        "mode": "subscription",
+        "status": "complete",
+        "url": f"https://checkout.stripe.com/c/pay/{session_id}",
+        "subscription": subscription(sub_id) if expand_subscription else sub_id,
+    }
+
+def build_app(faults: Faults):
+    app = stub_app(faults)
+
+    @app.get("/v1/subscriptions/{sub_id}")
+    async def get_subscription(sub_id: str):
+        return subscription(sub_id)
+
+    @app.post("/v1/checkout/sessions")
+    async def create_checkout_session():
+        return checkout_session(f"cs_bench_{uuid.uuid4().hex[:16]}", False)
+
+    @app.get("/v1/checkout/sessions/{session_id}")
+    async def get_checkout_session(session_id: str, request: Request):
+        expand = request.query_params.getlist("expand[]") + request.query_params.getlist("expand[0]")
+        return checkout_session(session_id, "subscription" in expand)
+
+    return app
@@ -0,0 +1,312 @@
+"""
+Stand-in for supabase: the bits of PostgREST (/rest/v1) and GoTrue (/auth/v1) that omni uses,
+over in-memory tables.
+
+PostgREST support: select (columns or *), eq/neq/lt/lte/gt/gte/like/is/in filters, not.,
+or=(...)/and(...) trees, order (several columns), limit/offset, single object responses
+(Accept: application/vnd.pgrst.object+json), Prefer: count=exact (Content-Range, HEAD),
+insert/upsert (on_conflict + resolution=merge-duplicates), update and delete.
+"""
+
+from datetime import datetime, timezone
+import base64
+import json
+import random
+import uuid
+
+from fastapi import Request, Response
+from fastapi.responses import JSONResponse
+
+from .common import Faults, stub_app
+
+PRODUCT = "writer"
+RESERVED_PARAMS = {"select", "order", "limit", "offset", "on_conflict", "columns"}
+TABLE_KEYS = {
+    "user_items": ["item_id"],
+    "user_settings": ["user_id", "product_name"],
+    "user_products": ["user_id", "product_name"],
+    "item_style_profiles": ["user_id", "item_id"],
+}
+
+SAMPLE_TEXT = (
+    "The morning fog had not yet lifted when we reached the harbor. Fishing boats rocked against "
+    "the pier, and somewhere a gull complained about the weather. I had promised my sister that "
+    "we would be home before dinner, but the ferry schedule had other ideas.\n\n"
+    "We found a cafe near the water and ordered coffee. The owner told us the ferry was often late "
+    "in autumn, when the currents changed and the captain liked to take the long way around the "
+    "point. She said it as if it were a law of nature, and maybe it was.\n\n"
+)
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+def with_timestamps(values: dict) -> dict:
+    """
+    Postgres turns a "now()" value into the current time (we write updated_at that way), so do the same.
+    """
+    return {key: now() if value == "now()" else value for key, value in values.items()}
+
+def user_id_for(n: int) -> str:
+    return f"00000000-0000-4000-8000-{n:012d}"
+
+def item_id_for(n: int, i: int) -> str:
+    return f"{n:08d}-0000-4000-9000-{i:012d}"
+
+class Store:
+    def __init__(self):
+        self.tables = {name: [] for name in TABLE_KEYS}
+
+    def seed(self, users: int, items_per_user: int, paid_ratio: float, content_chars: int, seed: int = 1):
+        """
+        Deterministic users/items, so the load generator can work out the ids by itself.
+        """
+        rng = random.Random(seed)
+        period_end = int(datetime.now(timezone.utc).timestamp()) + 30 * 24 * 3600
+        for n in range(users):
+            user_id = user_id_for(n)
+            if n < users * paid_ratio:
+                sub_id = f"sub_bench_{n}"
+                self.tables["user_products"].append({
+                    "user_id": user_id,
+                    "product_name": PRODUCT,
+                    "stripe_sub_id": sub_id,
+                    "subscription": {
+                        "id": sub_id,
+                        "status": "active",
+                        "cancel_at_period_end": False,
+                        "current_period_end": period_end,
+                        "updated": int(datetime.now(timezone.utc).timestamp()),
+                    },
+                })
+            self.tables["user_settings"].append({"user_id": user_id, "product_name": PRODUCT, "settings": {}})
+            for i in range(items_per_user):
+                repeats = content_chars // len(SAMPLE_TEXT) + 1
+                content = (SAMPLE_TEXT * repeats)[:rng.randint(content_chars // 2, content_chars)] if content_chars else ""
+                self.tables["user_items"].append({
+                    "item_id": item_id_for(n, i),
+                    "user_id": user_id,
+                    "product_name": PRODUCT,
+                    "item_type": "document",
+                    "item_meta": {"title": f"Document {i}"},
+                    "item_content": content,
+                    "created_at": now(),
+                    "updated_at": now(),
+                })
+
+def unquote(value: str) -> str:
+    if len(value) >= 2 and value[0] == '"' and value[-1] == '"':
+        return value[1:-1].replace('\\"', '"')
+    return value
+
+def split_top(text: str) -> list:
+    """
+    Split on commas that are not inside parentheses or quotes.
+    """
+    parts, depth, quoted, current = [], 0, False, ""
+    for ch in text:
+        if ch == '"':
+            quoted = not quoted
+        elif not quoted and ch == "(":
+            depth += 1
+        elif not quoted and ch == ")":
+            depth -= 1
+        if ch == "," and depth == 0 and not quoted:
+            parts.append(current)
+            current = ""
+        else:
+            current += ch
+    if current:
+        parts.append(current)
+    return parts
+
+def compare(row_value, op: str, value: str) -> bool:
+    if op == "is":
+        return (row_value is None) if value == "null" else (str(row_value).lower() == value)
+    if op == "in":
+        return str(row_value) in [unquote(v) for v in split_top(value.strip("()"))]
+    if row_value is None:
+        return False
+    value = unquote(value)
+    row_value = row_value if isinstance(row_value, str) else json.dumps(row_value) if isinstance(row_value, (dict, list)) else str(row_value)
+    if op == "eq":
+        return row_value == value
+    if op == "neq":
+        return row_value != value
+    if op == "lt":
+        return row_value < value
+    if op == "lte":
+        return row_value <= value
+    if op == "gt":
+        return row_value > value
+    if op == "gte":
+        return row_value >= value
+    if op in ("like", "ilike"):
+        pattern = value.replace("*", "%")
+        a, b = (row_value, pattern) if op == "like" else (row_value.lower(), pattern.lower())
+        if b.startswith("%") and b.endswith("%"):
+            return b.strip("%") in a
+        if b.endswith("%"):
+            return a.startswith(b.rstrip("%"))
+        if b.startswith("%"):
+            return a.endswith(b.lstrip("%"))
+        return a == b
+    raise ValueError(f"unsupported operator {op}")
+
+def parse_condition(column: str, expression: str):
+    negate = expression.startswith("not.")
+    if negate:
+        expression = expression[4:]
+    op, _, value = expression.partition(".")
+    def check(row):
+        result = compare(row.get(column), op, value)
+        return not result if negate else result
+    return check
+
+def parse_tree(kind: str, body: str):
+    """
+    A condition for or=(...) / and=(...) bodies, which can nest.
+    """
+    checks = []
+    for term in split_top(body.strip()[1:-1]):
+        term = term.strip()
+        if term.startswith("and(") or term.startswith("or("):
+            nested_kind, _, rest = term.partition("(")
+            checks.append(parse_tree(nested_kind, "(" + rest))
+        else:
+            column, _, expression = term.partition(".")
+            checks.append(parse_condition(column, expression))
+    if kind == "or":
+        return lambda row: any(check(row) for check in checks)
+    return lambda row: all(check(row) for check in checks)
+
+def parse_filters(params: list) -> list:
+    checks = []
+    for key, value in params:
+        if key in RESERVED_PARAMS:
+            continue
+        if key in ("or", "and"):
+            checks.append(parse_tree(key, value))
+        else:
+            checks.append(parse_condition(key, value))
+    return checks
+
+def project(row: dict, select: str) -> dict:
+    if not select or select.strip() == "*":
+        return dict(row)
+    columns = [c.strip() for c in select.split(",") if c.strip()]
+    return {c: row.get(c) for c in columns}
+
+def sort_rows(rows: list, orders: list) -> list:
+    for order in reversed(orders):
+        parts = order.split(".")
+        column = parts[0]
+        desc = "desc" in parts[1:]
+        present = [r for r in rows if r.get(column) is not None]
+        missing = [r for r in rows if r.get(column) is None]
+        present.sort(key=lambda r: r[column], reverse=desc)
+        rows = present + missing
+    return rows
+
+def pgrst_error(status: int, code: str, message: str, details: str = None):
+    return JSONResponse({"code": code, "message": message, "details": details, "hint": None}, status_code=status)
+
+def respond(request: Request, rows: list, total: int = None, status: int = 200):
+    headers = {}
+    prefer = request.headers.get("prefer", "")
+    if "count=" in prefer:
+        total = len(rows) if total is None else total
+        headers["Content-Range"] = f"0-{len(rows) - 1}/{total}" if rows else f"*/{total}"
+    if request.method == "HEAD":
+        return Response(status_code=status, headers=headers)
+    if "vnd.pgrst.object+json" in request.headers.get("accept", ""):
+        if len(rows) != 1:
+            return pgrst_error(406, "PGRST116", "JSON object requested, multiple (or no) rows returned",
+                               f"The result contains {len(rows)} rows")
+        return JSONResponse(rows[0], status_code=status, headers=headers)
+    if request.method in ("POST", "PATCH", "DELETE") and "return=minimal" in prefer:
+        return Response(status_code=204 if request.method != "POST" else 201, headers=headers)
+    return JSONResponse(rows, status_code=status, headers=headers)
+
+def build_app(faults: Faults, store: Store):
+    app = stub_app(faults)
+
+    @app.api_route("/rest/v1/{table}", methods=["GET", "HEAD", "POST", "PATCH", "DELETE"])
+    async def rest(table: str, request: Request):
+        if table not in store.tables:
+            return pgrst_error(404, "42P01", f'relation "public.{table}" does not exist')
+        rows = store.tables[table]
+        params = list(request.query_params.multi_items())
+        select = request.query_params.get("select", "*")
+        try:
+            checks = parse_filters(params)
+        except ValueError as e:
+            return pgrst_error(400, "PGRST100", str(e))
+        matched = [row for row in rows if all(check(row) for check in checks)]
+
+        if request.method in ("GET", "HEAD"):
+            orders = [o for key, value in params if key == "order" for o in value.split(",")]
+            matched = sort_rows(matched, orders)
+            total = len(matched)
+            offset = int(request.query_params.get("offset", 0))
+            limit = request.query_params.get("limit")
+            matched = matched[offset:offset + int(limit)] if limit is not None else matched[offset:]
+            return respond(request, [project(r, select) for r in matched], total)
+
+        if request.method == "POST":
+            body = await request.json()
+            records = body if isinstance(body, list) else [body]
+            upsert = "merge-duplicates" in request.headers.get("prefer", "")
+            conflict = request.query_params.get("on_conflict")
+            keys = conflict.split(",") if conflict else TABLE_KEYS[table]
+            out = []
+            for record in records:
+                record = with_timestamps(record)
+                if table == "user_items":
+                    record.setdefault("item_id", str(uuid.uuid4()))
+                    record.setdefault("created_at", now())
+                    record.setdefault("updated_at", now())
+                existing = next((r for r in rows if all(r.get(k) == record.get(k) for k in keys)), None)
+                if existing is not None and upsert:
+                    existing.update(record)
+                    out.append(existing)
+                elif existing is not None and table != "user_items":
+                    return pgrst_error(409, "23505", "duplicate key value violates unique constraint")
+                else:
+                    rows.append(record)
+                    out.append(record)
+            return respond(request, [project(r, select) for r in out], status=201)
+
+        if request.method == "PATCH":
+            changes = with_timestamps(await request.json())
+            for row in matched:
+                row.update(changes)
+            return respond(request, [project(r, select) for r in matched])
+
+        # DELETE
+        store.tables[table] = [row for row in rows if row not in matched]
+        return respond(request, [project(r, select) for r in matched])
+
+    @app.get("/auth/v1/user")
+    async def auth_user(request: Request):
+        token = request.headers.get("authorization", "").removeprefix("Bearer ").strip()
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        except (IndexError, ValueError):
+            return JSONResponse({"code": 401, "msg": "invalid JWT"}, status_code=401)
+        return {
+            "id": claims.get("sub"),
+            "aud": claims.get("aud", "authenticated"),
+            "role": claims.get("role", "authenticated"),
+            "email": claims.get("email"),
+            "app_metadata": {},
+            "user_metadata": {},
+            "created_at": now(),
+        }
+
+    @app.get("/auth/v1/.well-known/jwks.json")
+    async def jwks():
+        # HS256 projects publish no public keys
+        return {"keys": []}
+
+    return app
@@ -0,0 +1,195 @@
+"""
+Scripted workloads for the benchmark.
+
+A typing session opens a document, then types a passage into it word by word at a human-ish
+speed (scaled by --speed), asking for a suggestion the way the editor does: at the end of every
+sentence and at some of the pauses between words. Now and then the "user" accepts the start of a
+prediction instead of typing their own word, which exercises the continuation path.
+
+Sessions send the content in one of three ways:
+    full     the whole content, saved (the original editor behaviour)
+    patch    ops against the last version, falling back to the full content on a 409
+    stream   the whole content, streamed NDJSON predictions (measures time to first token)
+"""
+
+import asyncio
+import json
+import random
+import time
+
+from .stubs.supabase import item_id_for
+
+PASSAGES = [
+    "I never meant to stay in the village for more than a week. The train only stopped there twice a day, "
+    "and the hotel had three rooms, two of which were always being repainted. But on the second morning "
+    "I met the woman who ran the bookshop, and she asked me to help her sort a box of old letters. "
+    "By the end of the week I had read most of them, and I wanted to know how the story ended.",
+    "Dear Sam, thank you for the photos from the trip. The one of the lighthouse is my favourite, "
+    "although I think you were standing a little too close to the edge. We are all well here. "
+    "The garden is finally growing again after the long winter, and the dog has discovered that "
+    "the neighbours keep chickens. I will tell you more about that when you call on Sunday.",
+    "To install the tool, download the latest release and unpack it somewhere on your path. "
+    "Then run the setup command once to create a configuration file in your home directory. "
+    "Most settings can be left alone, but you will want to change the output folder. "
+    "If anything goes wrong, run the command again with the verbose flag and send us the log.",
+]
+
+CHARS_PER_SECOND = 5.0    # about 60 words per minute
+PAUSE_PROBABILITY = 0.35  # chance of a pause long enough to trigger a suggestion after a word
+ACCEPT_PROBABILITY = 0.25 # chance of typing the first word of the last prediction
+
+class Sample:
+    __slots__ = ("kind", "status", "latency", "ttft", "started")
+
+    def __init__(self, kind: str, status: int, latency: float, ttft: float = None, started: float = 0.0):
+        self.kind = kind
+        self.status = status
+        self.latency = latency
+        self.ttft = ttft
+        self.started = started
+
+async def timed_request(client, samples: list, kind: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, url, **kwargs)
+    except Exception:
+        samples.append(Sample(kind, 0, time.perf_counter() - started, started=started))
+        return None
+    samples.append(Sample(kind, response.status_code, time.perf_counter() - started, started=started))
+    return response
+
+async def stream_request(client, samples: list, url: str, body: dict):
+    """
+    POST a streaming suggest request. Returns the full prediction and the done line.
+    """
+    started = time.perf_counter()
+    ttft = None
+    prediction = ""
+    done = {}
+    status = 0
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            status = response.status_code
+            if status == 200:
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    message = json.loads(line)
+                    if message.get("prediction") and ttft is None:
+                        ttft = time.perf_counter() - started
+                    prediction += message.get("prediction", "")
+                    if message.get("done"):
+                        done = message
+            else:
+                await response.aread()
+    except Exception:
+        status = 0
+    samples.append(Sample("suggest_stream", status, time.perf_counter() - started, ttft, started=started))
+    return prediction if status == 200 else None, done
+
+async def pause(chars: int, speed: float, rng: random.Random):
+    seconds = chars / CHARS_PER_SECOND / speed
+    await asyncio.sleep(seconds * rng.uniform(0.7, 1.3))
+
+async def typing_session(client, samples: list, user: int, item: int, mode: str,
+                         speed: float, deadline: float, rng: random.Random):
+    """
+    Type into one document until the deadline.
+    """
+    item_id = item_id_for(user, item)
+    response = await timed_request(client, samples, "get_item", "GET", f"/items/{item_id}",
+                                   params={"include_content": "true"})
+    if response is None or response.status_code != 200 or not response.json():
+        return
+    document = response.json()
+    content = document.get("item_content") or ""
+    version = document.get("version")
+    # the content the server has as version (words typed since are sent with the next patch)
+    synced = content
+    # the first word needs a space if the document doesn't end with one
+    separator = " " if content and not content.endswith((" ", "\n")) else ""
+
+    passage_words = rng.choice(PASSAGES).split(" ")
+    position = 0
+    last_prediction = ""
+    while time.perf_counter() < deadline:
+        # the next word: either the user's own or the start of the last prediction
+        word = passage_words[position % len(passage_words)]
+        position += 1
+        accepted = last_prediction.strip().split(" ")[0] if last_prediction.strip() else ""
+        if accepted and rng.random() < ACCEPT_PROBABILITY:
+            word = accepted
+        typed = separator + word + " "
+        separator = ""
+        await pause(len(typed), speed, rng)
+        content += typed
+
+        if not (word.endswith((".", "!", "?")) or rng.random() < PAUSE_PROBABILITY):
+            continue
+
+        if mode == "stream":
+            prediction, done = await stream_request(client, samples, f"/items/{item_id}/suggest",
+                                                    {"content": content, "save_content": True, "stream": True})
+            last_prediction = prediction or ""
+            version = done.get("version", version)
+            continue
+
+        if mode == "patch" and version:
+            # everything typed since the last request, not just the last word
+            body = {"base_version": version, "ops": [{"pos": len(synced), "delete": 0, "insert": content[len(synced):]}]}
+        else:
+            body = {"content": content, "save_content": True}
+        response = await timed_request(client, samples, "suggest", "POST", f"/items/{item_id}/suggest", json=body)
+        if response is not None and response.status_code == 409:
+            # our version was stale, resend everything
+            body = {"content": content, "save_content": True}
+            response = await timed_request(client, samples, "suggest", "POST", f"/items/{item_id}/suggest", json=body)
+        if response is not None and response.status_code == 200:
+            result = response.json()
+            last_prediction = result.get("prediction") or ""
+            version = result.get("version", version)
+            synced = content
+        else:
+            last_prediction = ""
+            # a patch may have been applied before the request failed, so we no longer know the
+            # server's version: the next request sends the full content, which gets us a new one
+            version = None
+
+async def browse_session(client, samples: list, user: int, items: int, speed: float,
+                         deadline: float, rng: random.Random):
+    """
+    Flip through the document list and open documents.
+    """
+    while time.perf_counter() < deadline:
+        await timed_request(client, samples, "list_items", "GET", "/items",
+                            params={"include_meta": "true", "limit": "50"})
+        await pause(10, speed, rng)
+        item_id = item_id_for(user, rng.randrange(items))
+        await timed_request(client, samples, "get_item", "GET", f"/items/{item_id}",
+                            params={"include_meta": "true", "include_content": "true"})
+        await pause(20, speed, rng)
+
+# workload name -> list of (share of sessions, session kind, options)
+WORKLOADS = {
+    "typing": [(1.0, "typing", {"mode": "full"})],
+    "typing_patch": [(1.0, "typing", {"mode": "patch"})],
+    "typing_stream": [(1.0, "typing", {"mode": "stream"})],
+    "browse": [(1.0, "browse", {})],
+    "mixed": [
+        (0.6, "typing", {"mode": "stream"}),
+        (0.3, "typing", {"mode": "patch"}),
+        (0.1, "browse", {}),
+    ],
+}
+
+def plan_sessions(workload: str, users: int) -> list:
+    """
+    (session kind, options) for each of the concurrent users.
+    """
+    plan = []
+    for share, kind, options in WORKLOADS[workload]:
+        plan += [(kind, options)] * round(share * users)
+    _, kind, options = WORKLOADS[workload][0]
+    while len(plan) < users:
+        plan.append((kind, options))
+    return plan[:users]
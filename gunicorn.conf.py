@@ -0,0 +1,58 @@
+"""
+Production server settings, for running several workers on one host:
+
+    gunicorn -c gunicorn.conf.py app.main:app
+
+- one uvicorn worker per core when REDIS_URL is set, otherwise a single worker (WEB_CONCURRENCY to override).
+  The documents that patches are applied to (app/documents.py) have to be shared between workers,
+  and without redis each worker would have its own.
+- the app is imported once in the master and the workers are forked from it (PRELOAD_APP=0 to turn off),
+  so a worker starts with the modules and the tokenizer already loaded. Clients (http pools, supabase,
+  redis) are only made inside the workers, on first use or in the lifespan.
+- with REDIS_URL the workers also share the auth, entitlement and suggestion caches and the rate limits,
+  and tell each other about item, settings and style profile writes (the broadcast in omni/helpers.py),
+  so their cached rows, search indexes and profiles follow the other workers' writes.
+- on SIGTERM a worker stops accepting connections, finishes the requests it has (streams included) for up
+  to DRAIN_SECONDS, and then runs the lifespan shutdown, which saves queued content
+- prometheus metrics are collected across workers in PROMETHEUS_MULTIPROC_DIR
+"""
+
+import multiprocessing
+import os
+import shutil
+
+# imported for its side effect: it loads .env, which may set the REDIS_URL read below
+import omni  # noqa: F401
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+# the documents and the broadcast of writes both have to go through redis
+shared = bool(os.getenv("REDIS_URL") or (os.getenv("DOCUMENT_REDIS_URL") and os.getenv("BROADCAST_REDIS_URL")))
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() if shared else 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("PRELOAD_APP", "1") == "1"
+graceful_timeout = int(os.getenv("DRAIN_SECONDS", "30"))
+timeout = 60
+# longer than the load balancer's idle timeout, so it never reuses a connection we are closing
+keepalive = 75
+
+# has to be set before prometheus_client is imported, which with preload_app is right after this file
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join("/tmp", f"prometheus-{os.getpid()}"))
+
+def on_starting(server):
+    # metrics files of a previous run would be added to ours
+    directory = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory, exist_ok=True)
+
+def when_ready(server):
+    if preload_app:
+        # load the tokenizer in the master, so every worker gets it with the fork
+        from app.context import get_encoding
+        get_encoding()
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+def on_exit(server):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
@@ -0,0 +1,4 @@
+# Settings come from the environment, read with os.getenv when a module is imported.
+# .env is loaded here, once, since every module imports omni before it reads any.
+from dotenv import load_dotenv
+load_dotenv()
@@ -0,0 +1,368 @@
+"""
+Small in-process caches used by the helpers.
+
+TTLCache is an LRU dict where every entry also expires after a ttl.
+It can optionally be capped by (approximate) memory as well as entry count.
+It keeps hit/miss counters so we can see whether a cache is actually pulling its weight.
+Everything runs on the event loop, so there is no locking.
+
+RedisCache is an optional shared layer (async, JSON values) for state that should survive restarts
+or be shared between workers. It needs the redis package, and it swallows errors -
+a cache that is down should make us slower, not broken.
+TieredCache puts a TTLCache in front of a RedisCache, so most lookups stay in process
+while every worker still gets what any of them has looked up.
+Broadcast tells the other workers about writes over redis pub/sub, for in-process state that can't
+live in redis (search indexes, cached rows that are read on every request) and has to be dropped or
+updated when another worker changes the data behind it.
+
+Redis clients are made on first use, one per url per worker (get_redis), and closed by close_redis()
+at shutdown. REDIS_URL is the default for every shared cache; each can be pointed elsewhere with its own setting.
+"""
+
+import asyncio
+from collections import OrderedDict
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+_MISSING = object()
+_redis_clients = {}
+
+def shared_url(setting: str):
+    """
+    The redis url for a shared cache: its own setting, or REDIS_URL.
+    """
+    return os.getenv(setting) or REDIS_URL
+
+def get_redis(url: str):
+    """
+    This worker's client for url. Made on first use rather than at import, so a master process that
+    imports the app before forking (gunicorn preload_app) doesn't hand its connections to every worker.
+    """
+    client = _redis_clients.get(url)
+    if client is None:
+        client = _redis_clients[url] = aioredis.from_url(url)
+    return client
+
+async def close_redis():
+    for url in list(_redis_clients):
+        try:
+            await _redis_clients.pop(url).aclose()
+        except Exception as e:
+            logger.warning("closing redis client failed: %s", e)
+
+def approx_size(value) -> int:
+    """
+    Rough byte size of a cached value. Good enough for keeping a memory ceiling.
+    """
+    if isinstance(value, (str, bytes)):
+        return sys.getsizeof(value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(k) + approx_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approx_size(v) for v in value)
+    return sys.getsizeof(value)
+
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60, max_bytes: int = None, sizeof=approx_size):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._data = OrderedDict()  # key -> (expires_at, value, size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Get a value, or default if it is missing or expired.
+        """
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+
+        expires_at, value, size = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """
+        Store a value. ttl overrides the cache default for this entry.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self._remove(key)
+        if ttl <= 0:
+            return
+
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+
+        self._data[key] = (time.monotonic() + ttl, value, size)
+        self.bytes += size
+        while len(self._data) > self.maxsize or (self.max_bytes and self.bytes > self.max_bytes):
+            _, (_, _, evicted) = self._data.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class RedisCache:
+    def __init__(self, url: str, prefix: str, ttl: float = 60):
+        if aioredis is None:
+            raise RuntimeError("RedisCache needs the redis package (pip install redis)")
+        self.url = url
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @property
+    def redis(self):
+        return get_redis(self.url)
+
+    def _key(self, key) -> str:
+        if isinstance(key, tuple):
+            key = ":".join(str(part) for part in key)
+        return f"{self.prefix}:{key}"
+
+    async def get(self, key, default=None):
+        try:
+            raw = await self.redis.get(self._key(key))
+        except Exception as e:
+            logger.warning("redis cache get failed: %s", e)
+            self.errors += 1
+            return default
+        if raw is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return json.loads(raw)
+
+    async def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        try:
+            await self.redis.set(self._key(key), json.dumps(value), px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning("redis cache set failed: %s", e)
+            self.errors += 1
+
+    async def delete(self, key):
+        try:
+            await self.redis.delete(self._key(key))
+        except Exception as e:
+            logger.warning("redis cache delete failed: %s", e)
+            self.errors += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class TieredCache:
+    """
+    A TTLCache in front of an optional RedisCache. Values found in redis are copied into the local layer.
+    local_ttl caps how long the local layer trusts a value, for values another worker may change
+    (set() writes through, but only to this worker's local layer and redis).
+    encode/decode turn values into something JSON can store and back.
+    """
+    def __init__(self, local: TTLCache, shared: RedisCache = None, local_ttl: float = None,
+                 encode=None, decode=None):
+        self.local = local
+        self.shared = shared
+        self.local_ttl = local_ttl if shared else None
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+
+    @property
+    def ttl(self):
+        return self.local.ttl
+
+    def _local_ttl(self, ttl: float = None):
+        ttl = self.local.ttl if ttl is None else ttl
+        return min(ttl, self.local_ttl) if self.local_ttl is not None else ttl
+
+    async def get(self, key, default=None):
+        value = self.local.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.shared is None:
+            return default
+        raw = await self.shared.get(key, _MISSING)
+        if raw is _MISSING:
+            return default
+        value = self.decode(raw)
+        self.local.set(key, value, ttl=self._local_ttl())
+        return value
+
+    async def set(self, key, value, ttl: float = None):
+        self.local.set(key, value, ttl=self._local_ttl(ttl))
+        if self.shared is not None:
+            await self.shared.set(key, self.encode(value), ttl=ttl)
+
+    async def delete(self, key):
+        self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(key)
+
+    def stats(self) -> dict:
+        stats = {"local": self.local.stats()}
+        if self.shared is not None:
+            stats["shared"] = self.shared.stats()
+        return stats
+
+class Broadcast:
+    """
+    Messages between the workers over a redis pub/sub channel. publish(kind, *args) sends
+    (kind, args) as JSON, and every other worker calls the handler registered for kind with on(kind, handler).
+    Without a url there is only this worker, and publish does nothing.
+
+    Delivery is best effort: messages sent while a worker is (re)connecting are lost, so after a lost
+    connection the reset handlers run (they should drop everything that may have missed a message).
+    """
+    def __init__(self, url: str, channel: str):
+        if url and aioredis is None:
+            raise RuntimeError("Broadcast needs the redis package (pip install redis)")
+        self.url = url
+        self.channel = channel
+        self.handlers = {}
+        self.resets = []
+        self.sender = None
+        self.task = None
+        self.sending = set()
+        self.stats = {"published": 0, "received": 0, "errors": 0, "resets": 0}
+
+    def on(self, kind: str, handler):
+        self.handlers[kind] = handler
+
+    def on_reset(self, handler):
+        self.resets.append(handler)
+
+    def start(self):
+        # per worker, after the fork, so each worker gets its own sender id and connection
+        if self.url and self.task is None:
+            self.sender = uuid.uuid4().hex
+            self.task = asyncio.create_task(self.listen())
+
+    async def stop(self):
+        if self.sending:
+            await asyncio.gather(*self.sending, return_exceptions=True)
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def publish(self, kind: str, *args):
+        """
+        Send a message without waiting for it (callers are write helpers that have already done their write).
+        """
+        if self.task is None:
+            return
+        task = asyncio.get_running_loop().create_task(self.send([self.sender, kind, *args]))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def send(self, message: list):
+        try:
+            await get_redis(self.url).publish(self.channel, json.dumps(message))
+            self.stats["published"] += 1
+        except Exception as e:
+            logger.warning("broadcast publish failed: %s", e)
+            self.stats["errors"] += 1
+
+    def reset(self):
+        self.stats["resets"] += 1
+        for handler in self.resets:
+            try:
+                handler()
+            except Exception:
+                logger.exception("broadcast reset handler failed")
+
+    async def listen(self):
+        missed = False
+        while True:
+            pubsub = get_redis(self.url).pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                if missed:
+                    # messages sent while we weren't subscribed are gone
+                    self.reset()
+                    missed = False
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    sender, kind, *args = json.loads(message["data"])
+                    if sender == self.sender or kind not in self.handlers:
+                        continue
+                    self.stats["received"] += 1
+                    try:
+                        self.handlers[kind](*args)
+                    except Exception:
+                        logger.exception("broadcast handler for %s failed", kind)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("broadcast subscription lost: %s", e)
+                self.stats["errors"] += 1
+                missed = True
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
@@ -9,6 +9,7 @@ We will only have a few tables and all apps will use them.
 1) user_products
 - maps users to the products they currently have
 - has a user_id, a product_name, and a stripe subscription id
+- plus a "subscription" JSON column with the last known subscription state (kept fresh by the stripe webhook)
 
 2) user_settings
 - maps users to their settings for a project
@@ -19,6 +20,12 @@ We will only have a few tables and all apps will use them.
 - user_id, product_name, item_id, item_type, item_meta (JSON), item_content (text)
 (we reserve the right to add more fields later for convenience, but will be judicious about it)
 
+4) item_style_profiles
+- the style profile the server measured for an item (app/style.py)
+- user_id, item_id (unique together), profile (JSON); see migrations/item_style_profiles.sql
+- kept out of user_items so saving one doesn't change the item's meta or updated_at
+- delete item and delete items delete the item's profile too
+
 
 We will have a few helpers
 
@@ -38,6 +45,8 @@ We will have a few helpers
 4) get items - takes a user and product and returns all items
 - optionally take an item type and returns all items of that type
 - does not return meta or content by defualt, but flags can tell it to include them
+- optionally returns one page at a time (limit + cursor), newest first
+- count items does the same filtering but only returns how many there are
 
 5) get item - takes a user and item id and returns the item
 - by default returns all fields
@@ -58,85 +67,368 @@ We will have a few helpers
 """
 
 from fastapi import Depends, HTTPException
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
 import stripe
 
-from dotenv import load_dotenv
+import asyncio
 import os
 from fastapi.security import OAuth2PasswordBearer
 
 from typing import Annotated
+from types import SimpleNamespace
+from datetime import datetime, timezone
+import base64
+import hashlib
+import json
+import logging
+import time
 
-load_dotenv()
+import httpx
+import jwt
 
-supabase: Client = create_client(
-    os.getenv("SUPABASE_URL"),
-    os.getenv("SUPABASE_SERVICE_KEY")
-)
+from .cache import TTLCache, RedisCache, TieredCache, Broadcast, shared_url
+from .transport import get_http_client
+from .metrics import instrument
+
+logger = logging.getLogger(__name__)
+
+_supabase: AsyncClient = None
+_supabase_lock = asyncio.Lock()
+
+async def get_supabase() -> AsyncClient:
+    """
+    Get the shared async supabase client, creating it on first use.
+    (the async client has to be created inside a running event loop)
+    """
+    global _supabase
+    if _supabase is None:
+        async with _supabase_lock:
+            if _supabase is None:
+                # use the shared keep-alive pool once it has been built (see omni/transport.py)
+                http = get_http_client("supabase")
+                options = AsyncClientOptions(httpx_client=http) if http else None
+                _supabase = await acreate_client(
+                    os.getenv("SUPABASE_URL"),
+                    os.getenv("SUPABASE_SERVICE_KEY"),
+                    options=options
+                )
+    return _supabase
 
 stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+# only set to point stripe at a stand-in server (see bench/)
+if os.getenv("STRIPE_API_BASE"):
+    stripe.api_base = os.getenv("STRIPE_API_BASE")
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def require_auth(token: Annotated[str, Depends(oauth2_scheme)]):
+# Claims of verified tokens, so we only pay for verification once per token (not once per keystroke).
+# Entries never outlive the token's own exp claim. With redis (AUTH_CACHE_REDIS_URL or REDIS_URL)
+# a token verified by one worker is known to all of them.
+token_cache = TieredCache(
+    TTLCache(
+        maxsize=int(os.getenv("AUTH_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("AUTH_CACHE_TTL", "300"))
+    ),
+    RedisCache(shared_url("AUTH_CACHE_REDIS_URL"), "auth") if shared_url("AUTH_CACHE_REDIS_URL") else None
+)
+auth_stats = {"local": 0, "remote": 0, "rejected": 0}
+
+JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+JWT_AUDIENCE = os.getenv("SUPABASE_JWT_AUDIENCE", "authenticated")
+# projects using asymmetric signing keys publish them here
+JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    f"{os.getenv('SUPABASE_URL')}/auth/v1/.well-known/jwks.json" if os.getenv("SUPABASE_URL") else None
+)
+JWKS_REFRESH_SECONDS = 600
+# what we accept from the JWKS. The token header only says which key to use, never how to check it
+JWKS_ALGORITHMS = ["RS256", "ES256"]
+
+_jwks = {"keys": None, "fetched_at": 0.0}
+
+async def get_jwks(refresh: bool = False):
+    """
+    Get the project's JWKS, fetching it at most once every JWKS_REFRESH_SECONDS unless refresh is set.
+    Returns None if the project doesn't publish any signing keys.
+    """
+    stale = time.monotonic() - _jwks["fetched_at"] > JWKS_REFRESH_SECONDS
+    if JWKS_URL and (refresh or stale or _jwks["keys"] is None):
+        try:
+            http = get_http_client("supabase")
+            if http is not None:
+                response = await http.get(JWKS_URL)
+            else:
+                async with httpx.AsyncClient(timeout=5) as http:
+                    response = await http.get(JWKS_URL)
+            response.raise_for_status()
+            keys = response.json().get("keys") or []
+            _jwks["keys"] = jwt.PyJWKSet.from_dict({"keys": keys}) if keys else None
+        except Exception as e:
+            logger.warning("fetching JWKS failed: %s", e)
+        _jwks["fetched_at"] = time.monotonic()
+    return _jwks["keys"]
+
+async def decode_token(token: str):
+    """
+    Verify a supabase access token locally.
+    Returns the claims, or None if we have no key material to check it with
+    (in which case the caller should ask supabase).
+    Raises jwt.PyJWTError if the token is bad.
+    """
+    header = jwt.get_unverified_header(token)
+
+    if header.get("alg") == "HS256":
+        if not JWT_SECRET:
+            return None
+        key = JWT_SECRET
+        algorithm = "HS256"
+    else:
+        jwks = await get_jwks()
+        if jwks is None:
+            return None
+        kid = header.get("kid")
+        if kid not in [k.key_id for k in jwks.keys]:
+            # keys may have been rotated since we last looked
+            jwks = await get_jwks(refresh=True)
+            if jwks is None or kid not in [k.key_id for k in jwks.keys]:
+                raise jwt.InvalidTokenError("Unknown signing key")
+        key = jwks[kid].key
+        # the algorithm comes from the key, so a header naming another one just fails to verify
+        algorithm = jwks[kid].algorithm_name
+        if algorithm not in JWKS_ALGORITHMS:
+            raise jwt.InvalidTokenError("Unsupported signing key")
+
+    return jwt.decode(
+        token,
+        key,
+        algorithms=[algorithm],
+        audience=JWT_AUDIENCE,
+        options={"require": ["exp", "sub"]}
+    )
+
+def user_from_claims(claims: dict):
+    """
+    Build a user object shaped like supabase's UserResponse (user.user.id etc) from token claims.
+    """
+    return SimpleNamespace(user=SimpleNamespace(
+        id=claims["sub"],
+        email=claims.get("email"),
+        phone=claims.get("phone"),
+        role=claims.get("role"),
+        aud=claims.get("aud"),
+        app_metadata=claims.get("app_metadata", {}),
+        user_metadata=claims.get("user_metadata", {}),
+    ))
+
+@instrument("supabase")
+async def verify_token(token: str):
+    """
+    Turn an access token into a user.
+    Checks the cache, then verifies the JWT locally, and only falls back to supabase.auth.get_user
+    when there's no JWT secret or JWKS to verify against.
+    Raises HTTPException(401) for invalid tokens.
+    """
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    claims = await token_cache.get(cache_key)
+    if claims is not None:
+        return user_from_claims(claims)
+
     try:
-        user = supabase.auth.get_user(token)
+        claims = await decode_token(token)
+    except jwt.PyJWTError as e:
+        auth_stats["rejected"] += 1
+        raise HTTPException(status_code=401, detail=str(e))
+
+    if claims is not None:
+        auth_stats["local"] += 1
+        user = user_from_claims(claims)
+    else:
+        auth_stats["remote"] += 1
+        try:
+            supabase = await get_supabase()
+            user = await supabase.auth.get_user(token)
+        except Exception as e:
+            raise HTTPException(status_code=401, detail=str(e))
         if not user:
             raise HTTPException(status_code=401, detail="Invalid token")
-        return user
-    except Exception as e:
-        raise HTTPException(status_code=401, detail=str(e))
+        claims = jwt.decode(token, options={"verify_signature": False})
+
+    ttl = min(token_cache.ttl, claims.get("exp", 0) - time.time())
+    await token_cache.set(cache_key, claims, ttl=ttl)
+    return user
+
+async def require_auth(token: Annotated[str, Depends(oauth2_scheme)]):
+    return await verify_token(token)
 
-def check_for_product_record(user_id: str, product_name: str):
+@instrument("supabase")
+async def check_for_product_record(user_id: str, product_name: str):
     """
     Check if the user has a record for the specified product.
     """
-    product = supabase.table("user_products").select("*").eq("user_id", user_id).eq("product_name", product_name).maybe_single().execute()
-    print(product)
+    supabase = await get_supabase()
+    product = await supabase.table("user_products").select("*").eq("user_id", user_id).eq("product_name", product_name).maybe_single().execute()
     if not product:
         return None
     return product.data
 
-def check_subscription_status(stripe_subscription_id: str):
+@instrument("stripe")
+async def check_subscription_status(stripe_subscription_id: str):
     """
     Check if the subscription is active or trialing.
     """
     try:
-        subscription = stripe.Subscription.retrieve(stripe_subscription_id)
+        subscription = await stripe.Subscription.retrieve_async(stripe_subscription_id)
         if subscription.status in ["active", "trialing"]:
             return True
         return False
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
-def check_user_subscription(user_id: str, product_name: str):
+# Local copy of each user's subscription state, so the paywall check doesn't call Stripe.
+# The source of truth is the "subscription" JSON column on user_products, which the
+# stripe webhook keeps up to date. Keyed on (user_id, product_name).
+# With redis (ENTITLEMENT_CACHE_REDIS_URL or REDIS_URL) it is shared between workers. A webhook or
+# checkout handled by another worker then reaches this one's local copy within ENTITLEMENT_LOCAL_TTL seconds.
+entitlement_cache = TieredCache(
+    TTLCache(
+        maxsize=int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000")),
+        ttl=float(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+    ),
+    RedisCache(shared_url("ENTITLEMENT_CACHE_REDIS_URL"), "entitlement") if shared_url("ENTITLEMENT_CACHE_REDIS_URL") else None,
+    local_ttl=float(os.getenv("ENTITLEMENT_LOCAL_TTL", "10")),
+    decode=lambda stored: Entitlement(stored) if stored else stored
+)
+entitlement_stats = {"stripe_refreshes": 0, "webhook_updates": 0, "stale_events": 0}
+
+# how long past current_period_end we trust a stored "active" status before asking stripe again
+ENTITLEMENT_GRACE_SECONDS = 60 * 60
+
+class Entitlement(dict):
+    """
+    The bits of a stripe subscription we care about.
+    Supports attribute access (entitlement.status) like the stripe objects it replaces.
+    """
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+def entitlement_from_subscription(subscription, event_created: int = None) -> Entitlement:
+    """
+    Build an entitlement from a stripe subscription object (or webhook payload).
+    """
+    current_period_end = subscription.get("current_period_end")
+    if current_period_end is None:
+        # newer stripe api versions moved the period onto the subscription items
+        items = (subscription.get("items") or {}).get("data") or []
+        if items:
+            current_period_end = items[0].get("current_period_end")
+
+    return Entitlement({
+        "id": subscription["id"],
+        "status": subscription["status"],
+        "cancel_at_period_end": bool(subscription.get("cancel_at_period_end")),
+        "current_period_end": current_period_end,
+        "updated": event_created or int(time.time()),
+    })
+
+async def refresh_entitlement(user_id: str, product_name: str, stripe_sub_id: str) -> Entitlement:
+    """
+    Pull the subscription from stripe and store it on the product record.
+    Only used when we have no stored state for the subscription (or it looks out of date).
+    """
+    entitlement_stats["stripe_refreshes"] += 1
+    subscription = await stripe.Subscription.retrieve_async(stripe_sub_id)
+    entitlement = entitlement_from_subscription(subscription)
+
+    supabase = await get_supabase()
+    await supabase.table("user_products").update({
+        "subscription": dict(entitlement)
+    }).eq("user_id", user_id).eq("product_name", product_name).execute()
+    return entitlement
+
+@instrument("supabase")
+async def check_user_subscription(user_id: str, product_name: str):
     """
     Check if the user has a subscription for the specified product.
+    Returns the entitlement (status, cancel_at_period_end, ...) or False.
     """
-    product = check_for_product_record(user_id, product_name)
-    if not product:
-        return False
+    key = (user_id, product_name)
+    cached = await entitlement_cache.get(key)
+    if cached is not None:
+        return cached
 
-    print(product)
-    stripe_sub_id = product["stripe_sub_id"]
+    product = await check_for_product_record(user_id, product_name)
+    stripe_sub_id = product["stripe_sub_id"] if product else None
     if not stripe_sub_id:
+        await entitlement_cache.set(key, False)
         return False
 
-    subscription = stripe.Subscription.retrieve(stripe_sub_id)
-    return subscription
+    stored = product.get("subscription")
+    entitlement = Entitlement(stored) if stored else None
+
+    if not entitlement or entitlement.get("id") != stripe_sub_id:
+        entitlement = await refresh_entitlement(user_id, product_name, stripe_sub_id)
+    elif (entitlement.status in ["active", "trialing"]
+            and entitlement.get("current_period_end")
+            and entitlement.current_period_end + ENTITLEMENT_GRACE_SECONDS < time.time()):
+        # the period ended and we never heard about the renewal, double check with stripe
+        entitlement = await refresh_entitlement(user_id, product_name, stripe_sub_id)
+
+    await entitlement_cache.set(key, entitlement)
+    return entitlement
+
+SUBSCRIPTION_EVENTS = [
+    "customer.subscription.created",
+    "customer.subscription.updated",
+    "customer.subscription.deleted",
+    "customer.subscription.paused",
+    "customer.subscription.resumed",
+]
+
+async def handle_stripe_event(payload: bytes, signature: str):
+    """
+    Verify and apply a stripe webhook event.
+    Subscription events update the stored entitlement for every product record using that subscription.
+    """
+    try:
+        event = stripe.Webhook.construct_event(payload, signature, os.getenv("STRIPE_WEBHOOK_SECRET"))
+    except (ValueError, stripe.SignatureVerificationError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if event["type"] not in SUBSCRIPTION_EVENTS:
+        return False
+
+    subscription = event["data"]["object"]
+    entitlement = entitlement_from_subscription(subscription, event["created"])
+
+    supabase = await get_supabase()
+    records = await supabase.table("user_products").select("user_id, product_name, subscription").eq("stripe_sub_id", subscription["id"]).execute()
+
+    for record in records.data:
+        stored = record.get("subscription")
+        if stored and stored.get("id") == entitlement.id and stored.get("updated", 0) > entitlement.updated:
+            # stripe doesn't guarantee ordering, don't let an old event overwrite newer state
+            entitlement_stats["stale_events"] += 1
+            continue
+
+        await supabase.table("user_products").update({
+            "subscription": dict(entitlement)
+        }).eq("user_id", record["user_id"]).eq("product_name", record["product_name"]).execute()
+        await entitlement_cache.set((record["user_id"], record["product_name"]), entitlement)
+        entitlement_stats["webhook_updates"] += 1
+
+    return True
 
 class RequireProductSubscription:
     def __init__(self, product_name: str):
         self.product_name = product_name
 
-    def __call__(self, token: Annotated[str, Depends(oauth2_scheme)]):
+    async def __call__(self, token: Annotated[str, Depends(oauth2_scheme)]):
+        user = await verify_token(token)
         try:
-            user = supabase.auth.get_user(token)
-            if not user:
-                raise HTTPException(status_code=401, detail="Invalid token")
-            
             # Check if the user has access to the specified product
-            subscription = check_user_subscription(user.user.id, self.product_name)
+            subscription = await check_user_subscription(user.user.id, self.product_name)
             if not subscription:
                 raise HTTPException(status_code=402, detail="Payment required")
             
@@ -144,6 +436,8 @@ class RequireProductSubscription:
                 raise HTTPException(status_code=402, detail="Payment required")
             
             return (user, subscription)
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
         
@@ -156,14 +450,15 @@ PRODUCT_LIST = {
     }
 }
 
-def create_checkout_session(user_id: str, product_name: str, success_url: str, cancel_url: str):
+@instrument("stripe")
+async def create_checkout_session(user_id: str, product_name: str, success_url: str, cancel_url: str):
     try:
         # Check if the product exists
         if product_name not in PRODUCT_LIST:
             raise HTTPException(status_code=404, detail="Product not found")
     
         # Create a checkout session
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = await stripe.checkout.Session.create_async(
             line_items=[
                 {
                     "price": PRODUCT_LIST[product_name]["price_id"],
@@ -182,151 +477,502 @@ def create_checkout_session(user_id: str, product_name: str, success_url: str, c
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     
-def verify_checkout_session(user_id: str, session_id: str, product_name: str):
-    print("Here")
+@instrument("stripe")
+async def verify_checkout_session(user_id: str, session_id: str, product_name: str):
     try:
-        # Retrieve the session
-        print("DUDe")
-        checkout_session = stripe.checkout.Session.retrieve(session_id)
-        print(checkout_session)
-        product = check_for_product_record(user_id, product_name)
+        # Retrieve the session and the product record at the same time, they don't depend on each other
+        checkout_session, product = await asyncio.gather(
+            stripe.checkout.Session.retrieve_async(session_id, expand=["subscription"]),
+            check_for_product_record(user_id, product_name)
+        )
+        subscription = checkout_session['subscription']
+        entitlement = entitlement_from_subscription(subscription)
 
-        print(product)
+        supabase = await get_supabase()
        
         if not product:
             # Create a new record for the user
-            print("creating")
-            result = supabase.table("user_products").insert({
+            await supabase.table("user_products").insert({
                 "user_id": user_id,
                 "product_name": product_name,
-                "stripe_sub_id": checkout_session['subscription'],
+                "stripe_sub_id": subscription['id'],
+                "subscription": dict(entitlement),
             }).execute()
-            print(result)
+            logger.info("created %s subscription record for %s", product_name, user_id)
         else:
             # Update the existing record
-            result = supabase.table("user_products").update({
-                "stripe_sub_id": checkout_session['subscription']
+            await supabase.table("user_products").update({
+                "stripe_sub_id": subscription['id'],
+                "subscription": dict(entitlement),
             }).eq("user_id", user_id).eq("product_name", product_name).execute()
-            print(result)
+            logger.info("updated %s subscription record for %s", product_name, user_id)
 
+        await entitlement_cache.set((user_id, product_name), entitlement)
         return True
     except Exception as e:
-        print(e)
+        logger.exception("verifying checkout session %s failed", session_id)
         raise HTTPException(status_code=500, detail=str(e))
     
-def get_settings(user_id: str, product_name: str, default=None):
+# Read-through cache for items, item lists and settings, so repeated reads (like the
+# existence check on every suggest call) don't go to the db. The write helpers below keep it honest:
+# - ("item", user_id, item_id) -> {columns: row}, dropped whenever the item is written
+# - ("items", user_id, generation, ...) -> list rows; any item write bumps the user's generation,
+#   which orphans all of their cached lists (they age out of the LRU)
+# - ("settings", user_id, product_name) -> settings, dropped by set_settings
+# With several workers (gunicorn.conf.py) the writes are broadcast (BROADCAST_REDIS_URL or REDIS_URL),
+# and the other workers drop their copies too, so they only lag behind by the time the message takes.
+record_cache = TTLCache(
+    maxsize=int(os.getenv("RECORD_CACHE_SIZE", "20000")),
+    ttl=float(os.getenv("RECORD_CACHE_TTL", "60")),
+    max_bytes=int(os.getenv("RECORD_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+)
+_item_generations = {}
+_NO_SETTINGS = "__none__"
+
+# writes made by this worker, for the others (started and stopped by the app's lifespan)
+broadcast = Broadcast(shared_url("BROADCAST_REDIS_URL"), "omni:changes")
+
+# called as listener(change, user_id, item_id, fields) after every item write made by this worker,
+# change is "create", "content", "meta" or "delete" (app/search.py keeps its index up to date this way)
+item_listeners = []
+# the same, for the writes of the other workers. Only for in-process state: work that the writing worker
+# does for everyone (like app/retrieval.py's stores on disk) must not be repeated by every worker
+remote_item_listeners = []
+
+def call_item_listeners(listeners: list, change: str, user_id: str, item_id: str, fields: dict):
+    for listener in listeners:
+        try:
+            listener(change, user_id, item_id, fields)
+        except Exception:
+            logger.exception("item listener failed on %s of %s", change, item_id)
+
+def notify_item_change(change: str, user_id: str, item_id: str, **fields):
+    call_item_listeners(item_listeners, change, user_id, item_id, fields)
+    broadcast.publish("item", change, user_id, item_id, fields)
+
+def item_changed_elsewhere(change: str, user_id: str, item_id: str, fields: dict):
+    # our cached copies don't have the other worker's write
+    invalidate_item(user_id, item_id)
+    call_item_listeners(remote_item_listeners, change, user_id, item_id, fields)
+
+def settings_changed_elsewhere(user_id: str, product_name: str):
+    record_cache.delete(("settings", user_id, product_name))
+
+broadcast.on("item", item_changed_elsewhere)
+broadcast.on("settings", settings_changed_elsewhere)
+broadcast.on_reset(record_cache.clear)
+
+def items_generation(user_id: str) -> int:
+    return _item_generations.get(user_id, 0)
+
+def invalidate_item(user_id: str, item_id: str = None):
+    """
+    Forget cached copies of an item (if given) and all cached item lists for the user.
+    """
+    if item_id:
+        record_cache.delete(("item", user_id, item_id))
+    _item_generations[user_id] = items_generation(user_id) + 1
+
+def update_cached_item(user_id: str, item_id: str, changes: dict):
+    """
+    Apply a write we just made to the cached copies of an item instead of dropping them,
+    so the next read (e.g. the next suggest call) is still a hit.
+    updated_at is set to our clock, which is close enough to the db's now().
+    """
+    key = ("item", user_id, item_id)
+    variants = record_cache.get(key)
+    if variants:
+        changes = dict(changes, updated_at=datetime.now(timezone.utc).isoformat())
+        updated = {}
+        for columns, row in variants.items():
+            row = dict(row)
+            for field, value in changes.items():
+                if field in row:
+                    row[field] = value
+            updated[columns] = row
+        record_cache.set(key, updated)
+    _item_generations[user_id] = items_generation(user_id) + 1
+
+def record_cache_stats() -> dict:
+    return record_cache.stats()
+
+@instrument("supabase")
+async def get_settings(user_id: str, product_name: str, default=None):
     """
     Get the settings for a user and product.
     """
-    settings = supabase.table("user_settings").select("*").eq("user_id", user_id).eq("product_name", product_name).maybe_single().execute()
-    if not settings:
+    key = ("settings", user_id, product_name)
+    cached = record_cache.get(key)
+    if cached is None:
+        supabase = await get_supabase()
+        settings = await supabase.table("user_settings").select("*").eq("user_id", user_id).eq("product_name", product_name).maybe_single().execute()
+        cached = settings.data["settings"] if settings else _NO_SETTINGS
+        record_cache.set(key, cached)
+
+    if cached == _NO_SETTINGS:
         return default or {}
-    return settings.data["settings"]
+    return dict(cached)
 
-def get_items(user_id: str, product_name: str, item_type: str = None, include_meta: bool = False, include_content: bool = False):
+def item_columns(include_meta: bool, include_content: bool) -> str:
     """
-    Get all items for a user and product.
+    The user_items columns to select for the include flags.
     """
-    query = supabase.table("user_items")
-
     if not include_meta and not include_content:
-        query = query.select("item_id, item_type, updated_at")
-        
+        return "item_id, item_type, updated_at"
     elif not include_content and include_meta:
-        query = query.select("item_id, item_type, updated_at, item_meta")
-    
+        return "item_id, item_type, updated_at, item_meta"
     elif include_content and not include_meta:
-        query = query.select("item_id, item_type, updated_at, item_content")
-    
-    else:
-        query = query.select("*")
+        return "item_id, item_type, updated_at, item_content"
+    return "*"
+
+def encode_cursor(item: dict) -> str:
+    """
+    Opaque cursor pointing just after item in (updated_at, item_id) order.
+    """
+    raw = json.dumps([item["updated_at"], item["item_id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        updated_at, item_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return updated_at, item_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+@instrument("supabase")
+async def get_items(user_id: str, product_name: str, item_type: str = None, include_meta: bool = False, include_content: bool = False, limit: int = None, cursor: str = None):
+    """
+    Get all items for a user and product.
+    With a limit, returns one page, newest first, ordered on (updated_at, item_id).
+    Pass encode_cursor(last item of the page) as cursor to get the next one.
+    """
+    # lists with content are big and mostly used for exports, those always go to the db
+    key = None
+    if not include_content:
+        key = ("items", user_id, items_generation(user_id), product_name, item_type, include_meta, limit, cursor)
+        cached = record_cache.get(key)
+        if cached is not None:
+            return [dict(item) for item in cached]
+
+    supabase = await get_supabase()
+    query = supabase.table("user_items").select(item_columns(include_meta, include_content))
 
     if item_type:
         query = query.eq("item_type", item_type)
     
     query = query.eq("user_id", user_id).eq("product_name", product_name)
+
+    if limit:
+        if cursor:
+            updated_at, item_id = decode_cursor(cursor)
+            # keyset: strictly after the cursor in (updated_at desc, item_id desc) order
+            query = query.or_(f'updated_at.lt."{updated_at}",and(updated_at.eq."{updated_at}",item_id.lt."{item_id}")')
+        query = query.order("updated_at", desc=True).order("item_id", desc=True).limit(limit)
     
-    items = query.execute()
+    items = await query.execute()
+
+    if key:
+        record_cache.set(key, [dict(item) for item in items.data])
     
     return items.data
 
-def get_item(user_id: str, item_id: str, include_meta: bool = True, include_content: bool = True):
+async def iter_items(user_id: str, product_name: str, item_type: str = None, include_meta: bool = False, include_content: bool = False, page_size: int = 200):
     """
-    Get a specific item for a user.
+    Yield all items for a user and product, a page at a time, without holding them all in memory.
     """
-    query = supabase.table("user_items")
-    
-    if not include_meta and not include_content:
-        query = query.select("item_id, item_type, updated_at")
-        
-    elif not include_content and include_meta:
-        query = query.select("item_id, item_type, updated_at, item_meta")
-    
-    elif include_content and not include_meta:
-        query = query.select("item_id, item_type, updated_at, item_content")
-    
-    else:
-        query = query.select("*")
+    cursor = None
+    while True:
+        page = await get_items(user_id, product_name, item_type, include_meta, include_content, limit=page_size, cursor=cursor)
+        for item in page:
+            yield item
+        if len(page) < page_size:
+            return
+        cursor = encode_cursor(page[-1])
+
+@instrument("supabase")
+async def count_items(user_id: str, product_name: str, item_type: str = None) -> int:
+    """
+    Count items for a user and product without fetching them.
+    """
+    supabase = await get_supabase()
+    query = supabase.table("user_items").select("item_id", count="exact", head=True)
+    if item_type:
+        query = query.eq("item_type", item_type)
+    result = await query.eq("user_id", user_id).eq("product_name", product_name).execute()
+    return result.count or 0
+
+@instrument("supabase")
+async def get_item(user_id: str, item_id: str, include_meta: bool = True, include_content: bool = True):
+    """
+    Get a specific item for a user. None if there is no such item.
+    """
+    columns = item_columns(include_meta, include_content)
+    key = ("item", user_id, item_id)
+    variants = record_cache.get(key) or {}
+    if columns in variants:
+        return dict(variants[columns])
+    if "*" in variants:
+        # we already have the whole row, just pick out what was asked for
+        row = variants["*"]
+        return {c.strip(): row.get(c.strip()) for c in columns.split(",")}
+
+    supabase = await get_supabase()
+    query = supabase.table("user_items").select(columns)
 
     query = query.eq("user_id", user_id).eq("item_id", item_id)
     
-    item = query.single().execute()
+    item = await query.maybe_single().execute()
+    if not item or not item.data:
+        return None
+
+    variants = dict(variants)
+    variants[columns] = dict(item.data)
+    record_cache.set(key, variants)
     
     return item.data
 
-def set_settings(user_id: str, product_name: str, settings: dict):
+@instrument("supabase")
+async def set_settings(user_id: str, product_name: str, settings: dict):
     """
     Set the settings for a user and product.
     """
-    existing_settings = supabase.table("user_settings").select("*").eq("user_id", user_id).eq("product_name", product_name).single().execute()
+    supabase = await get_supabase()
+    existing_settings = await supabase.table("user_settings").select("*").eq("user_id", user_id).eq("product_name", product_name).single().execute()
     
     if existing_settings:
-        supabase.table("user_settings").update({
+        await supabase.table("user_settings").update({
             "settings": settings
         }).eq("user_id", user_id).eq("product_name", product_name).execute()
     else:
-        supabase.table("user_settings").insert({
+        await supabase.table("user_settings").insert({
             "user_id": user_id,
             "product_name": product_name,
             "settings": settings
         }).execute()
 
-def set_item_meta(user_id: str, item_id: str, meta: dict):
+    record_cache.delete(("settings", user_id, product_name))
+    broadcast.publish("settings", user_id, product_name)
+
+@instrument("supabase")
+async def set_item_meta(user_id: str, item_id: str, meta: dict):
     """
     Set the meta for a specific item for a user.
     """
-    supabase.table("user_items").update({
+    supabase = await get_supabase()
+    await supabase.table("user_items").update({
         "item_meta": meta,
         "updated_at": "now()"
     }).eq("user_id", user_id).eq("item_id", item_id).execute()
+    update_cached_item(user_id, item_id, {"item_meta": meta})
+    notify_item_change("meta", user_id, item_id, meta=meta)
 
-def set_item_content(user_id: str, item_id: str, content: str):
+@instrument("supabase")
+async def set_item_content(user_id: str, item_id: str, content: str):
     """
     Set the content for a specific item for a user.
     """
-    supabase.table("user_items").update({
+    supabase = await get_supabase()
+    await supabase.table("user_items").update({
         "item_content": content,
         "updated_at": "now()"
     }).eq("user_id", user_id).eq("item_id", item_id).execute()
+    update_cached_item(user_id, item_id, {"item_content": content})
+    notify_item_change("content", user_id, item_id, content=content)
 
-def create_item(user_id: str, product_name: str, item_type: str, meta: dict = None, content: str = None):
+@instrument("supabase")
+async def get_item_style_profile(user_id: str, item_id: str):
+    """
+    The style profile we saved for an item (see app/style.py), or None.
+    """
+    supabase = await get_supabase()
+    result = await supabase.table("item_style_profiles").select("profile").eq("user_id", user_id).eq("item_id", item_id).maybe_single().execute()
+    if not result:
+        return None
+    return result.data["profile"]
+
+@instrument("supabase")
+async def set_item_style_profile(user_id: str, item_id: str, profile: dict):
+    """
+    Save the style profile for an item. It has its own table so that saving it doesn't touch
+    the item itself (its meta belongs to the client, and its updated_at orders the item list).
+    """
+    supabase = await get_supabase()
+    await supabase.table("item_style_profiles").upsert({
+        "user_id": user_id,
+        "item_id": item_id,
+        "profile": profile
+    }, on_conflict="user_id,item_id").execute()
+    broadcast.publish("style", user_id, item_id)
+
+async def delete_style_profiles(user_id: str, item_ids: list):
+    """
+    Delete the style profiles of deleted items. The items are already gone, so a failure here
+    only leaves rows behind that nothing reads: it is logged, not raised.
+    """
+    supabase = await get_supabase()
+    try:
+        await asyncio.gather(*(
+            supabase.table("item_style_profiles").delete().eq("user_id", user_id).in_("item_id", chunk).execute()
+            for chunk in id_chunks(item_ids)
+        ))
+    except Exception:
+        logger.exception("deleting the style profiles of %d deleted items failed", len(item_ids))
+
+@instrument("supabase")
+async def create_item(user_id: str, product_name: str, item_type: str, meta: dict = None, content: str = None):
     """
     Create a new item for a user and product.
     supabase will auto-generate the item_id.
     """
-    
-    result = supabase.table("user_items").insert({
+    supabase = await get_supabase()
+    result = await supabase.table("user_items").insert({
         "user_id": user_id,
         "product_name": product_name,
         "item_type": item_type,
         "item_meta": meta or {},
         "item_content": content or ""
     }).execute()
+    invalidate_item(user_id)
+    for row in result.data or []:
+        notify_item_change("create", user_id, row["item_id"], product_name=product_name, item_type=item_type,
+                           meta=row.get("item_meta"), content=row.get("item_content"), updated_at=row.get("updated_at"))
 
     return result.data
 
-def delete_item(user_id: str, item_id: str):
+@instrument("supabase")
+async def delete_item(user_id: str, item_id: str):
     """"
     Delete a specific item for a user.
     """
-    supabase.table("user_items").delete().eq("user_id", user_id).eq("item_id", item_id).execute()
\ No newline at end of file
+    supabase = await get_supabase()
+    await supabase.table("user_items").delete().eq("user_id", user_id).eq("item_id", item_id).execute()
+    invalidate_item(user_id, item_id)
+    notify_item_change("delete", user_id, item_id)
+    await delete_style_profiles(user_id, [item_id])
+
+# Batch versions of the item helpers, for importing and reorganizing many items at once.
+# Most are a handful of requests however many items there are: ids go into in_ filters
+# of at most IN_FILTER_SIZE ids (they end up in the url), rows into one bulk insert.
+IN_FILTER_SIZE = 100
+# updates in flight at a time in update_items
+UPDATE_CONCURRENCY = 10
+
+def id_chunks(item_ids: list) -> list:
+    return [item_ids[i:i + IN_FILTER_SIZE] for i in range(0, len(item_ids), IN_FILTER_SIZE)]
+
+@instrument("supabase")
+async def create_items(user_id: str, product_name: str, items: list) -> list:
+    """
+    Create several items in one insert. items are dicts with item_type and optionally meta and content.
+    Returns the new rows in the same order. Either all of them are created or none.
+    """
+    supabase = await get_supabase()
+    result = await supabase.table("user_items").insert([{
+        "user_id": user_id,
+        "product_name": product_name,
+        "item_type": item.get("item_type"),
+        "item_meta": item.get("meta") or {},
+        "item_content": item.get("content") or ""
+    } for item in items]).execute()
+    invalidate_item(user_id)
+    for row in result.data or []:
+        notify_item_change("create", user_id, row["item_id"], product_name=product_name, item_type=row.get("item_type"),
+                           meta=row.get("item_meta"), content=row.get("item_content"), updated_at=row.get("updated_at"))
+
+    return result.data
+
+@instrument("supabase")
+async def get_items_by_id(user_id: str, item_ids: list, include_meta: bool = True, include_content: bool = True) -> dict:
+    """
+    Get several items of a user by id. Returns {item_id: item}, without the ids that don't exist.
+    """
+    columns = item_columns(include_meta, include_content)
+    found = {}
+    missing = []
+    for item_id in dict.fromkeys(item_ids):
+        variants = record_cache.get(("item", user_id, item_id)) or {}
+        if columns in variants:
+            found[item_id] = dict(variants[columns])
+        elif "*" in variants:
+            row = variants["*"]
+            found[item_id] = {c.strip(): row.get(c.strip()) for c in columns.split(",")}
+        else:
+            missing.append(item_id)
+    if not missing:
+        return found
+
+    supabase = await get_supabase()
+    results = await asyncio.gather(*(
+        supabase.table("user_items").select(columns).eq("user_id", user_id).in_("item_id", chunk).execute()
+        for chunk in id_chunks(missing)
+    ))
+    for result in results:
+        for row in result.data:
+            key = ("item", user_id, row["item_id"])
+            variants = dict(record_cache.get(key) or {})
+            variants[columns] = dict(row)
+            record_cache.set(key, variants)
+            found[row["item_id"]] = row
+    return found
+
+@instrument("supabase")
+async def update_items(user_id: str, updates: list) -> dict:
+    """
+    Set the meta and/or content of several items of a user. updates are dicts with item_id and
+    meta and/or content; later updates of the same item win.
+    Returns {item_id: updated_at} for the items that were updated, or {item_id: exception} for those
+    whose update failed. Ids that don't exist, or aren't the user's, are left out.
+
+    PostgREST can't set different values on different rows in one update, so every item is its own
+    update (UPDATE_CONCURRENCY at a time). Not an upsert: that would bring back an item deleted meanwhile.
+    """
+    merged = {}
+    for update in updates:
+        merged.setdefault(update["item_id"], {}).update(
+            {field: update[field] for field in ("meta", "content") if field in update})
+
+    supabase = await get_supabase()
+    slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+    async def update_one(item_id: str, fields: dict):
+        changes = {}
+        if "meta" in fields:
+            changes["item_meta"] = fields["meta"] or {}
+        if "content" in fields:
+            changes["item_content"] = fields["content"] or ""
+        async with slots:
+            try:
+                result = await supabase.table("user_items").update(dict(changes, updated_at="now()")).eq("user_id", user_id).eq("item_id", item_id).execute()
+            except Exception as e:
+                return e
+        if not result.data:
+            return None
+        update_cached_item(user_id, item_id, changes)
+        if "item_meta" in changes:
+            notify_item_change("meta", user_id, item_id, meta=changes["item_meta"])
+        if "item_content" in changes:
+            notify_item_change("content", user_id, item_id, content=changes["item_content"])
+        return result.data[0].get("updated_at")
+
+    results = await asyncio.gather(*(update_one(item_id, fields) for item_id, fields in merged.items()))
+    return {item_id: result for item_id, result in zip(merged, results) if result is not None}
+
+@instrument("supabase")
+async def delete_items(user_id: str, item_ids: list) -> list:
+    """
+    Delete several items of a user. Returns the ids that were deleted (ids that don't exist,
+    or aren't the user's, are left out).
+    """
+    supabase = await get_supabase()
+    chunks = id_chunks(list(dict.fromkeys(item_ids)))
+    results = await asyncio.gather(*(
+        supabase.table("user_items").delete().eq("user_id", user_id).in_("item_id", chunk).execute()
+        for chunk in chunks
+    ))
+    deleted = [row["item_id"] for result in results for row in result.data]
+    for item_id in deleted:
+        invalidate_item(user_id, item_id)
+        notify_item_change("delete", user_id, item_id)
+    if deleted:
+        await delete_style_profiles(user_id, deleted)
+    return deleted
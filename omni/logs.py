@@ -0,0 +1,68 @@
+"""
+Logging setup.
+
+Modules log with logging.getLogger(__name__). setup_logging() (called from the app's lifespan, so once per worker) points
+the root logger at a QueueHandler, and a QueueListener thread does the actual writing, so a log
+call on the event loop is a queue put instead of a blocking write to stdout.
+
+LOG_LEVEL sets the level (default INFO), LOG_FORMAT=json writes one JSON object per line.
+"""
+
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+
+_listener = None
+_listener_pid = None
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def setup_logging():
+    """
+    Route all logging through a queue to a background writer. Safe to call more than once.
+    """
+    global _listener, _listener_pid
+    # a listener started before a fork has no thread in this process, start our own
+    if _listener is not None and _listener_pid == os.getpid():
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+
+def stop_logging():
+    """
+    Write out whatever is still queued. Called on shutdown.
+    """
+    global _listener, _listener_pid
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+        _listener_pid = None
@@ -0,0 +1,190 @@
+"""
+Prometheus metrics, served on /metrics.
+
+- MetricsMiddleware times every request per route (until the last byte of the body, so streamed
+  suggestions count in full) and keeps an in-flight gauge.
+- the shared HTTP transport (transport.py) records latency and in-flight requests per upstream.
+- @instrument("supabase", "get_item") times a helper as one upstream operation, which is the
+  number you want when a helper makes several requests or hits a cache first.
+- stage("context") times one part of the suggest path.
+- the stats dicts the modules already keep (cache hit rates, router, writer, ...) are exposed
+  as gauges through register_stats, read when /metrics is scraped.
+
+With several workers (gunicorn.conf.py) PROMETHEUS_MULTIPROC_DIR is set, and the metrics above are
+summed over all workers. The stats gauges are still those of the worker that answered the scrape.
+"""
+
+from contextlib import contextmanager
+import functools
+import os
+import re
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2.5, 5, 10, 30)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, until the last byte of the body",
+    ["method", "route", "status"], buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests being served", ["route"],
+                           multiprocess_mode="livesum")
+
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds", "Time for one HTTP request to an upstream, until its body is read",
+    ["upstream", "status"], buckets=LATENCY_BUCKETS)
+UPSTREAM_IN_FLIGHT = Gauge("upstream_requests_in_flight", "HTTP requests to an upstream in flight", ["upstream"],
+                           multiprocess_mode="livesum")
+
+OPERATION_LATENCY = Histogram(
+    "upstream_operation_duration_seconds", "Time for a helper that talks to an upstream, including its cache",
+    ["upstream", "operation", "outcome"], buckets=LATENCY_BUCKETS)
+
+STAGE_LATENCY = Histogram(
+    "suggest_stage_duration_seconds", "Time spent in each part of a suggestion",
+    ["stage"], buckets=LATENCY_BUCKETS)
+
+LLM_TOKENS = Counter("llm_tokens_total", "Tokens used by model calls", ["kind"])
+LLM_OUTPUT_TOKENS = Histogram(
+    "llm_output_tokens", "Output tokens per prediction", ["state", "stop"],
+    buckets=(5, 10, 20, 30, 40, 60, 80, 100, 150, 250, 500))
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (BaseHTTPMiddleware would stop timing when the response starts).
+    Add it with the app's routes, app.add_middleware(MetricsMiddleware, routes=app.routes),
+    so requests are labelled by route template rather than by url.
+    """
+    def __init__(self, app, routes: list = None):
+        self.app = app
+        self.routes = routes or []
+
+    def route_name(self, scope) -> str:
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        # a label per unknown url would blow up the metric, group them
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = {"code": 500}
+        route = self.route_name(scope)
+        in_flight = REQUESTS_IN_FLIGHT.labels(route)
+        in_flight.inc()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            in_flight.dec()
+            REQUEST_LATENCY.labels(scope["method"], route, str(status["code"])).observe(
+                time.perf_counter() - started)
+
+def instrument(upstream: str, operation: str = None):
+    """
+    Decorator timing an async helper as an upstream operation.
+    """
+    def decorator(fn):
+        name = operation or fn.__name__
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await fn(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                OPERATION_LATENCY.labels(upstream, name, outcome).observe(time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+@contextmanager
+def stage(name: str):
+    """
+    Time one stage of the suggest path.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+def record_tokens(prompt_tokens: int, completion_tokens: int):
+    LLM_TOKENS.labels("prompt").inc(prompt_tokens)
+    LLM_TOKENS.labels("completion").inc(completion_tokens)
+
+class StatsCollector:
+    """
+    Exposes stats dicts as gauges: {"hits": 3, "by_state": {"word": {...}}} becomes
+    <prefix>_hits and <prefix>_by_state_word_..., and lists of dicts with a "name" get a name label.
+    """
+    def __init__(self):
+        self.sources = {}
+
+    def flatten(self, prefix: str, stats, labels: dict, out: dict):
+        prefix = re.sub(r"[^a-zA-Z0-9_]", "_", prefix)
+        if isinstance(stats, bool):
+            stats = int(stats)
+        if isinstance(stats, (int, float)):
+            out.setdefault(prefix, []).append((labels, stats))
+        elif isinstance(stats, dict):
+            for key, value in stats.items():
+                self.flatten(f"{prefix}_{key}", value, labels, out)
+        elif isinstance(stats, list):
+            for entry in stats:
+                if isinstance(entry, dict) and "name" in entry:
+                    self.flatten(prefix, {k: v for k, v in entry.items() if k != "name"},
+                                 {**labels, "name": str(entry["name"])}, out)
+
+    def collect(self):
+        for prefix, source in list(self.sources.items()):
+            try:
+                stats = source()
+            except Exception:
+                continue
+            out = {}
+            self.flatten(prefix, stats, {}, out)
+            for name, samples in out.items():
+                label_names = sorted({k for labels, _ in samples for k in labels})
+                family = GaugeMetricFamily(name, f"{prefix} stats", labels=label_names)
+                for labels, value in samples:
+                    family.add_metric([labels.get(k, "") for k in label_names], value)
+                yield family
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+def register_stats(prefix: str, source):
+    """
+    Expose source() (a stats dict or a list of them) under prefix on /metrics.
+    """
+    stats_collector.sources[prefix] = source
+
+_multiprocess_registry = None
+
+def render_metrics():
+    """
+    (body, content type) for the /metrics endpoint.
+    """
+    global _multiprocess_registry
+    if not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    if _multiprocess_registry is None:
+        _multiprocess_registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(_multiprocess_registry)
+        _multiprocess_registry.register(stats_collector)
+    return generate_latest(_multiprocess_registry), CONTENT_TYPE_LATEST
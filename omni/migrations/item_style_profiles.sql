@@ -0,0 +1,13 @@
+-- Style profiles the server measures for items (app/style.py), one row per item.
+-- Kept out of user_items so that saving a profile doesn't touch the item's meta or updated_at.
+-- omni/helpers.py upserts on (user_id, item_id) and deletes a profile when it deletes the item.
+
+create table if not exists item_style_profiles (
+    user_id uuid not null references auth.users (id) on delete cascade,
+    item_id uuid not null,
+    profile jsonb not null default '{}'::jsonb,
+    primary key (user_id, item_id)
+);
+
+-- only the server (service key) reads and writes profiles
+alter table item_style_profiles enable row level security;
@@ -0,0 +1,164 @@
+"""
+Shared HTTP transport for our upstreams (supabase, stripe, azure openai).
+
+Each upstream gets one long lived httpx.AsyncClient with a tuned, keep-alive connection pool
+(HTTP/2 when the h2 package is installed), so we stop paying for DNS + TLS handshakes on hot paths.
+The clients are built once at startup (start_http_clients, called from the FastAPI lifespan)
+and closed on shutdown. Until then get_http_client returns None and the SDKs use their defaults.
+
+Settings, per upstream (NAME is SUPABASE, STRIPE or OPENAI):
+    HTTP_<NAME>_TIMEOUT           total timeout in seconds
+    HTTP_<NAME>_CONNECT_TIMEOUT   connect timeout in seconds
+    HTTP_<NAME>_MAX_CONNECTIONS   pool size
+    HTTP_<NAME>_MAX_KEEPALIVE     idle connections kept open
+and HTTP_KEEPALIVE_EXPIRY / HTTP2 for all of them. Stripe is the exception: the SDK has no public way
+to take a client of ours, so it keeps its own and only gets the timeouts.
+
+Every client counts requests in flight against its pool size (pool_stats), so we can see
+when a pool is saturated and requests start queueing for a connection, and records each
+request's latency (until its body is closed) in the upstream metrics.
+"""
+
+import os
+import time
+
+import httpx
+import stripe
+
+from .metrics import UPSTREAM_LATENCY, UPSTREAM_IN_FLIGHT
+
+try:
+    import h2  # noqa: F401  (httpx needs it for http2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+UPSTREAM_DEFAULTS = {
+    "supabase": {"timeout": 10, "connect_timeout": 3, "max_connections": 100, "max_keepalive": 50},
+    "stripe": {"timeout": 30, "connect_timeout": 5, "max_connections": 20, "max_keepalive": 10},
+    "openai": {"timeout": 30, "connect_timeout": 3, "max_connections": 200, "max_keepalive": 100},
+}
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+USE_HTTP2 = os.getenv("HTTP2", "1") == "1" and HTTP2_AVAILABLE
+
+_clients = {}
+_stripe_http = None
+pool_stats = {}
+
+def upstream_setting(name: str, setting: str):
+    default = UPSTREAM_DEFAULTS[name][setting]
+    return type(default)(os.getenv(f"HTTP_{name.upper()}_{setting.upper()}", default))
+
+class CountedStream(httpx.AsyncByteStream):
+    """
+    Response body wrapper that tells the transport when the response is finished with.
+    """
+    def __init__(self, stream, on_close):
+        self.stream = stream
+        self.on_close = on_close
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.on_close:
+                self.on_close()
+                self.on_close = None
+
+class CountingTransport(httpx.AsyncBaseTransport):
+    """
+    AsyncHTTPTransport that keeps in-flight/peak counts for pool_stats.
+    A request counts as in flight until its response body is closed.
+    """
+    def __init__(self, name: str, max_connections: int, **kwargs):
+        self.inner = httpx.AsyncHTTPTransport(**kwargs)
+        self.name = name
+        self.in_flight = UPSTREAM_IN_FLIGHT.labels(name)
+        self.stats = pool_stats.setdefault(name, {
+            "max_connections": max_connections,
+            "in_flight": 0,
+            "peak_in_flight": 0,
+            "requests": 0,
+            "saturated": 0,
+            "errors": 0,
+        })
+
+    def done(self, started: float, status: str):
+        self.stats["in_flight"] -= 1
+        self.in_flight.dec()
+        UPSTREAM_LATENCY.labels(self.name, status).observe(time.perf_counter() - started)
+
+    async def handle_async_request(self, request):
+        stats = self.stats
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        self.in_flight.inc()
+        started = time.perf_counter()
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        if stats["in_flight"] > stats["max_connections"]:
+            # this request will wait for a connection to free up
+            stats["saturated"] += 1
+
+        try:
+            response = await self.inner.handle_async_request(request)
+        except Exception:
+            stats["errors"] += 1
+            self.done(started, "error")
+            raise
+
+        status = str(response.status_code)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=CountedStream(response.stream, lambda: self.done(started, status)),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.inner.aclose()
+
+def build_http_client(name: str) -> httpx.AsyncClient:
+    max_connections = upstream_setting(name, "max_connections")
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=upstream_setting(name, "max_keepalive"),
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    transport = CountingTransport(name, max_connections, limits=limits, http2=USE_HTTP2, retries=1)
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(upstream_setting(name, "timeout"), connect=upstream_setting(name, "connect_timeout")),
+    )
+
+def get_http_client(name: str):
+    """
+    The shared client for an upstream, or None before start_http_clients has run.
+    """
+    return _clients.get(name)
+
+async def start_http_clients():
+    """
+    Build the shared clients. Called once per process at startup.
+    """
+    global _stripe_http
+    for name in UPSTREAM_DEFAULTS:
+        if name != "stripe" and name not in _clients:
+            _clients[name] = build_http_client(name)
+
+    # stripe's module level methods (retrieve_async etc) use stripe.default_http_client
+    if _stripe_http is None:
+        _stripe_http = stripe.HTTPXClient(timeout=httpx.Timeout(
+            upstream_setting("stripe", "timeout"), connect=upstream_setting("stripe", "connect_timeout")))
+        stripe.default_http_client = _stripe_http
+
+async def close_http_clients():
+    global _stripe_http
+    for name in list(_clients):
+        await _clients.pop(name).aclose()
+    if _stripe_http is not None:
+        await _stripe_http.close_async()
+        _stripe_http = None
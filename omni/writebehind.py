@@ -0,0 +1,143 @@
+"""
+Write-behind persistence for item content.
+
+The editor saves on every debounce tick, but only the latest content of an item matters.
+ContentWriter keeps the newest pending content per item and writes it with set_item_content
+every CONTENT_FLUSH_INTERVAL seconds (or sooner once CONTENT_FLUSH_SIZE items are waiting).
+Failed writes are retried with exponential backoff, unless newer content has arrived in the meantime.
+
+start() has to be called from inside the event loop (the FastAPI lifespan does it),
+and stop() flushes whatever is left before shutdown.
+"""
+
+import asyncio
+import logging
+import os
+import time
+
+from .helpers import set_item_content
+
+logger = logging.getLogger(__name__)
+
+CONTENT_FLUSH_INTERVAL = float(os.getenv("CONTENT_FLUSH_INTERVAL", "2"))
+CONTENT_FLUSH_SIZE = int(os.getenv("CONTENT_FLUSH_SIZE", "100"))
+CONTENT_FLUSH_CONCURRENCY = int(os.getenv("CONTENT_FLUSH_CONCURRENCY", "10"))
+RETRY_BASE_SECONDS = 1
+RETRY_MAX_SECONDS = 60
+
+class ContentWriter:
+    def __init__(self, write=set_item_content,
+                 interval: float = CONTENT_FLUSH_INTERVAL,
+                 flush_size: int = CONTENT_FLUSH_SIZE,
+                 concurrency: int = CONTENT_FLUSH_CONCURRENCY):
+        self.write = write
+        self.interval = interval
+        self.flush_size = flush_size
+        self.concurrency = concurrency
+        self.pending = {}    # (user_id, item_id) -> latest content
+        self.attempts = {}   # (user_id, item_id) -> failed attempts for the pending content
+        self.retry_at = {}   # (user_id, item_id) -> monotonic time before which we don't retry
+        self.task = None
+        self.wakeup = None
+        self.stopping = False
+        self.stats = {"enqueued": 0, "coalesced": 0, "writes": 0, "failures": 0, "flushes": 0}
+
+    def enqueue(self, user_id: str, item_id: str, content: str):
+        """
+        Queue content to be saved. Replaces anything already queued for the item.
+        """
+        key = (user_id, item_id)
+        if key in self.pending:
+            self.stats["coalesced"] += 1
+        self.pending[key] = content
+        # new content gets a fresh set of retries
+        self.attempts.pop(key, None)
+        self.retry_at.pop(key, None)
+        self.stats["enqueued"] += 1
+
+        if self.wakeup is not None and len(self.pending) >= self.flush_size:
+            self.wakeup.set()
+
+    def pending_content(self, user_id: str, item_id: str):
+        """
+        Content that is queued but not written yet, or None.
+        """
+        return self.pending.get((user_id, item_id))
+
+    def discard(self, user_id: str, item_id: str):
+        """
+        Drop anything queued for an item (e.g. because it was deleted).
+        """
+        key = (user_id, item_id)
+        self.pending.pop(key, None)
+        self.attempts.pop(key, None)
+        self.retry_at.pop(key, None)
+
+    async def write_one(self, key, content, semaphore):
+        async with semaphore:
+            try:
+                await self.write(key[0], key[1], content)
+                self.stats["writes"] += 1
+            except Exception as e:
+                logger.warning("saving content for %s failed: %s", key[1], e)
+                self.stats["failures"] += 1
+                # only retry if nothing newer was queued while we were writing
+                if key not in self.pending:
+                    attempts = self.attempts.get(key, 0) + 1
+                    self.pending[key] = content
+                    self.attempts[key] = attempts
+                    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempts - 1))
+                    self.retry_at[key] = time.monotonic() + delay
+
+    async def flush(self, force: bool = False):
+        """
+        Write everything that is due. force ignores retry backoff (used when draining).
+        """
+        now = time.monotonic()
+        batch = {}
+        for key in list(self.pending):
+            if force or self.retry_at.get(key, 0) <= now:
+                batch[key] = self.pending.pop(key)
+                self.retry_at.pop(key, None)
+        if not batch:
+            return
+
+        self.stats["flushes"] += 1
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(*[self.write_one(key, content, semaphore) for key, content in batch.items()])
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.stopping = False
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout: float = 10):
+        """
+        Stop the flush loop and write out whatever is still pending.
+        """
+        if self.task is not None:
+            # let the loop finish the flush it's in rather than cancelling writes half way
+            self.stopping = True
+            self.wakeup.set()
+            await self.task
+            self.task = None
+
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await self.flush(force=True)
+            if self.pending:
+                await asyncio.sleep(RETRY_BASE_SECONDS)
+        if self.pending:
+            logger.error("content writer stopped with %d unsaved items", len(self.pending))
+
+content_writer = ContentWriter()